@@ -3,13 +3,15 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserChangeForm, UserCreationForm
 from django.contrib.auth.models import AbstractUser, Permission
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from import_export.admin import ExportActionModelAdmin
 from modeltranslation.admin import TranslationAdmin
 from simple_history.admin import SimpleHistoryAdmin
 
 from .models import (AcademicField, AcademicLevel, ActionToken, Domain,
-                     Organization, TemporaryToken, User)
+                     ExportJob, Organization, OutgoingEmail, TemporaryToken,
+                     TicketEntry, User)
 from .resources import (AcademicFieldResource, AcademicLevelResource,
                         OrganizationResource, UserResource)
 
@@ -99,6 +101,46 @@ class AcademicLevelAdmin(SimpleHistoryAdmin, TranslationAdmin,
     resource_class = AcademicLevelResource
 
 
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient_list', 'status', 'attempts',
+                    'created', 'sent',)
+    search_fields = ('subject', 'recipient_list',)
+    list_filter = (
+        'status',
+        'created',
+    )
+    actions = ('requeue', )
+
+    def requeue(self, request, queryset):
+        queryset.exclude(status='S').update(
+            status='P',
+            attempts=0,
+            next_attempt=timezone.now(),
+        )
+    requeue.short_description = _('Send again')
+
+
+class TicketEntryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'amount', 'reason', 'created',)
+    search_fields = ('user__email', 'user__username',)
+    list_filter = (
+        'reason',
+        'created',
+    )
+    readonly_fields = ('user', 'amount', 'reason', 'created',)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('export', 'file_format', 'user', 'status', 'created_at',
+                    'completed_at',)
+    list_filter = (
+        'export',
+        'status',
+        'created_at',
+    )
+    readonly_fields = ('file', 'error', 'completed_at',)
+
+
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Organization, CustomOrganizationAdmin)
 admin.site.register(Domain, SimpleHistoryAdmin)
@@ -106,3 +148,6 @@ admin.site.register(ActionToken, ActionTokenAdmin)
 admin.site.register(TemporaryToken, TemporaryTokenAdmin)
 admin.site.register(AcademicField, AcademicFieldAdmin)
 admin.site.register(AcademicLevel, AcademicLevelAdmin)
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
+admin.site.register(TicketEntry, TicketEntryAdmin)
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -3,3 +3,10 @@ class MailServiceError(Exception):
     Raised when an email needs to be sent but an error occurs.
     """
     pass
+
+
+class InsufficientTicketsError(Exception):
+    """
+    Raised when more tickets are debited from a user than they have.
+    """
+    pass
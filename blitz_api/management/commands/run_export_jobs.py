@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from blitz_api.services import run_export_jobs
+
+
+class Command(BaseCommand):
+    help = 'Build the files of pending export jobs and save them to the ' \
+           'media storage'
+
+    def handle(self, *args, **options):
+        results = run_export_jobs()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Completed {completed} export jobs, {failed} failed'.format(
+                **results
+            )
+        ))
@@ -0,0 +1,78 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blitz_api.models import OutgoingEmail
+from blitz_api.services import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Send the emails waiting in the outbox. Emails that fail are ' \
+           'retried with an exponential backoff and marked as failed after ' \
+           'the maximum number of attempts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', default=100, type=int)
+        parser.add_argument('--max_attempts', default=5, type=int)
+        parser.add_argument(
+            '--retry_delay',
+            default=60,
+            type=int,
+            help='Seconds before the first retry of a failed email, doubled '
+                 'at each attempt',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            dest='loop',
+            help='Keep polling the outbox instead of exiting once it is empty',
+        )
+        parser.add_argument(
+            '--interval',
+            default=5,
+            type=float,
+            help='Seconds to wait between polls when the outbox is empty',
+        )
+
+    def handle(self, *args, **options):
+        totals = {'sent': 0, 'retried': 0, 'failed': 0}
+        batches = 0
+        start = time.monotonic()
+
+        try:
+            while True:
+                results = send_queued_emails(
+                    batch_size=options['batch_size'],
+                    max_attempts=options['max_attempts'],
+                    retry_delay=options['retry_delay'],
+                )
+                processed = sum(results.values())
+                if processed:
+                    batches += 1
+                    for key in totals:
+                        totals[key] += results[key]
+                    if options['loop']:
+                        self.report(totals, batches, start)
+                elif options['loop']:
+                    time.sleep(options['interval'])
+                else:
+                    break
+        except KeyboardInterrupt:
+            pass
+
+        self.report(totals, batches, start)
+
+    def report(self, totals, batches, start):
+        duration = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            'Sent {sent} emails, {retried} retried, {failed} failed in '
+            '{batches} batches ({rate:.2f} emails/s)'.format(
+                batches=batches,
+                rate=totals['sent'] / duration if duration else 0,
+                **totals
+            )
+        ))
+        self.stdout.write('Outbox: {0} pending, {1} failed'.format(
+            OutgoingEmail.objects.filter(status='P').count(),
+            OutgoingEmail.objects.filter(status='F').count(),
+        ))
@@ -0,0 +1,40 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:20
+
+from django.db import migrations, models
+import django.utils.timezone
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blitz_api', '0017_actiontoken_data_change_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=253, verbose_name='Subject')),
+                ('message', models.TextField(blank=True, verbose_name='Message')),
+                ('html_message', models.TextField(blank=True, null=True, verbose_name='HTML message')),
+                ('from_email', models.CharField(max_length=253, verbose_name='From')),
+                ('recipient_list', jsonfield.fields.JSONField(verbose_name='Recipients')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('S', 'Sent'), ('F', 'Failed')], default='P', max_length=1, verbose_name='Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='Sent date')),
+            ],
+            options={
+                'verbose_name': 'Outgoing email',
+                'verbose_name_plural': 'Outgoing emails',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='outgoingemail',
+            index_together={('status', 'next_attempt')},
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ticket_ledgers(apps, schema_editor):
+    '''
+    Start the ledger of each user holding tickets with an entry of its
+    current balance.
+    '''
+    User = apps.get_model('blitz_api', 'User')
+    TicketEntry = apps.get_model('blitz_api', 'TicketEntry')
+    TicketEntry.objects.bulk_create(
+        [
+            TicketEntry(user_id=user_id, amount=tickets, reason='I')
+            for user_id, tickets in User.objects.filter(
+                tickets__gt=0,
+            ).values_list('id', 'tickets')
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blitz_api', '0018_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(verbose_name='Amount')),
+                ('reason', models.CharField(choices=[('I', 'Initial balance'), ('P', 'Package purchase'), ('R', 'Reservation'), ('C', 'Reservation canceled'), ('O', 'Order released')], max_length=1, verbose_name='Reason')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_entries', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Ticket entry',
+                'verbose_name_plural': 'Ticket entries',
+            },
+        ),
+        migrations.RunPython(open_ticket_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.8 on 2026-10-18 04:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blitz_api', '0019_ticketentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('export', models.CharField(choices=[('user', 'Users'), ('organization', 'Organizations'), ('academic_level', 'Academic levels'), ('academic_field', 'Academic fields'), ('membership', 'Memberships'), ('package', 'Packages'), ('order', 'Orders'), ('order_line', 'Order lines'), ('custom_payment', 'Custom payments'), ('coupon', 'Coupons'), ('coupon_user', 'Coupon uses'), ('refund', 'Refunds'), ('workplace', 'Workplaces'), ('period', 'Periods'), ('timeslot', 'Time slots'), ('reservation', 'Reservations'), ('retirement', 'Retirements'), ('retirement_reservation', 'Retirement reservations'), ('wait_queue', 'Wait queues'), ('wait_queue_notification', 'Wait queue notifications')], max_length=100, verbose_name='Export')),
+                ('file_format', models.CharField(choices=[('csv', 'CSV'), ('xlsx', 'XLSX')], default='xlsx', max_length=10, verbose_name='File format')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('R', 'Running'), ('C', 'Completed'), ('F', 'Failed')], default='P', max_length=1, verbose_name='Status')),
+                ('file', models.FileField(blank=True, upload_to='exports', verbose_name='File')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('completed_at', models.DateTimeField(blank=True, null=True, verbose_name='Completion date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Export job',
+                'verbose_name_plural': 'Export jobs',
+            },
+        ),
+    ]
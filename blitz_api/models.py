@@ -382,3 +382,227 @@ class Address(models.Model):
 
     class Meta:
         abstract = True
+
+
+class OutgoingEmail(models.Model):
+    """
+    Email waiting to be sent by the "send_queued_emails" command.
+
+    Emails are saved in the same transaction as the changes they notify and
+    are retried with an exponential backoff until they are sent or reach the
+    maximum number of attempts.
+    """
+
+    class Meta:
+        verbose_name = _("Outgoing email")
+        verbose_name_plural = _("Outgoing emails")
+        index_together = (('status', 'next_attempt'), )
+
+    STATUS = (
+        ('P', _("Pending")),
+        ('S', _("Sent")),
+        ('F', _("Failed")),
+    )
+
+    subject = models.CharField(
+        verbose_name=_("Subject"),
+        max_length=253,
+    )
+
+    message = models.TextField(
+        verbose_name=_("Message"),
+        blank=True,
+    )
+
+    html_message = models.TextField(
+        verbose_name=_("HTML message"),
+        null=True,
+        blank=True,
+    )
+
+    from_email = models.CharField(
+        verbose_name=_("From"),
+        max_length=253,
+    )
+
+    recipient_list = JSONField(
+        verbose_name=_("Recipients"),
+    )
+
+    status = models.CharField(
+        verbose_name=_("Status"),
+        max_length=1,
+        choices=STATUS,
+        default='P',
+    )
+
+    attempts = models.PositiveIntegerField(
+        verbose_name=_("Attempts"),
+        default=0,
+    )
+
+    next_attempt = models.DateTimeField(
+        verbose_name=_("Next attempt"),
+        default=timezone.now,
+    )
+
+    last_error = models.TextField(
+        verbose_name=_("Last error"),
+        blank=True,
+    )
+
+    created = models.DateTimeField(
+        verbose_name=_("Creation date"),
+        auto_now_add=True,
+    )
+
+    sent = models.DateTimeField(
+        verbose_name=_("Sent date"),
+        null=True,
+        blank=True,
+    )
+
+    def __str__(self):
+        return self.subject
+
+
+class TicketEntry(models.Model):
+    """
+    Credit or debit of tickets in the ledger of a user. Entries are only
+    added, along with an atomic update of the user's balance (User.tickets).
+    """
+
+    class Meta:
+        verbose_name = _("Ticket entry")
+        verbose_name_plural = _("Ticket entries")
+
+    REASONS = (
+        ('I', _("Initial balance")),
+        ('P', _("Package purchase")),
+        ('R', _("Reservation")),
+        ('C', _("Reservation canceled")),
+        ('O', _("Order released")),
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name=_("User"),
+        related_name='ticket_entries',
+    )
+
+    amount = models.IntegerField(
+        verbose_name=_("Amount"),
+    )
+
+    reason = models.CharField(
+        verbose_name=_("Reason"),
+        max_length=1,
+        choices=REASONS,
+    )
+
+    created = models.DateTimeField(
+        verbose_name=_("Creation date"),
+        auto_now_add=True,
+    )
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.user, self.amount)
+
+
+class ExportJob(models.Model):
+    """
+    Export of a whole table, built in the background by the
+    "run_export_jobs" command and saved to the media storage.
+    """
+
+    class Meta:
+        verbose_name = _("Export job")
+        verbose_name_plural = _("Export jobs")
+
+    EXPORTS = (
+        ('user', _("Users")),
+        ('organization', _("Organizations")),
+        ('academic_level', _("Academic levels")),
+        ('academic_field', _("Academic fields")),
+        ('membership', _("Memberships")),
+        ('package', _("Packages")),
+        ('order', _("Orders")),
+        ('order_line', _("Order lines")),
+        ('custom_payment', _("Custom payments")),
+        ('coupon', _("Coupons")),
+        ('coupon_user', _("Coupon uses")),
+        ('refund', _("Refunds")),
+        ('workplace', _("Workplaces")),
+        ('period', _("Periods")),
+        ('timeslot', _("Time slots")),
+        ('reservation', _("Reservations")),
+        ('retirement', _("Retirements")),
+        ('retirement_reservation', _("Retirement reservations")),
+        ('wait_queue', _("Wait queues")),
+        ('wait_queue_notification', _("Wait queue notifications")),
+    )
+
+    FORMATS = (
+        ('csv', "CSV"),
+        ('xlsx', "XLSX"),
+    )
+
+    STATUS = (
+        ('P', _("Pending")),
+        ('R', _("Running")),
+        ('C', _("Completed")),
+        ('F', _("Failed")),
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name=_("User"),
+        related_name='export_jobs',
+    )
+
+    export = models.CharField(
+        verbose_name=_("Export"),
+        max_length=100,
+        choices=EXPORTS,
+    )
+
+    file_format = models.CharField(
+        verbose_name=_("File format"),
+        max_length=10,
+        choices=FORMATS,
+        default='xlsx',
+    )
+
+    status = models.CharField(
+        verbose_name=_("Status"),
+        max_length=1,
+        choices=STATUS,
+        default='P',
+    )
+
+    file = models.FileField(
+        verbose_name=_("File"),
+        upload_to='exports',
+        blank=True,
+    )
+
+    error = models.TextField(
+        verbose_name=_("Error"),
+        blank=True,
+    )
+
+    created_at = models.DateTimeField(
+        verbose_name=_("Creation date"),
+        auto_now_add=True,
+    )
+
+    completed_at = models.DateTimeField(
+        verbose_name=_("Completion date"),
+        null=True,
+        blank=True,
+    )
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.export, self.created_at)
@@ -12,7 +12,7 @@ from django.core.mail import EmailMessage
 from django.db.models.base import ObjectDoesNotExist
 
 from .models import (
-    Domain, Organization, ActionToken, AcademicField, AcademicLevel,
+    Domain, Organization, ActionToken, AcademicField, AcademicLevel, ExportJob,
 )
 from .services import remove_translation_fields, check_if_translated_field
 from . import services
@@ -590,3 +590,16 @@ class ChangePasswordSerializer(serializers.Serializer):
 
     token = serializers.CharField(required=True)
     new_password = serializers.CharField(required=True)
+
+
+class ExportJobSerializer(serializers.HyperlinkedModelSerializer):
+    id = serializers.ReadOnlyField()
+    user = serializers.HyperlinkedRelatedField(
+        view_name='user-detail',
+        read_only=True,
+    )
+
+    class Meta:
+        model = ExportJob
+        fields = '__all__'
+        read_only_fields = ('status', 'file', 'error', 'completed_at',)
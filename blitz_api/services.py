@@ -1,25 +1,103 @@
-from datetime import datetime
+import csv
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+import tempfile
 
 import pytz
 import re
 
 from django.apps import apps
 from django.conf import settings
-from django.core.mail import EmailMessage
-from django.http import HttpResponse
+from django.core.files import File
+from django.core.mail import (EmailMessage, EmailMultiAlternatives,
+                              get_connection)
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
 from django.utils.translation import ugettext_lazy as _
 from django.template.loader import render_to_string
 
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import PageNumberPagination
 
-from .exceptions import MailServiceError
+from .exceptions import InsufficientTicketsError, MailServiceError
+from .models import ExportJob, OutgoingEmail, TicketEntry, User
 from django.core.mail import send_mail as django_send_mail
 
 from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
+logger = logging.getLogger(__name__)
+
 LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
 
+# Number of objects fetched at once by streamed exports
+EXPORT_CHUNK_SIZE = 1000
+
+# Model and import-export resource of each export that can be run as a job
+EXPORT_RESOURCES = {
+    'user': ('blitz_api.User', 'blitz_api.resources.UserResource'),
+    'organization': (
+        'blitz_api.Organization',
+        'blitz_api.resources.OrganizationResource',
+    ),
+    'academic_level': (
+        'blitz_api.AcademicLevel',
+        'blitz_api.resources.AcademicLevelResource',
+    ),
+    'academic_field': (
+        'blitz_api.AcademicField',
+        'blitz_api.resources.AcademicFieldResource',
+    ),
+    'membership': ('store.Membership', 'store.resources.MembershipResource'),
+    'package': ('store.Package', 'store.resources.PackageResource'),
+    'order': ('store.Order', 'store.resources.OrderResource'),
+    'order_line': ('store.OrderLine', 'store.resources.OrderLineResource'),
+    'custom_payment': (
+        'store.CustomPayment',
+        'store.resources.CustomPaymentResource',
+    ),
+    'coupon': ('store.Coupon', 'store.resources.CouponResource'),
+    'coupon_user': ('store.CouponUser', 'store.resources.CouponUserResource'),
+    'refund': ('store.Refund', 'store.resources.RefundResource'),
+    'workplace': (
+        'workplace.Workplace',
+        'workplace.resources.WorkplaceResource',
+    ),
+    'period': ('workplace.Period', 'workplace.resources.PeriodResource'),
+    'timeslot': ('workplace.TimeSlot', 'workplace.resources.TimeSlotResource'),
+    'reservation': (
+        'workplace.Reservation',
+        'workplace.resources.ReservationResource',
+    ),
+    'retirement': (
+        'retirement.Retirement',
+        'retirement.resources.RetirementResource',
+    ),
+    'retirement_reservation': (
+        'retirement.Reservation',
+        'retirement.resources.ReservationResource',
+    ),
+    'wait_queue': (
+        'retirement.WaitQueue',
+        'retirement.resources.WaitQueueResource',
+    ),
+    'wait_queue_notification': (
+        'retirement.WaitQueueNotification',
+        'retirement.resources.WaitQueueNotificationResource',
+    ),
+}
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.'
+            'sheet',
+}
+
 
 def send_mail(users, context, template):
     """
@@ -118,7 +196,7 @@ def notify_user_of_new_account(email, password):
             merge_data
         )
 
-        return django_send_mail(
+        return queue_mail(
             "Bienvenue à Thèsez-vous?",
             plain_msg,
             settings.DEFAULT_FROM_EMAIL,
@@ -127,6 +205,430 @@ def notify_user_of_new_account(email, password):
         )
 
 
+def queue_mail(subject, message, from_email, recipient_list,
+               html_message=None, on_commit=False):
+    """
+    Replacement of Django's send_mail for transactional emails.
+
+    If the EMAIL_OUTBOX setting is enabled, the email is saved in the outbox,
+    as part of the current transaction, to be sent by the
+    "send_queued_emails" command. Otherwise it is sent right away, or once
+    the current transaction is committed if on_commit is True: the email is
+    then not sent if the transaction is rolled back, and an error while
+    sending it is logged instead of failing the committed transaction.
+    """
+    if not settings.LOCAL_SETTINGS.get('EMAIL_OUTBOX'):
+        if not on_commit:
+            return django_send_mail(
+                subject,
+                message,
+                from_email,
+                recipient_list,
+                html_message=html_message,
+            )
+
+        def send():
+            try:
+                django_send_mail(
+                    subject,
+                    message,
+                    from_email,
+                    recipient_list,
+                    html_message=html_message,
+                )
+            except Exception:
+                logger.exception(
+                    'Email "%s" to %s could not be sent',
+                    subject,
+                    ', '.join(recipient_list),
+                )
+
+        transaction.on_commit(send)
+        return 1
+
+    OutgoingEmail.objects.create(
+        subject=subject,
+        message=message,
+        html_message=html_message,
+        from_email=from_email,
+        recipient_list=list(recipient_list),
+    )
+    return 1
+
+
+def queue_mass_mail(subject, message, from_email, recipient_list,
+                    html_message=None, unique=True):
+    """
+    Send the same email separately to each recipient of the list. Duplicated
+    recipients get a single email unless unique is False.
+
+    If the EMAIL_OUTBOX setting is enabled, the emails are saved in the outbox
+    in bulk. Otherwise they are sent right away over a single connection, and
+    a recipient that can't be reached doesn't prevent sending to the others.
+
+    Returns the delivery status of each recipient: "queued", "sent" or
+    "failed" with the error.
+    """
+    if unique:
+        recipient_list = list(dict.fromkeys(recipient_list))
+
+    if settings.LOCAL_SETTINGS.get('EMAIL_OUTBOX'):
+        OutgoingEmail.objects.bulk_create([
+            OutgoingEmail(
+                subject=subject,
+                message=message,
+                html_message=html_message,
+                from_email=from_email,
+                recipient_list=[recipient],
+            ) for recipient in recipient_list
+        ])
+        return [
+            {'email': recipient, 'status': 'queued'}
+            for recipient in recipient_list
+        ]
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception:
+        # Each email will try to open the connection and fail on its own
+        pass
+
+    results = []
+    for recipient in recipient_list:
+        email = EmailMultiAlternatives(
+            subject,
+            message,
+            from_email,
+            [recipient],
+            connection=connection,
+        )
+        if html_message:
+            email.attach_alternative(html_message, 'text/html')
+        try:
+            email.send()
+        except Exception as err:
+            results.append({
+                'email': recipient,
+                'status': 'failed',
+                'error': '{0}: {1}'.format(type(err).__name__, err),
+            })
+        else:
+            results.append({'email': recipient, 'status': 'sent'})
+
+    connection.close()
+
+    return results
+
+
+def send_queued_emails(batch_size=100, max_attempts=5, retry_delay=60):
+    """
+    Send a batch of emails waiting in the outbox over a single connection.
+
+    Emails are claimed before being sent so that concurrent workers don't
+    send them twice. An email that can't be sent is retried after
+    retry_delay seconds, doubled at each attempt, and is marked as failed
+    after max_attempts attempts.
+
+    Returns the number of emails sent, retried and failed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+                status='P',
+                next_attempt__lte=now,
+            ).order_by('next_attempt', 'id')[:batch_size]
+        )
+        # Claim the batch until the next retry in case the worker dies
+        OutgoingEmail.objects.filter(
+            id__in=[email.id for email in emails],
+        ).update(next_attempt=now + timedelta(seconds=retry_delay))
+
+    results = {'sent': 0, 'retried': 0, 'failed': 0}
+    if not emails:
+        return results
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception:
+        # Each email will try to open the connection and fail on its own
+        pass
+
+    for email in emails:
+        email.attempts += 1
+        message = EmailMultiAlternatives(
+            email.subject,
+            email.message,
+            email.from_email,
+            email.recipient_list,
+            connection=connection,
+        )
+        if email.html_message:
+            message.attach_alternative(email.html_message, 'text/html')
+        try:
+            message.send()
+        except Exception as err:
+            email.last_error = '{0}: {1}'.format(type(err).__name__, err)
+            if email.attempts >= max_attempts:
+                email.status = 'F'
+                results['failed'] += 1
+            else:
+                email.next_attempt = timezone.now() + timedelta(
+                    seconds=retry_delay * 2 ** (email.attempts - 1)
+                )
+                results['retried'] += 1
+        else:
+            email.status = 'S'
+            email.sent = timezone.now()
+            results['sent'] += 1
+        email.save()
+
+    connection.close()
+
+    return results
+
+
+def update_tickets(amounts, reason):
+    """
+    Credit or debit the tickets of users.
+
+    amounts maps user ids to the number of tickets credited to them, or
+    debited if negative. All balances are updated at once by a single
+    statement and an entry is added to the ledger of each user.
+
+    Raises InsufficientTicketsError, without changing any balance, if a user
+    doesn't have enough tickets to be debited, or User.DoesNotExist if a user
+    doesn't exist. The enclosing transaction, if any, must then be rolled
+    back.
+    """
+    amounts = {
+        user_id: amount for user_id, amount in amounts.items() if amount
+    }
+    if not amounts:
+        return
+
+    # Debits only apply to balances that can cover them
+    condition = Q()
+    for user_id, amount in amounts.items():
+        if amount < 0:
+            condition |= Q(pk=user_id, tickets__gte=-amount)
+        else:
+            condition |= Q(pk=user_id)
+
+    with transaction.atomic(savepoint=False):
+        updated = User.objects.filter(condition).update(
+            tickets=Coalesce(F('tickets'), 0) + Case(
+                *[
+                    When(pk=user_id, then=Value(amount))
+                    for user_id, amount in amounts.items()
+                ],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+        if updated != len(amounts):
+            missing = set(amounts) - set(
+                User.objects.filter(
+                    pk__in=list(amounts),
+                ).values_list('pk', flat=True)
+            )
+            if missing:
+                raise User.DoesNotExist(
+                    "Users {0} do not exist.".format(sorted(missing))
+                )
+            raise InsufficientTicketsError(
+                _("You don't have enough tickets.")
+            )
+
+        TicketEntry.objects.bulk_create([
+            TicketEntry(user_id=user_id, amount=amount, reason=reason)
+            for user_id, amount in amounts.items()
+        ])
+
+
+def iterate_by_pk(queryset, chunk_size=None):
+    """
+    Iterate over the objects of a queryset, fetched by chunks of
+    EXPORT_CHUNK_SIZE objects in ascending primary key order. Each chunk
+    starts after the last primary key of the previous one instead of using
+    an OFFSET, so that every chunk costs the same no matter how deep in the
+    table it is.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    queryset = queryset.order_by('pk')
+    last_pk = None
+
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        for obj in chunk:
+            yield obj
+        last_pk = chunk[-1].pk
+
+
+def export_rows(resource, queryset):
+    """
+    Generate the headers, then one row per object, of the export of a
+    queryset by an import-export resource.
+    """
+    yield resource.get_export_headers()
+    for obj in iterate_by_pk(queryset):
+        yield resource.export_resource(obj)
+
+
+class Echo(object):
+    """ File-like object returning what is written to it """
+    def write(self, value):
+        return value
+
+
+def write_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(rows):
+    """
+    Write rows to a temporary XLSX file and return it. The workbook is in
+    write-only mode: rows are flushed to disk as they are added instead of
+    being kept in memory.
+    """
+    # Only needed by XLSX exports
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    for row in rows:
+        worksheet.append([
+            value if isinstance(value, (int, float, Decimal)) or value is None
+            else str(value)
+            for value in row
+        ])
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+
+    return output
+
+
+def run_export_job(job):
+    """
+    Build the file of an export job and save it to the media storage.
+    Return True if the job was completed.
+    """
+    # Claim the job so that it is not run twice by concurrent workers
+    claimed = ExportJob.objects.filter(pk=job.pk, status='P').update(
+        status='R',
+    )
+    if not claimed:
+        return False
+
+    try:
+        model_label, resource_path = EXPORT_RESOURCES[job.export]
+        queryset = apps.get_model(model_label)._default_manager.all()
+        rows = export_rows(import_string(resource_path)(), queryset)
+
+        if job.file_format == 'csv':
+            output = tempfile.TemporaryFile()
+            for line in write_csv(rows):
+                output.write(line.encode('utf-8'))
+        else:
+            output = write_xlsx(rows)
+
+        with output:
+            output.seek(0)
+            job.file.save(
+                '{0}-{1}.{2}'.format(
+                    job.export,
+                    LOCAL_TIMEZONE.localize(
+                        datetime.now()
+                    ).strftime("%Y%m%d-%H%M%S"),
+                    job.file_format,
+                ),
+                File(output),
+                save=False,
+            )
+    except Exception as err:
+        job.status = 'F'
+        job.error = '{0}: {1}'.format(type(err).__name__, err)
+        job.save()
+        return False
+
+    job.status = 'C'
+    job.completed_at = timezone.now()
+    job.save()
+
+    return True
+
+
+def run_export_jobs():
+    """
+    Run the pending export jobs, oldest first, and return how many were
+    completed and how many failed.
+    """
+    results = {'completed': 0, 'failed': 0}
+
+    for job in ExportJob.objects.filter(status='P').order_by('created_at'):
+        if run_export_job(job):
+            results['completed'] += 1
+        else:
+            job.refresh_from_db()
+            if job.status == 'F':
+                results['failed'] += 1
+
+    return results
+
+
+def stream_export(request, resource, queryset, name):
+    """
+    Return the export of a whole queryset by an import-export resource, in
+    the format given by the `stream` query parameter (csv or xlsx).
+
+    Objects are fetched and written by chunks so that memory stays flat no
+    matter how many there are. CSV rows are sent as they are written while
+    XLSX files are built on disk first.
+    """
+    file_format = request.query_params.get('stream')
+    if file_format not in EXPORT_CONTENT_TYPES:
+        raise ValidationError({
+            'stream': [_(
+                "Select a valid export format: {0}."
+            ).format(', '.join(sorted(EXPORT_CONTENT_TYPES)))]
+        })
+
+    rows = export_rows(resource, queryset)
+    if file_format == 'csv':
+        response = StreamingHttpResponse(
+            write_csv(rows),
+            content_type=EXPORT_CONTENT_TYPES[file_format],
+        )
+    else:
+        response = FileResponse(
+            write_xlsx(rows),
+            content_type=EXPORT_CONTENT_TYPES[file_format],
+        )
+
+    response['Content-Disposition'] = ''.join([
+        'attachment; filename="',
+        name,
+        '-',
+        LOCAL_TIMEZONE.localize(datetime.now()).strftime("%Y%m%d-%H%M%S"),
+        '.',
+        file_format,
+        '"',
+    ])
+
+    return response
+
+
 class ExportPagination(PageNumberPagination):
     """ Custom paginator for data exportation """
     page_size = 1000
@@ -15,6 +15,7 @@ import logging
 from pathlib import Path
 import sys
 
+from corsheaders.defaults import default_headers
 from decouple import config, Csv
 from django.utils.translation import ugettext_lazy as _
 from dj_database_url import parse as db_url
@@ -105,6 +106,12 @@ LOGGING = {
             'level': 'DEBUG',  # change debug level as appropiate
             'propagate': False,
         },
+        # One line per call to the external payment API
+        'store.gateway': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 # Disable logging during unittests. Can be overriden in specific tests with:
@@ -257,6 +264,14 @@ REST_FRAMEWORK = {
 
 CORS_ORIGIN_ALLOW_ALL = True
 
+CORS_ALLOW_HEADERS = default_headers + (
+    'idempotency-key',
+)
+
+CORS_EXPOSE_HEADERS = (
+    'idempotent-replayed',
+)
+
 
 # Temporary Token
 
@@ -308,6 +323,9 @@ SUPPORT_EMAIL = config('SUPPORT_EMAIL', default='admin@fjnr.ca')
 LOCAL_SETTINGS = {
     'ORGANIZATION': config('ORGANIZATION', default='Blitz'),
     'EMAIL_SERVICE': config('EMAIL_SERVICE', default=False, cast=bool),
+    # Emails saved in the outbox are only sent by the "send_queued_emails"
+    # command: enable it once that command is scheduled.
+    'EMAIL_OUTBOX': config('EMAIL_OUTBOX', default=False, cast=bool),
     'AUTO_ACTIVATE_USER': config('AUTO_ACTIVATE_USER', default=False, cast=bool),
     'FRONTEND_INTEGRATION': {
         'ACTIVATION_URL': config('ACTIVATION_URL', default='https://example.com/activate/{{token}}'),
@@ -315,6 +333,11 @@ LOCAL_SETTINGS = {
     },
     'SELLING_TAX': 0.14975,
     'RETIREMENT_NOTIFICATION_LIFETIME_DAYS': config('RETIREMENT_NOTIFICATION_LIFETIME_DAYS', default=30),
+    'IDEMPOTENCY_KEY_LIFETIME_HOURS': config('IDEMPOTENCY_KEY_LIFETIME_HOURS', default=24, cast=int),
+    'IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS': config('IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS', default=120, cast=int),
+    'PENDING_ORDER_LIFETIME_MINUTES': config('PENDING_ORDER_LIFETIME_MINUTES', default=15, cast=int),
+    'REFUND_CONCURRENCY': config('REFUND_CONCURRENCY', default=4, cast=int),
+    'TIMESLOT_BATCH_SIZE': config('TIMESLOT_BATCH_SIZE', default=500, cast=int),
 }
 
 # Payment settings
@@ -326,6 +349,13 @@ PAYSAFE = {
     'BASE_URL': config('PAYSAFE_BASE_URL', default='https://api.test.paysafe.com/'),
     'VAULT_URL': config('PAYSAFE_VAULT_URL', default='customervault/v1/'),
     'CARD_URL': config('PAYSAFE_CARD_URL', default='cardpayments/v1/'),
+    'POOL_SIZE': config('PAYSAFE_POOL_SIZE', default=10, cast=int),
+    'CONNECT_TIMEOUT': config('PAYSAFE_CONNECT_TIMEOUT', default=3.05, cast=float),
+    'READ_TIMEOUT': config('PAYSAFE_READ_TIMEOUT', default=20, cast=float),
+    'MAX_RETRIES': config('PAYSAFE_MAX_RETRIES', default=2, cast=int),
+    'RETRY_BACKOFF': config('PAYSAFE_RETRY_BACKOFF', default=0.2, cast=float),
+    'BREAKER_THRESHOLD': config('PAYSAFE_BREAKER_THRESHOLD', default=5, cast=int),
+    'BREAKER_RESET_TIMEOUT': config('PAYSAFE_BREAKER_RESET_TIMEOUT', default=30, cast=float),
 }
 
 # django-import-export
@@ -0,0 +1,123 @@
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock
+
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from blitz_api.models import OutgoingEmail
+from blitz_api.services import queue_mail, queue_mass_mail
+
+
+@override_settings(
+    LOCAL_SETTINGS=dict(settings.LOCAL_SETTINGS, EMAIL_OUTBOX=True),
+)
+class SendQueuedEmailsTest(TestCase):
+
+    def queue_emails(self, count):
+        for i in range(count):
+            queue_mail(
+                "Subject {0}".format(i),
+                "Message",
+                settings.DEFAULT_FROM_EMAIL,
+                ["user{0}@example.com".format(i)],
+                html_message="<p>Message</p>",
+            )
+
+    def test_queue_mail(self):
+        """
+        Ensure emails are saved in the outbox instead of being sent.
+        """
+        self.queue_emails(1)
+
+        email = OutgoingEmail.objects.get()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(email.status, 'P')
+        self.assertEqual(email.recipient_list, ["user0@example.com"])
+
+    def test_queue_mass_mail(self):
+        """
+        Ensure an email is saved in the outbox for each distinct recipient.
+        """
+        results = queue_mass_mail(
+            "Subject",
+            "Message",
+            settings.DEFAULT_FROM_EMAIL,
+            ["user0@example.com", "user1@example.com", "user0@example.com"],
+        )
+
+        self.assertEqual(results, [
+            {'email': "user0@example.com", 'status': 'queued'},
+            {'email': "user1@example.com", 'status': 'queued'},
+        ])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            [email.recipient_list for email in OutgoingEmail.objects.all()],
+            [["user0@example.com"], ["user1@example.com"]],
+        )
+
+    @override_settings(LOCAL_SETTINGS=settings.LOCAL_SETTINGS)
+    def test_queue_mail_without_outbox(self):
+        """
+        Ensure emails are sent right away when the outbox is disabled.
+        """
+        self.queue_emails(1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_send_queued_emails(self):
+        out = StringIO()
+        self.queue_emails(3)
+
+        call_command('send_queued_emails', '--batch_size=2', stdout=out)
+
+        self.assertIn(
+            'Sent 3 emails, 0 retried, 0 failed in 2 batches',
+            out.getvalue(),
+        )
+        self.assertIn('Outbox: 0 pending, 0 failed', out.getvalue())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].to, ["user0@example.com"])
+        self.assertEqual(
+            mail.outbox[0].alternatives,
+            [("<p>Message</p>", 'text/html')],
+        )
+        self.assertFalse(OutgoingEmail.objects.exclude(status='S').exists())
+
+    @mock.patch(
+        'django.core.mail.EmailMultiAlternatives.send',
+        side_effect=SMTPException("Connection refused"),
+    )
+    def test_send_queued_emails_error(self, send):
+        """
+        Ensure emails that can't be sent are retried later, then marked as
+        failed after the maximum number of attempts.
+        """
+        out = StringIO()
+        self.queue_emails(1)
+
+        call_command('send_queued_emails', '--max_attempts=2', stdout=out)
+
+        email = OutgoingEmail.objects.get()
+
+        self.assertIn('Sent 0 emails, 1 retried, 0 failed', out.getvalue())
+        self.assertEqual(email.status, 'P')
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, "SMTPException: Connection refused")
+        self.assertGreater(email.next_attempt, timezone.now())
+
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+        call_command('send_queued_emails', '--max_attempts=2', stdout=out)
+
+        email.refresh_from_db()
+
+        self.assertIn('Sent 0 emails, 0 retried, 1 failed', out.getvalue())
+        self.assertIn('Outbox: 0 pending, 1 failed', out.getvalue())
+        self.assertEqual(email.status, 'F')
+        self.assertEqual(email.attempts, 2)
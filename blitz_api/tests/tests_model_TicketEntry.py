@@ -0,0 +1,97 @@
+from django.db import transaction
+from django.test import TestCase
+
+from ..exceptions import InsufficientTicketsError
+from ..factories import UserFactory
+from ..models import TicketEntry, User
+from ..services import update_tickets
+
+
+class TicketEntryTests(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.user_2 = UserFactory()
+
+    def test_update_tickets(self):
+        """
+        Ensure an entry is added to the ledger of each user and that all
+        balances are updated at once.
+        """
+        with self.assertNumQueries(2):
+            update_tickets({self.user.id: 3, self.user_2.id: -1}, 'P')
+
+        self.user.refresh_from_db()
+        self.user_2.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 4)
+        self.assertEqual(self.user_2.tickets, 0)
+        self.assertEqual(
+            list(
+                TicketEntry.objects.order_by('user_id').values_list(
+                    'user_id', 'amount', 'reason',
+                )
+            ),
+            [(self.user.id, 3, 'P'), (self.user_2.id, -1, 'P')],
+        )
+
+    def test_update_tickets_empty(self):
+        """
+        Ensure nothing is recorded when no tickets change hands.
+        """
+        with self.assertNumQueries(0):
+            update_tickets({self.user.id: 0}, 'R')
+
+        self.assertFalse(TicketEntry.objects.exists())
+
+    def test_update_tickets_balance(self):
+        """
+        Ensure users without any tickets are credited.
+        """
+        self.user.tickets = None
+        self.user.save()
+
+        update_tickets({self.user.id: 2}, 'C')
+
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 2)
+
+    def test_update_tickets_insufficient_balance(self):
+        """
+        Ensure a debit larger than the balance of a user is rejected and that
+        nothing is recorded.
+        """
+        with self.assertRaises(InsufficientTicketsError):
+            with transaction.atomic():
+                update_tickets({self.user.id: 2, self.user_2.id: -5}, 'R')
+
+        self.user.refresh_from_db()
+        self.user_2.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 1)
+        self.assertEqual(self.user_2.tickets, 1)
+        self.assertFalse(TicketEntry.objects.exists())
+
+    def test_update_tickets_unknown_user(self):
+        """
+        Ensure tickets can't be credited to a user that doesn't exist and
+        that nothing is recorded.
+        """
+        with self.assertRaises(User.DoesNotExist):
+            with transaction.atomic():
+                update_tickets({self.user.id: 2, 0: 3}, 'R')
+
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 1)
+        self.assertFalse(TicketEntry.objects.exists())
+
+    def test_str(self):
+        entry = TicketEntry.objects.create(
+            user=self.user,
+            amount=2,
+            reason='P',
+        )
+
+        self.assertEqual(str(entry), '{0}: 2'.format(self.user))
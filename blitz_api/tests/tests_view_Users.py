@@ -1,15 +1,20 @@
+import csv
 import json
 
 from datetime import timedelta
+from io import BytesIO, StringIO
 from unittest import mock
 
+from openpyxl import load_workbook
+
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.db import connection
 from django.urls import reverse
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from ..factories import UserFactory, AdminFactory
 from ..models import (ActionToken, Organization, Domain,
@@ -761,3 +766,68 @@ class UsersTests(APITestCase):
         self.assertEqual(json.loads(response.content), content)
 
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_stream_csv(self):
+        """
+        Ensure admins can export all users at once as a streamed CSV file,
+        fetched by chunks with the same number of queries for each chunk.
+        """
+        for i in range(3):
+            UserFactory()
+        self.client.force_authenticate(user=self.admin)
+
+        with mock.patch('blitz_api.services.EXPORT_CHUNK_SIZE', 2):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(
+                    reverse('user-export') + '?stream=csv',
+                )
+                content = b''.join(response.streaming_content)
+
+        rows = list(csv.reader(StringIO(content.decode())))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('.csv"', response['Content-Disposition'])
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual(
+            [int(row[0]) for row in rows[1:]],
+            list(User.objects.order_by('pk').values_list('pk', flat=True)),
+        )
+        # 5 users in 3 chunks, plus the empty chunk ending the export
+        chunk_queries = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('SELECT "blitz_api_user"."id"')
+        ]
+        self.assertEqual(len(chunk_queries), 4)
+
+    def test_export_stream_xlsx(self):
+        """
+        Ensure admins can export all users at once as an XLSX file.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get(reverse('user-export') + '?stream=xlsx')
+
+        worksheet = load_workbook(
+            BytesIO(b''.join(response.streaming_content))
+        ).active
+        rows = list(worksheet.values)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('.xlsx"', response['Content-Disposition'])
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual(len(rows), 3)
+
+    def test_export_stream_invalid_format(self):
+        """
+        Ensure we can't stream an export in an unknown format.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get(reverse('user-export') + '?stream=pdf')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            json.loads(response.content),
+            {'stream': ['Select a valid export format: csv, xlsx.']},
+        )
@@ -0,0 +1,179 @@
+import csv
+import json
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+
+from ..factories import AdminFactory, UserFactory
+from ..models import ExportJob
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ExportJobTests(APITestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ExportJobTests, cls).setUpClass()
+        cls.client = APIClient()
+        cls.user = UserFactory()
+        cls.admin = AdminFactory()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        super(ExportJobTests, cls).tearDownClass()
+
+    def test_create(self):
+        """
+        Ensure admins can create an export job, which is left pending.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            'export': 'user',
+            'file_format': 'csv',
+        }
+
+        response = self.client.post(
+            reverse('exportjob-list'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+
+        content = json.loads(response.content)
+        job = ExportJob.objects.get()
+
+        self.assertEqual(content['status'], 'P')
+        self.assertEqual(content['file'], None)
+        self.assertEqual(job.user, self.admin)
+
+    def test_create_without_permission(self):
+        """
+        Ensure users can't create export jobs.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.post(
+            reverse('exportjob-list'),
+            {'export': 'user'},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_create_invalid_export(self):
+        """
+        Ensure we can't create a job for an unknown export.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.post(
+            reverse('exportjob-list'),
+            {'export': 'passwords'},
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_retrieve_completed(self):
+        """
+        Ensure the file of a job can be downloaded once it was built by the
+        worker.
+        """
+        job = ExportJob.objects.create(
+            user=self.admin,
+            export='user',
+            file_format='csv',
+        )
+        xlsx_job = ExportJob.objects.create(
+            user=self.admin,
+            export='order',
+            file_format='xlsx',
+        )
+        out = StringIO()
+
+        call_command('run_export_jobs', stdout=out)
+
+        self.assertIn('Completed 2 export jobs, 0 failed', out.getvalue())
+
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get(
+            reverse('exportjob-detail', kwargs={'pk': job.pk}),
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        content = json.loads(response.content)
+        job.refresh_from_db()
+
+        self.assertEqual(content['status'], 'C')
+        self.assertTrue(content['completed_at'])
+        self.assertTrue(content['file'].endswith('.csv'))
+        with job.file.open('rb') as export_file:
+            rows = list(csv.reader(StringIO(export_file.read().decode())))
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual(len(rows), 3)
+        xlsx_job.refresh_from_db()
+        self.assertTrue(xlsx_job.file.name.endswith('.xlsx'))
+
+        # Jobs are only run once
+        call_command('run_export_jobs', stdout=out)
+
+        self.assertIn('Completed 0 export jobs, 0 failed', out.getvalue())
+
+    def test_run_failed(self):
+        """
+        Ensure a job that can't be built is marked as failed with its error.
+        """
+        job = ExportJob.objects.create(user=self.admin, export='user')
+        out = StringIO()
+
+        with mock.patch(
+                'blitz_api.services.write_xlsx',
+                side_effect=OSError("No space left on device")):
+            call_command('run_export_jobs', stdout=out)
+
+        job.refresh_from_db()
+
+        self.assertIn('Completed 0 export jobs, 1 failed', out.getvalue())
+        self.assertEqual(job.status, 'F')
+        self.assertEqual(job.error, 'OSError: No space left on device')
+        self.assertFalse(job.file)
+
+    def test_run_failed_resource(self):
+        """
+        Ensure a job whose resource can't be loaded is marked as failed
+        instead of staying running.
+        """
+        job = ExportJob.objects.create(user=self.admin, export='user')
+        out = StringIO()
+
+        with mock.patch(
+                'blitz_api.services.import_string',
+                side_effect=ImportError("No module named 'resources'")):
+            call_command('run_export_jobs', stdout=out)
+
+        job.refresh_from_db()
+
+        self.assertIn('Completed 0 export jobs, 1 failed', out.getvalue())
+        self.assertEqual(job.status, 'F')
+        self.assertEqual(
+            job.error,
+            "ImportError: No module named 'resources'",
+        )
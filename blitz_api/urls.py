@@ -51,6 +51,7 @@ router.register('domains', views.DomainViewSet)
 router.register('organizations', views.OrganizationViewSet)
 router.register('academic_levels', views.AcademicLevelViewSet)
 router.register('academic_fields', views.AcademicFieldViewSet)
+router.register('export_jobs', views.ExportJobViewSet)
 router.register(
     'authentication',
     views.TemporaryTokenDestroy,
@@ -19,11 +19,11 @@ from rest_framework.exceptions import PermissionDenied
 
 from .models import (
     TemporaryToken, ActionToken, Domain, Organization, AcademicLevel,
-    AcademicField,
+    AcademicField, ExportJob,
 )
 from .resources import (AcademicFieldResource, AcademicLevelResource,
                         OrganizationResource, UserResource)
-from .services import ExportPagination
+from .services import ExportPagination, stream_export
 from . import serializers, permissions, services
 
 User = get_user_model()
@@ -78,6 +78,9 @@ class UserViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(request, UserResource(), queryset, 'User')
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -482,6 +485,14 @@ class OrganizationViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                OrganizationResource(),
+                queryset,
+                'Organization',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -572,6 +583,14 @@ class AcademicLevelViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                AcademicLevelResource(),
+                queryset,
+                'AcademicLevel',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -609,6 +628,14 @@ class AcademicFieldViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                AcademicFieldResource(),
+                queryset,
+                'AcademicField',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -622,3 +649,29 @@ class AcademicFieldViewSet(viewsets.ModelViewSet):
             '".xls'
         ])
         return response
+
+
+class ExportJobViewSet(mixins.CreateModelMixin,
+                       mixins.RetrieveModelMixin,
+                       mixins.ListModelMixin,
+                       viewsets.GenericViewSet):
+    """
+    retrieve:
+    Return the given export job. Its file can be downloaded once its status
+    is "C" (completed).
+
+    list:
+    Return a list of all the existing export jobs.
+
+    create:
+    Create a new export job. The file is built in the background by the
+    "run_export_jobs" command.
+    """
+    serializer_class = serializers.ExportJobSerializer
+    queryset = ExportJob.objects.all()
+    permission_classes = (IsAdminUser,)
+    filter_fields = ('export', 'status',)
+    ordering = ('-created_at',)
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
@@ -5,8 +5,8 @@ from modeltranslation.admin import TranslationAdmin
 from safedelete.admin import SafeDeleteAdmin, highlight_deleted
 from simple_history.admin import SimpleHistoryAdmin
 
-from .models import (Picture, Reservation, Retirement, WaitQueue,
-                     WaitQueueNotification, )
+from .models import (Picture, RefundJob, RefundJobItem, Reservation,
+                     Retirement, WaitQueue, WaitQueueNotification, )
 from .resources import (ReservationResource, RetirementResource,
                         WaitQueueResource)
 
@@ -95,8 +95,37 @@ class WaitQueueNotificationAdmin(SimpleHistoryAdmin):
     )
 
 
+class RefundJobItemAdminInline(admin.TabularInline):
+    model = RefundJobItem
+    readonly_fields = (
+        'reservation',
+        'status',
+        'reference',
+        'refund',
+        'error',
+    )
+    can_delete = False
+    extra = 0
+
+
+class RefundJobAdmin(admin.ModelAdmin):
+    inlines = (RefundJobItemAdminInline, )
+    list_display = (
+        'retirement',
+        'refund_rate',
+        'created_at',
+        'finished_at',
+    )
+    list_filter = (
+        ('retirement', admin.RelatedOnlyFieldListFilter),
+        'created_at',
+        'finished_at',
+    )
+
+
 admin.site.register(Retirement, RetirementAdmin)
 admin.site.register(Picture, PictureAdmin)
 admin.site.register(Reservation, ReservationAdmin)
 admin.site.register(WaitQueue, WaitQueueAdmin)
 admin.site.register(WaitQueueNotification, WaitQueueNotificationAdmin)
+admin.site.register(RefundJob, RefundJobAdmin)
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from retirement.models import RefundJob, Retirement
+from retirement.services import create_refund_job, run_refund_job
+
+
+class Command(BaseCommand):
+    help = 'Refund the active reservations of a retirement. An unfinished ' \
+           'refund job of the retirement is resumed instead of starting a ' \
+           'new one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('retirement', type=int)
+        parser.add_argument(
+            '--refund_rate',
+            default=100,
+            type=int,
+            help='Percentage of the price refunded',
+        )
+        parser.add_argument(
+            '--details',
+            default='Retirement canceled',
+            help='Reason of the refunds',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Maximum number of simultaneous calls to the payment API',
+        )
+        parser.add_argument(
+            '--retry_failed',
+            action='store_true',
+            dest='retry_failed',
+            help='Try again the refunds that failed in the resumed job',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            retirement = Retirement.objects.get(pk=options['retirement'])
+        except Retirement.DoesNotExist:
+            raise CommandError(
+                'Retirement "{0}" does not exist'.format(options['retirement'])
+            )
+
+        job = RefundJob.objects.filter(
+            retirement=retirement,
+            finished_at__isnull=True,
+        ).first()
+        if job is None:
+            job = create_refund_job(
+                retirement,
+                options['refund_rate'],
+                options['details'],
+            )
+        elif options['retry_failed']:
+            job.items.filter(status='F').update(status='P')
+
+        summary = run_refund_job(job, concurrency=options['concurrency'])
+
+        self.stdout.write(self.style.SUCCESS(
+            'Refunded {refunded} reservations, {failed} failed, {pending} '
+            'pending ({amount}$)'.format(**summary)
+        ))
@@ -0,0 +1,50 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0028_coupon_code_unique'),
+        ('retirement', '0009_reservation_orderline_allow_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefundJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('refund_rate', models.PositiveIntegerField(verbose_name='Refund rate')),
+                ('details', models.TextField(blank=True, max_length=1000, null=True, verbose_name='Details')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finish date')),
+                ('retirement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refund_jobs', to='retirement.Retirement', verbose_name='Retirement')),
+            ],
+            options={
+                'verbose_name': 'Refund job',
+                'verbose_name_plural': 'Refund jobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='RefundJobItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('R', 'Refunded'), ('F', 'Failed')], default='P', max_length=1, verbose_name='Status')),
+                ('reference', models.CharField(max_length=253, unique=True, verbose_name='Reference')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='retirement.RefundJob', verbose_name='Refund job')),
+                ('refund', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='refund_job_items', to='store.Refund', verbose_name='Refund')),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refund_job_items', to='retirement.Reservation', verbose_name='Reservation')),
+            ],
+            options={
+                'verbose_name': 'Refund job item',
+                'verbose_name_plural': 'Refund job items',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='refundjobitem',
+            unique_together={('job', 'reservation')},
+        ),
+    ]
@@ -7,7 +7,7 @@ from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from safedelete.models import SafeDeleteModel
 from simple_history.models import HistoricalRecords
-from store.models import Membership, OrderLine
+from store.models import Membership, OrderLine, Refund
 
 User = get_user_model()
 
@@ -324,3 +324,106 @@ class WaitQueueNotification(models.Model):
         return ', '.join(
             [str(self.retirement), str(self.user)]
         )
+
+
+class RefundJob(models.Model):
+    """
+    Refunds of many reservations of a retirement, processed in bulk. Progress
+    is kept for each reservation so that an interrupted job can be resumed.
+    """
+
+    class Meta:
+        verbose_name = _("Refund job")
+        verbose_name_plural = _("Refund jobs")
+
+    retirement = models.ForeignKey(
+        Retirement,
+        on_delete=models.CASCADE,
+        verbose_name=_("Retirement"),
+        related_name='refund_jobs',
+    )
+
+    refund_rate = models.PositiveIntegerField(
+        verbose_name=_("Refund rate"),
+    )
+
+    details = models.TextField(
+        verbose_name=_("Details"),
+        max_length=1000,
+        null=True,
+        blank=True,
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    finished_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        verbose_name=_("Finish date"),
+    )
+
+    def __str__(self):
+        return ', '.join([str(self.retirement), str(self.created_at)])
+
+
+class RefundJobItem(models.Model):
+    """
+    Refund of a single reservation in a refund job.
+    """
+
+    class Meta:
+        verbose_name = _("Refund job item")
+        verbose_name_plural = _("Refund job items")
+        unique_together = ('job', 'reservation')
+
+    STATUS = (
+        ('P', _("Pending")),
+        ('R', _("Refunded")),
+        ('F', _("Failed")),
+    )
+
+    job = models.ForeignKey(
+        RefundJob,
+        on_delete=models.CASCADE,
+        verbose_name=_("Refund job"),
+        related_name='items',
+    )
+
+    reservation = models.ForeignKey(
+        Reservation,
+        on_delete=models.CASCADE,
+        verbose_name=_("Reservation"),
+        related_name='refund_job_items',
+    )
+
+    status = models.CharField(
+        max_length=1,
+        choices=STATUS,
+        default='P',
+        verbose_name=_("Status"),
+    )
+
+    # Sent as the merchantRefNum of the refund so that a retried refund is
+    # not issued twice
+    reference = models.CharField(
+        max_length=253,
+        unique=True,
+        verbose_name=_("Reference"),
+    )
+
+    refund = models.ForeignKey(
+        Refund,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_("Refund"),
+        related_name='refund_job_items',
+    )
+
+    error = models.TextField(
+        blank=True,
+        verbose_name=_("Error"),
+    )
+
+    def __str__(self):
+        return ', '.join([str(self.job), str(self.reservation)])
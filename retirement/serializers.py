@@ -9,7 +9,6 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.core.mail import mail_admins
-from django.core.mail import send_mail
 from django.db import transaction
 from django.db.models import F
 from django.template.loader import render_to_string
@@ -21,6 +20,7 @@ from rest_framework.validators import UniqueValidator
 
 from blitz_api.serializers import UserSerializer
 from blitz_api.services import (check_if_translated_field,
+                                queue_mail,
                                 remove_translation_fields)
 from store.exceptions import PaymentAPIError
 from store.models import Order, OrderLine, PaymentProfile, Refund
@@ -876,7 +876,7 @@ class ReservationSerializer(serializers.HyperlinkedModelSerializer):
             plain_msg = render_to_string("invoice.txt", merge_data)
             msg_html = render_to_string("invoice.html", merge_data)
 
-            send_mail(
+            queue_mail(
                 "Confirmation d'achat",
                 plain_msg,
                 settings.DEFAULT_FROM_EMAIL,
@@ -905,7 +905,7 @@ class ReservationSerializer(serializers.HyperlinkedModelSerializer):
             plain_msg = render_to_string("refund.txt", merge_data)
             msg_html = render_to_string("refund.html", merge_data)
 
-            send_mail(
+            queue_mail(
                 "Confirmation de remboursement",
                 plain_msg,
                 settings.DEFAULT_FROM_EMAIL,
@@ -928,7 +928,7 @@ class ReservationSerializer(serializers.HyperlinkedModelSerializer):
             plain_msg = render_to_string("exchange.txt", merge_data)
             msg_html = render_to_string("exchange.html", merge_data)
 
-            send_mail(
+            queue_mail(
                 "Confirmation d'échange",
                 plain_msg,
                 settings.DEFAULT_FROM_EMAIL,
@@ -950,7 +950,7 @@ class ReservationSerializer(serializers.HyperlinkedModelSerializer):
                 merge_data
             )
 
-            send_mail(
+            queue_mail(
                 "Confirmation d'inscription à la retraite",
                 plain_msg,
                 settings.DEFAULT_FROM_EMAIL,
@@ -1,14 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
+import uuid
 
 from django.conf import settings
-from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Count, Q, Sum
 from django.template.loader import render_to_string
 from django.utils import timezone
 
+from blitz_api.services import queue_mail
 from store.exceptions import PaymentAPIError
 from store.models import Refund
-from store.services import (PAYSAFE_EXCEPTION,
-                            refund_amount, )
+from store.services import refund_amount
+
+from .models import RefundJob, RefundJobItem
 
 
 TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
@@ -25,7 +30,7 @@ def notify_reserved_retirement_seat(user, retirement):
     plain_msg = render_to_string("reserved_place.txt", merge_data)
     msg_html = render_to_string("reserved_place.html", merge_data)
 
-    return send_mail(
+    return queue_mail(
         "Place exclusive pour 24h",
         plain_msg,
         settings.DEFAULT_FROM_EMAIL,
@@ -45,7 +50,7 @@ def send_retirement_7_days_email(user, retirement):
     plain_msg = render_to_string("reminder.txt", merge_data)
     msg_html = render_to_string("reminder.html", merge_data)
 
-    return send_mail(
+    return queue_mail(
         "Rappel retraite",
         plain_msg,
         settings.DEFAULT_FROM_EMAIL,
@@ -68,7 +73,7 @@ def send_post_retirement_email(user, retirement):
     plain_msg = render_to_string("throwback.txt", merge_data)
     msg_html = render_to_string("throwback.html", merge_data)
 
-    return send_mail(
+    return queue_mail(
         "Merci pour votre participation",
         plain_msg,
         settings.DEFAULT_FROM_EMAIL,
@@ -77,6 +82,23 @@ def send_post_retirement_email(user, retirement):
     )
 
 
+def get_refund_amount(reservation, refund_rate):
+    """
+    Return the amount in cents, taxes included, to refund for a reservation
+    given the percentage of its price that is refunded. Refunds already
+    issued for the order line are deducted.
+    """
+    refunded_amount = sum(
+        refund.amount for refund in reservation.order_line.refunds.all()
+    )
+
+    amount_to_refund = (
+        reservation.retirement.price - refunded_amount
+    ) * refund_rate
+
+    return amount_to_refund * Decimal(TAX_RATE + 1)
+
+
 def refund_retirement(reservation, refund_rate, refund_reason):
     """
     reservation: Reservation model instance
@@ -88,20 +110,7 @@ def refund_retirement(reservation, refund_rate, refund_reason):
     transaction.
     """
     orderline = reservation.order_line
-    user = orderline.order.user
-    retirement = reservation.retirement
-    previous_refunds = orderline.refunds
-    refunded_amount = Decimal(0)
-
-    if previous_refunds:
-        refunded_amount = sum(
-            previous_refunds.all().values_list('amount', flat=True)
-        )
-
-    amount_to_refund = (retirement.price - refunded_amount) * refund_rate
-
-    tax = round(amount_to_refund * Decimal(TAX_RATE), 2)
-    amount_to_refund *= Decimal(TAX_RATE + 1)
+    amount_to_refund = get_refund_amount(reservation, refund_rate)
 
     refund_response = refund_amount(
         orderline.order.settlement_id,
@@ -118,3 +127,151 @@ def refund_retirement(reservation, refund_rate, refund_reason):
     )
 
     return refund_instance
+
+
+def create_refund_job(retirement, refund_rate, details, reservations=None):
+    """
+    Create a job to refund the active reservations of a retirement, or only
+    the given reservations.
+
+    refund_rate: integer from 0 to 100 defining percentage of amount refunded
+    details:     reason of the refunds
+    """
+    if reservations is None:
+        reservations = retirement.reservations.filter(
+            is_active=True,
+            refundable=True,
+            order_line__isnull=False,
+        )
+    # Reservations already refunded by a job are not refunded again. Earlier
+    # partial refunds of their order line (ie: exchanges) are deducted from
+    # the amount refunded by "get_refund_amount".
+    reservations = reservations.exclude(refund_job_items__status='R')
+
+    with transaction.atomic():
+        job = RefundJob.objects.create(
+            retirement=retirement,
+            refund_rate=refund_rate,
+            details=details,
+        )
+        RefundJobItem.objects.bulk_create([
+            RefundJobItem(
+                job=job,
+                reservation_id=reservation_id,
+                reference='refund-' + str(uuid.uuid4()),
+            )
+            for reservation_id in reservations.values_list('pk', flat=True)
+        ])
+
+    return job
+
+
+def run_refund_job(job, concurrency=None):
+    """
+    Refund the pending reservations of a job and return its summary.
+
+    Calls to the payment API are made by a pool of at most `concurrency`
+    threads (REFUND_CONCURRENCY by default) while their results are saved
+    one by one, as they come. If the job is interrupted, running it again
+    only processes the reservations that are still pending. Each refund is
+    sent with the reference of its item so that a refund retried after a
+    crash is not issued twice: the payment API then rejects it as a
+    duplicate and the reservation is considered refunded.
+
+    Refunded reservations are canceled along with the creation of their
+    refund.
+    """
+    if concurrency is None:
+        concurrency = settings.LOCAL_SETTINGS['REFUND_CONCURRENCY']
+
+    items = job.items.filter(status='P').select_related(
+        'reservation__retirement',
+        'reservation__order_line__order',
+    ).prefetch_related(
+        'reservation__order_line__refunds',
+    )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = dict()
+        for item in items:
+            amount = get_refund_amount(item.reservation, job.refund_rate)
+            if int(amount) <= 0:
+                # Nothing left to refund
+                with transaction.atomic():
+                    cancel_refunded_reservation(item.reservation)
+                    item.status = 'R'
+                    item.save()
+                continue
+            future = executor.submit(
+                refund_amount,
+                item.reservation.order_line.order.settlement_id,
+                int(amount),
+                item.reference,
+            )
+            futures[future] = (item, amount)
+
+        for future in as_completed(futures):
+            item, amount = futures[future]
+            try:
+                refund_id = future.result().json()['id']
+            except PaymentAPIError as err:
+                if err.code != '5031':
+                    item.status = 'F'
+                    item.error = str(err)
+                    item.save()
+                    continue
+                # The refund of the item was issued by a previous run that
+                # was interrupted before saving it.
+                refund_id = None
+
+            with transaction.atomic():
+                item.refund = Refund.objects.create(
+                    orderline=item.reservation.order_line,
+                    refund_date=timezone.now(),
+                    amount=amount/100,
+                    details=job.details,
+                    refund_id=refund_id,
+                )
+                cancel_refunded_reservation(item.reservation)
+                item.status = 'R'
+                item.error = ''
+                item.save()
+
+    # Jobs with failed refunds stay open so that they can be retried
+    if not job.items.exclude(status='R').exists():
+        job.finished_at = timezone.now()
+        job.save()
+
+    return get_refund_job_summary(job)
+
+
+def cancel_refunded_reservation(reservation):
+    """
+    Cancel a reservation refunded because its retirement was deleted.
+    """
+    reservation.is_active = False
+    reservation.cancelation_reason = 'RD'
+    reservation.cancelation_action = 'R'
+    reservation.cancelation_date = timezone.now()
+    reservation.save(update_fields=[
+        'is_active',
+        'cancelation_reason',
+        'cancelation_action',
+        'cancelation_date',
+    ])
+
+
+def get_refund_job_summary(job):
+    """
+    Return the number of refunded, failed and pending reservations of a job
+    and the total amount refunded.
+    """
+    summary = job.items.aggregate(
+        refunded=Count('pk', filter=Q(status='R')),
+        failed=Count('pk', filter=Q(status='F')),
+        pending=Count('pk', filter=Q(status='P')),
+        amount=Sum('refund__amount'),
+    )
+    summary['amount'] = summary['amount'] or Decimal(0)
+
+    return summary
@@ -0,0 +1,285 @@
+from datetime import datetime
+from io import StringIO
+
+import pytz
+import responses
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from blitz_api.factories import UserFactory
+from store.models import Order, OrderLine, Refund
+from store.tests.paysafe_sample_responses import (
+    SAMPLE_DUPLICATE_TRANSACTION, SAMPLE_REFUND_RESPONSE, UNKNOWN_EXCEPTION,
+)
+
+from ..models import RefundJob, Reservation, Retirement
+
+LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
+REFUND_URL = "http://example.com/cardpayments/v1/accounts/0123456789/" \
+             "settlements/{0}/refunds"
+
+
+@override_settings(
+    PAYSAFE={
+        'ACCOUNT_NUMBER': "0123456789",
+        'USER': "user",
+        'PASSWORD': "password",
+        'BASE_URL': "http://example.com/",
+        'VAULT_URL': "customervault/v1/",
+        'CARD_URL': "cardpayments/v1/"
+    }
+)
+class RefundRetirementTest(TestCase):
+
+    def setUp(self):
+        self.retirement = Retirement.objects.create(
+            name="mega_retirement",
+            details="This is a description of the mega retirement.",
+            seats=400,
+            address_line1="123 random street",
+            postal_code="123 456",
+            state_province="Random state",
+            country="Random country",
+            price=100,
+            start_time=LOCAL_TIMEZONE.localize(datetime(2130, 1, 15, 8)),
+            end_time=LOCAL_TIMEZONE.localize(datetime(2130, 1, 17, 12)),
+            min_day_refund=7,
+            min_day_exchange=7,
+            refund_rate=50,
+            is_active=True,
+            accessibility=True,
+        )
+        self.reservations = [
+            self.create_reservation(settlement_id)
+            for settlement_id in ('1', '2')
+        ]
+
+    def create_reservation(self, settlement_id):
+        user = UserFactory()
+        order = Order.objects.create(
+            user=user,
+            transaction_date=timezone.now(),
+            authorization_id=1,
+            settlement_id=settlement_id,
+        )
+        order_line = OrderLine.objects.create(
+            order=order,
+            quantity=1,
+            content_type=ContentType.objects.get_for_model(Retirement),
+            object_id=self.retirement.id,
+            cost=self.retirement.price,
+        )
+        return Reservation.objects.create(
+            user=user,
+            retirement=self.retirement,
+            order_line=order_line,
+            is_active=True,
+        )
+
+    @responses.activate
+    def test_refund_retirement(self):
+        """
+        Ensure every active reservation of the retirement is refunded.
+        """
+        for settlement_id in ('1', '2'):
+            responses.add(
+                responses.POST,
+                REFUND_URL.format(settlement_id),
+                json=SAMPLE_REFUND_RESPONSE,
+                status=200
+            )
+        out = StringIO()
+
+        call_command(
+            'refund_retirement',
+            str(self.retirement.id),
+            '--concurrency=2',
+            stdout=out,
+        )
+
+        job = RefundJob.objects.get()
+
+        self.assertIn(
+            'Refunded 2 reservations, 0 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertTrue(job.finished_at)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            set(job.items.values_list('refund__orderline', flat=True)),
+            {reservation.order_line_id for reservation in self.reservations},
+        )
+        for reservation in self.reservations:
+            reservation.refresh_from_db()
+            self.assertFalse(reservation.is_active)
+            self.assertEqual(reservation.cancelation_reason, 'RD')
+            self.assertEqual(reservation.cancelation_action, 'R')
+            self.assertTrue(reservation.cancelation_date)
+
+    @responses.activate
+    def test_refund_retirement_twice(self):
+        """
+        Ensure reservations refunded by a finished job are not refunded
+        again by a new job.
+        """
+        for settlement_id in ('1', '2'):
+            responses.add(
+                responses.POST,
+                REFUND_URL.format(settlement_id),
+                json=SAMPLE_REFUND_RESPONSE,
+                status=200
+            )
+        out = StringIO()
+
+        call_command('refund_retirement', str(self.retirement.id), stdout=out)
+        call_command(
+            'refund_retirement',
+            str(self.retirement.id),
+            '--refund_rate=50',
+            stdout=out,
+        )
+
+        self.assertIn(
+            'Refunded 0 reservations, 0 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(Refund.objects.count(), 2)
+
+    @responses.activate
+    def test_refund_retirement_partially_refunded(self):
+        """
+        Ensure reservations partially refunded before the job (ie: after an
+        exchange) are refunded what is left of their price.
+        """
+        for settlement_id in ('1', '2'):
+            responses.add(
+                responses.POST,
+                REFUND_URL.format(settlement_id),
+                json=SAMPLE_REFUND_RESPONSE,
+                status=200
+            )
+        Refund.objects.create(
+            orderline=self.reservations[0].order_line,
+            refund_date=timezone.now(),
+            amount=40,
+            details="Exchange",
+            refund_id=1,
+        )
+        out = StringIO()
+
+        call_command('refund_retirement', str(self.retirement.id), stdout=out)
+
+        job = RefundJob.objects.get()
+        partial_refund = job.items.get(reservation=self.reservations[0]).refund
+        full_refund = job.items.get(reservation=self.reservations[1]).refund
+
+        self.assertIn(
+            'Refunded 2 reservations, 0 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            partial_refund.amount,
+            round(full_refund.amount * 60 / 100, 2),
+        )
+
+    @responses.activate
+    def test_refund_retirement_resume(self):
+        """
+        Ensure a job is resumed where it stopped and that refunds that
+        succeeded are not issued again.
+        """
+        responses.add(
+            responses.POST,
+            REFUND_URL.format('1'),
+            json=SAMPLE_REFUND_RESPONSE,
+            status=200
+        )
+        responses.add(
+            responses.POST,
+            REFUND_URL.format('2'),
+            json=UNKNOWN_EXCEPTION,
+            status=400
+        )
+        out = StringIO()
+
+        call_command('refund_retirement', str(self.retirement.id), stdout=out)
+
+        job = RefundJob.objects.get()
+        failed_item = job.items.get(status='F')
+
+        self.assertIn(
+            'Refunded 1 reservations, 1 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertFalse(job.finished_at)
+        self.assertEqual(failed_item.reservation, self.reservations[1])
+        self.assertTrue(failed_item.error)
+
+        responses.replace(
+            responses.POST,
+            REFUND_URL.format('2'),
+            json=SAMPLE_REFUND_RESPONSE,
+            status=200
+        )
+
+        call_command(
+            'refund_retirement',
+            str(self.retirement.id),
+            '--retry_failed',
+            stdout=out,
+        )
+
+        job.refresh_from_db()
+
+        self.assertIn(
+            'Refunded 2 reservations, 0 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertTrue(job.finished_at)
+        self.assertEqual(RefundJob.objects.count(), 1)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(Refund.objects.count(), 2)
+        # The retried refund was sent with the reference of its item
+        self.assertIn(
+            failed_item.reference.encode(),
+            responses.calls[2].request.body,
+        )
+
+    @responses.activate
+    def test_refund_retirement_already_refunded(self):
+        """
+        Ensure a refund rejected as a duplicate of a refund issued by an
+        interrupted run is considered refunded.
+        """
+        for settlement_id in ('1', '2'):
+            responses.add(
+                responses.POST,
+                REFUND_URL.format(settlement_id),
+                json=SAMPLE_DUPLICATE_TRANSACTION,
+                status=400
+            )
+        out = StringIO()
+
+        call_command('refund_retirement', str(self.retirement.id), stdout=out)
+
+        job = RefundJob.objects.get()
+
+        self.assertIn(
+            'Refunded 2 reservations, 0 failed, 0 pending',
+            out.getvalue(),
+        )
+        self.assertTrue(job.finished_at)
+        self.assertEqual(Refund.objects.count(), 2)
+        self.assertFalse(
+            Reservation.objects.filter(
+                retirement=self.retirement,
+                is_active=True,
+            ).exists()
+        )
@@ -47,6 +47,8 @@ TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
         'CARD_URL': "cardpayments/v1/"
     }
 )
+# Test transactions are never committed: commit hooks are run right away
+@mock.patch('django.db.transaction.on_commit', new=lambda func: func())
 class ReservationTests(APITestCase):
 
     @classmethod
@@ -10,11 +10,11 @@ import pytz
 import rest_framework
 
 from blitz_api.exceptions import MailServiceError
-from blitz_api.services import send_mail, ExportPagination
+from blitz_api.services import (send_mail, queue_mail, ExportPagination,
+                                stream_export, )
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.mail import mail_admins
-from django.core.mail import send_mail as django_send_mail
 from django.db import transaction
 from django.db.models import F
 from django.http import HttpResponse
@@ -29,7 +29,8 @@ from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from store.exceptions import PaymentAPIError
 from store.models import Refund
-from store.services import refund_amount, PAYSAFE_EXCEPTION
+from store.services import (refund_amount, idempotent_request,
+                            PAYSAFE_EXCEPTION, )
 
 from . import permissions, serializers
 from .models import (Picture, Reservation, Retirement, WaitQueue,
@@ -90,6 +91,14 @@ class RetirementViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                RetirementResource(),
+                queryset,
+                'Retirement',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -190,6 +199,7 @@ class ReservationViewSet(viewsets.ModelViewSet):
 
     partial_update:
     Modify a reservation instance (ie: mark user as present).
+    Requests sent with an "Idempotency-Key" header are processed only once.
     """
     serializer_class = serializers.ReservationSerializer
     queryset = Reservation.objects.all()
@@ -210,6 +220,14 @@ class ReservationViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                ReservationResource(),
+                queryset,
+                'RetirementReservation',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -254,6 +272,15 @@ class ReservationViewSet(viewsets.ModelViewSet):
             return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
         return super(ReservationViewSet, self).update(request, *args, **kwargs)
 
+    @idempotent_request
+    def partial_update(self, request, *args, **kwargs):
+        # Exchanges of retirement charge or refund the user
+        return super(ReservationViewSet, self).partial_update(
+            request,
+            *args,
+            **kwargs
+        )
+
     def destroy(self, request, *args, **kwargs):
         """
         A user can cancel his reservation by "deleting" it. It will return an
@@ -399,41 +426,43 @@ class ReservationViewSet(viewsets.ModelViewSet):
 
                 retirement.save()
 
-        # Send an email if a refund has been issued
-        if reservation_active and instance.cancelation_action == 'R':
-            # Here the price takes the applied coupon into account, if
-            # applicable.
-            old_retirement = {
-                'price': (amount * retirement.refund_rate) / 100,
-                'name': "{0}: {1}".format(
-                    _("Retirement"),
-                    retirement.name
+            # Send an email if a refund has been issued
+            if reservation_active and instance.cancelation_action == 'R':
+                # Here the price takes the applied coupon into account, if
+                # applicable.
+                old_retirement = {
+                    'price': (amount * retirement.refund_rate) / 100,
+                    'name': "{0}: {1}".format(
+                        _("Retirement"),
+                        retirement.name
+                    )
+                }
+
+                # Send order confirmation email
+                merge_data = {
+                    'DATETIME': timezone.localtime().strftime("%x %X"),
+                    'ORDER_ID': order.id,
+                    'CUSTOMER_NAME': user.first_name + " " + user.last_name,
+                    'CUSTOMER_EMAIL': user.email,
+                    'CUSTOMER_NUMBER': user.id,
+                    'TYPE': "Remboursement",
+                    'OLD_RETIREMENT': old_retirement,
+                    'COST': round(total_amount/100, 2),
+                    'TAX': round(Decimal(amount_tax/100), 2),
+                }
+
+                plain_msg = render_to_string("refund.txt", merge_data)
+                msg_html = render_to_string("refund.html", merge_data)
+
+                queue_mail(
+                    "Confirmation de remboursement",
+                    plain_msg,
+                    settings.DEFAULT_FROM_EMAIL,
+                    [user.email],
+                    html_message=msg_html,
+                    on_commit=True,
                 )
-            }
 
-            # Send order confirmation email
-            merge_data = {
-                'DATETIME': timezone.localtime().strftime("%x %X"),
-                'ORDER_ID': order.id,
-                'CUSTOMER_NAME': user.first_name + " " + user.last_name,
-                'CUSTOMER_EMAIL': user.email,
-                'CUSTOMER_NUMBER': user.id,
-                'TYPE': "Remboursement",
-                'OLD_RETIREMENT': old_retirement,
-                'COST': round(total_amount/100, 2),
-                'TAX': round(Decimal(amount_tax/100), 2),
-            }
-
-            plain_msg = render_to_string("refund.txt", merge_data)
-            msg_html = render_to_string("refund.html", merge_data)
-
-            django_send_mail(
-                "Confirmation de remboursement",
-                plain_msg,
-                settings.DEFAULT_FROM_EMAIL,
-                [user.email],
-                html_message=msg_html,
-            )
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -477,6 +506,14 @@ class WaitQueueViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                WaitQueueResource(),
+                queryset,
+                'WaitQueue',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -631,6 +668,14 @@ class WaitQueueNotificationViewSet(mixins.ListModelMixin,
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                WaitQueueNotificationResource(),
+                queryset,
+                'WaitQueueNotification',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -6,7 +6,7 @@ from safedelete.admin import SafeDeleteAdmin, highlight_deleted
 from simple_history.admin import SimpleHistoryAdmin
 
 from .models import (Membership, Order, OrderLine, Package, PaymentProfile,
-                     CustomPayment, Coupon, CouponUser, Refund, )
+                     PaymentCard, CustomPayment, Coupon, CouponUser, Refund, )
 from .resources import (MembershipResource, OrderResource, OrderLineResource,
                         PackageResource, CustomPaymentResource, CouponResource,
                         CouponUserResource, RefundResource, )
@@ -84,10 +84,12 @@ class OrderAdmin(SimpleHistoryAdmin, ExportActionModelAdmin):
         'settlement_id',
         'transaction_date',
         'user',
+        'status',
     )
     list_filter = (
         ('user', admin.RelatedOnlyFieldListFilter),
         'transaction_date',
+        'status',
     )
     search_fields = (
         'user__email',
@@ -124,12 +126,32 @@ class OrderLineAdmin(SimpleHistoryAdmin, ExportActionModelAdmin):
     owner.admin_order_field = 'order__user'
 
 
+class PaymentCardInline(admin.TabularInline):
+    model = PaymentCard
+    can_delete = False
+    verbose_name_plural = _('Payment cards')
+    fk_name = 'payment_profile'
+    extra = 0
+    max_num = 0
+    readonly_fields = (
+        'external_api_id',
+        'card_type',
+        'last_digits',
+        'card_expiry_month',
+        'card_expiry_year',
+        'status',
+    )
+    fields = readonly_fields
+
+
 class PaymentProfileAdmin(SimpleHistoryAdmin):
+    inlines = (PaymentCardInline, )
     list_display = (
         'name',
         'owner',
         'external_api_id',
         'external_api_url',
+        'cards_synced_at',
     )
     list_filter = (
         ('owner', admin.RelatedOnlyFieldListFilter),
@@ -158,7 +180,9 @@ class CouponAdmin(SimpleHistoryAdmin, ExportActionModelAdmin):
         'percent_off',
         'owner',
         'details',
+        'total_uses',
     )
+    readonly_fields = ('total_uses', )
     list_filter = (
         ('owner', admin.RelatedOnlyFieldListFilter),
     )
@@ -168,6 +192,10 @@ class CouponAdmin(SimpleHistoryAdmin, ExportActionModelAdmin):
         'owner__username',
     )
 
+    def save_related(self, request, form, formsets, change):
+        super(CouponAdmin, self).save_related(request, form, formsets, change)
+        form.instance.update_total_uses()
+
 
 class CouponUserAdmin(SimpleHistoryAdmin, SafeDeleteAdmin,
                       ExportActionModelAdmin, ):
@@ -188,6 +216,16 @@ class CouponUserAdmin(SimpleHistoryAdmin, SafeDeleteAdmin,
         'user__username',
     ) + SafeDeleteAdmin.list_filter
 
+    def save_model(self, request, obj, form, change):
+        super(CouponUserAdmin, self).save_model(request, obj, form, change)
+        obj.coupon.update_total_uses()
+        if 'coupon' in form.changed_data and form.initial.get('coupon'):
+            Coupon.objects.get(pk=form.initial['coupon']).update_total_uses()
+
+    def delete_model(self, request, obj):
+        super(CouponUserAdmin, self).delete_model(request, obj)
+        obj.coupon.update_total_uses()
+
 
 admin.site.register(Membership, MembershipAdmin)
 admin.site.register(Package, PackageAdmin)
@@ -1,5 +1,17 @@
 class PaymentAPIError(Exception):
     """
     Raised when a payment related action fails.
+
+    code: error code returned by the payment API, if any
+    """
+    def __init__(self, *args, code=None):
+        super(PaymentAPIError, self).__init__(*args)
+        self.code = code
+
+
+class GatewayUnavailableError(PaymentAPIError):
+    """
+    Raised when the external payment API can't be reached, or while calls to
+    it are suspended after repeated failures.
     """
     pass
@@ -0,0 +1,328 @@
+"""
+Local stand-in for the Paysafe API.
+
+It serves the card payment and customer vault endpoints used in
+store/services.py so that the checkout can be exercised without reaching
+Paysafe's test API. Latency and errors listed in PAYSAFE_EXCEPTION can be
+injected to reproduce a slow or failing gateway.
+
+This server keeps everything in memory and must never be used in production.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+VAULT_ENDPOINTS = (
+    'vault.create_profile',
+    'vault.get_profile',
+    'vault.create_card',
+    'vault.update_card',
+    'vault.get_card',
+    'vault.delete_card',
+)
+CARD_ENDPOINTS = (
+    'card.auths',
+    'card.refunds',
+)
+
+# Endpoints on which each error code can be injected and the HTTP status
+# returned with it.
+ERROR_CODES = {
+    '3004': (('vault.create_card', 'vault.update_card'), 400),
+    '3006': (('card.auths', ), 402),
+    '3008': (('card.auths', ), 402),
+    '3009': (('card.auths', ), 402),
+    '3022': (('card.auths', ), 402),
+    '3029': (('card.auths', ), 402),
+    '3404': (('card.refunds', ), 400),
+    '3406': (('card.refunds', ), 400),
+    '5031': (CARD_ENDPOINTS, 409),
+    '5068': (('card.auths', 'vault.create_card', 'vault.update_card'), 400),
+    '5269': (VAULT_ENDPOINTS + CARD_ENDPOINTS, 404),
+    '5270': (VAULT_ENDPOINTS + CARD_ENDPOINTS, 401),
+    '5500': (('card.auths', ), 400),
+    '7503': (('vault.create_card', ), 409),
+    '7505': (('vault.create_profile', ), 409),
+}
+
+
+class FakePaysafeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.dispatch(self, 'GET')
+
+    def do_POST(self):
+        self.server.dispatch(self, 'POST')
+
+    def do_PUT(self):
+        self.server.dispatch(self, 'PUT')
+
+    def do_DELETE(self):
+        self.server.dispatch(self, 'DELETE')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakePaysafeServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering like the Paysafe API.
+
+    latency:        Seconds to wait before answering each request
+    jitter:         Maximum number of seconds randomly added to latency
+    error_rate:     Probability (0 to 1) of answering with an injected error
+    error_codes:    Paysafe error codes that can be injected (see ERROR_CODES)
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 error_rate=0, error_codes=None,
+                 vault_url='customervault/v1/', card_url='cardpayments/v1/',
+                 verbose=False):
+        super().__init__(address, FakePaysafeHandler)
+        for code in error_codes or []:
+            if code not in ERROR_CODES:
+                raise ValueError("Unsupported error code: " + code)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes or [])
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self.profiles = dict()
+        self.cards = dict()
+        self.settlements = dict()
+        self.requests_count = dict()
+
+        vault = '/' + vault_url
+        card = '/' + card_url + r'accounts/(?P<account>[^/]+)/'
+        self.routes = (
+            ('POST', vault + r'profiles/?$', 'vault.create_profile'),
+            ('GET', vault + r'profiles/(?P<profile>[^/]+)$',
+             'vault.get_profile'),
+            ('POST', vault + r'profiles/(?P<profile>[^/]+)/cards/?$',
+             'vault.create_card'),
+            ('PUT', vault + r'profiles/(?P<profile>[^/]+)/cards/(?P<card>'
+             r'[^/]+)$', 'vault.update_card'),
+            ('DELETE', vault + r'profiles/(?P<profile>[^/]+)/cards/(?P<card>'
+             r'[^/]+)$', 'vault.delete_card'),
+            ('GET', vault + r'cards/(?P<card>[^/]+)$', 'vault.get_card'),
+            ('POST', card + r'auths/?$', 'card.auths'),
+            ('POST', card + r'settlements/(?P<settlement>[^/]+)/refunds/?$',
+             'card.refunds'),
+        )
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}/'.format(*self.server_address[:2])
+
+    def start(self):
+        """Serves requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, handler, method):
+        path = urlsplit(handler.path).path
+        length = int(handler.headers.get('Content-Length') or 0)
+        try:
+            data = json.loads(handler.rfile.read(length) or b'{}')
+        except ValueError:
+            data = dict()
+
+        for route_method, pattern, endpoint in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(handler, 404, self.error('5269'))
+
+        with self._lock:
+            self.requests_count[endpoint] = (
+                self.requests_count.get(endpoint, 0) + 1
+            )
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        injected = [
+            code for code in self.error_codes
+            if endpoint in ERROR_CODES[code][0]
+        ]
+        if injected and random.random() < self.error_rate:
+            code = random.choice(injected)
+            return self.respond(handler, ERROR_CODES[code][1], self.error(
+                code,
+                handler.headers.get('Host', ''),
+            ))
+
+        action = getattr(self, endpoint.replace('.', '_'))
+        with self._lock:
+            status, content = action(data, handler, **match.groupdict())
+        return self.respond(handler, status, content)
+
+    def respond(self, handler, status, content):
+        body = json.dumps(content).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def error(self, code, host='example.com'):
+        content = {
+            'id': str(uuid.uuid4()),
+            'error': {
+                'code': code,
+                'message': "Fake Paysafe error {0}.".format(code),
+            },
+        }
+        if code == '7503':
+            # Paysafe links to the card that already exists
+            content['links'] = [{
+                'rel': 'existing_entity',
+                'href': 'http://{0}/customervault/v1/cards/unknown'.format(
+                    host
+                ),
+            }]
+        return content
+
+    def vault_create_profile(self, data, handler):
+        profile = {
+            'id': str(uuid.uuid4()),
+            'status': 'ACTIVE',
+            'merchantCustomerId': data.get('merchantCustomerId'),
+            'locale': data.get('locale'),
+            'firstName': data.get('firstName'),
+            'lastName': data.get('lastName'),
+            'email': data.get('email'),
+            'phone': data.get('phone'),
+            'paymentToken': uuid.uuid4().hex[:15],
+        }
+        self.profiles[profile['id']] = dict(profile, cards=[])
+        return 201, profile
+
+    def vault_get_profile(self, data, handler, profile):
+        if profile not in self.profiles:
+            return 404, self.error('5269')
+        content = dict(self.profiles[profile])
+        content['cards'] = [
+            self.cards[card_id] for card_id in content['cards']
+        ]
+        return 200, content
+
+    def _build_card(self, card_id, single_use_token):
+        last_digits = str(abs(hash(single_use_token)) % 10000).zfill(4)
+        return {
+            'status': 'ACTIVE',
+            'id': card_id,
+            'cardBin': '453091',
+            'lastDigits': last_digits,
+            'cardExpiry': {
+                'year': 2041,
+                'month': 12,
+            },
+            'holderName': 'John Smith',
+            'cardType': 'VI',
+            'paymentToken': uuid.uuid4().hex[:15],
+        }
+
+    def vault_create_card(self, data, handler, profile):
+        if profile not in self.profiles:
+            return 404, self.error('5269')
+        if not data.get('singleUseToken'):
+            return 400, self.error('5068')
+        card = self._build_card(str(uuid.uuid4()), data['singleUseToken'])
+        self.cards[card['id']] = card
+        self.profiles[profile]['cards'].append(card['id'])
+        return 201, card
+
+    def vault_update_card(self, data, handler, profile, card):
+        if card not in self.profiles.get(profile, {}).get('cards', []):
+            return 404, self.error('5269')
+        if not data.get('singleUseToken'):
+            return 400, self.error('5068')
+        updated_card = self._build_card(card, data['singleUseToken'])
+        self.cards[card] = updated_card
+        return 200, updated_card
+
+    def vault_delete_card(self, data, handler, profile, card):
+        if card not in self.profiles.get(profile, {}).get('cards', []):
+            return 404, self.error('5269')
+        self.profiles[profile]['cards'].remove(card)
+        del self.cards[card]
+        return 200, {}
+
+    def vault_get_card(self, data, handler, card):
+        if card not in self.cards:
+            return 404, self.error('5269')
+        return 200, self.cards[card]
+
+    def card_auths(self, data, handler, account):
+        payment_token = data.get('card', {}).get('paymentToken')
+        card = next(
+            (c for c in self.cards.values()
+             if c['paymentToken'] == payment_token),
+            None
+        )
+        if card is None:
+            return 400, self.error('5500')
+
+        auth_id = str(uuid.uuid4())
+        settlement = {
+            'id': str(uuid.uuid4()),
+            'merchantRefNum': data.get('merchantRefNum'),
+            'txnTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'status': 'PENDING',
+            'amount': data.get('amount'),
+            'availableToRefund': data.get('amount'),
+        }
+        self.settlements[settlement['id']] = settlement
+        return 200, {
+            'id': auth_id,
+            'merchantRefNum': data.get('merchantRefNum'),
+            'txnTime': settlement['txnTime'],
+            'status': 'COMPLETED',
+            'amount': data.get('amount'),
+            'settleWithAuth': True,
+            'availableToSettle': 0,
+            'card': {
+                'type': card['cardType'],
+                'lastDigits': card['lastDigits'],
+                'cardExpiry': card['cardExpiry'],
+            },
+            'currencyCode': 'CAD',
+            'settlements': [settlement],
+        }
+
+    def card_refunds(self, data, handler, account, settlement):
+        if settlement not in self.settlements:
+            return 404, self.error('5269')
+        settlement = self.settlements[settlement]
+        if not settlement['availableToRefund']:
+            return 400, self.error('3404')
+        if data.get('amount', 0) > settlement['availableToRefund']:
+            return 400, self.error('3406')
+        settlement['availableToRefund'] -= data.get('amount', 0)
+        return 200, {
+            'id': str(uuid.uuid4()),
+            'merchantRefNum': data.get('merchantRefNum'),
+            'amount': data.get('amount'),
+            'dupCheck': True,
+            'txnTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'status': 'COMPLETED',
+        }
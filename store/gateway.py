@@ -0,0 +1,359 @@
+from collections import OrderedDict
+from copy import deepcopy
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
+from .exceptions import GatewayUnavailableError
+
+###############################################################################
+#                          PAYSAFE HTTP CLIENT                                #
+###############################################################################
+
+# Used when the PAYSAFE setting does not define a value.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 20
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.2
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET_TIMEOUT = 30
+
+# Requests that can be sent again without side effects unless told otherwise
+IDEMPOTENT_METHODS = ('GET', )
+# Responses worth retrying. Only server errors count as failures of the
+# gateway for the circuit breaker.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Upper bounds, in seconds, of the latency histogram of each endpoint
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+logger = logging.getLogger(__name__)
+
+UNAVAILABLE_MESSAGE = _(
+    "The payment service is temporarily unavailable. Please try again later."
+)
+
+
+def get_error_code(response):
+    """
+    Returns the Paysafe error code of a failed response, if any.
+    """
+    if response.status_code < 400:
+        return None
+    try:
+        return str(response.json()['error']['code'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast while the external payment API is down.
+
+    The circuit opens after `failure_threshold` consecutive failures and
+    requests are refused without reaching the API. Once `reset_timeout`
+    seconds have passed, a single trial request is let through: the circuit
+    closes if it succeeds and opens again otherwise.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial:
+                # Another request is already testing the API
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._opened_at is not None or
+                    self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class PaysafeClient(object):
+    """
+    HTTP client shared by every call made to the external payment API.
+
+    A single keep-alive session is reused for all requests so that TCP and
+    TLS handshakes are not paid on each call. Every request is sent with
+    explicit connect/read timeouts and its duration is recorded per logical
+    endpoint (ie: 'card.auths', 'vault.get_profile').
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 breaker_reset_timeout=DEFAULT_BREAKER_RESET_TIMEOUT):
+        self.config = (
+            pool_size,
+            connect_timeout,
+            read_timeout,
+            max_retries,
+            retry_backoff,
+            breaker_threshold,
+            breaker_reset_timeout,
+        )
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._latencies = dict()
+
+    def request(self, method, endpoint, url, idempotent=None, **kwargs):
+        """
+        Sends a request through the shared session.
+
+        Idempotent requests that fail because of the network or a server
+        error are retried up to `max_retries` times, with a jittered
+        exponential backoff. Requests are refused right away while the
+        circuit breaker is open. GatewayUnavailableError is raised when the
+        API can't be reached.
+
+        method:     HTTP verb
+        endpoint:   Logical name of the endpoint, used to group latencies
+        url:        Full URL of the request
+        idempotent: Whether the request can safely be sent more than once.
+                    Defaults to True for GET requests only.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault(
+            'auth',
+            (settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
+        )
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+
+            if not self.breaker.allow_request():
+                raise GatewayUnavailableError(UNAVAILABLE_MESSAGE)
+
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as err:
+                self.record_call(
+                    method,
+                    endpoint,
+                    time.monotonic() - start,
+                    error=err,
+                )
+                self.breaker.record_failure()
+                if last_attempt:
+                    raise GatewayUnavailableError(UNAVAILABLE_MESSAGE)
+            except Exception:
+                # The trial request of a half-open circuit must not stay
+                # pending forever
+                self.breaker.record_failure()
+                raise
+            else:
+                self.record_call(
+                    method,
+                    endpoint,
+                    time.monotonic() - start,
+                    response=response,
+                )
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if last_attempt or response.status_code not in RETRY_STATUSES:
+                    return response
+
+            time.sleep(self.get_retry_delay(attempt))
+
+    def get_retry_delay(self, attempt):
+        """
+        Returns a random delay, in seconds, that doubles at each attempt.
+        """
+        return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request('GET', endpoint, url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request('POST', endpoint, url, **kwargs)
+
+    def put(self, endpoint, url, **kwargs):
+        return self.request('PUT', endpoint, url, **kwargs)
+
+    def delete(self, endpoint, url, **kwargs):
+        return self.request('DELETE', endpoint, url, **kwargs)
+
+    def record_call(self, method, endpoint, duration, response=None,
+                    error=None):
+        """
+        Records the outcome of a request in the metrics of its endpoint and
+        logs it as a structured line.
+
+        Either the response or the network error of the request is given.
+        """
+        if response is not None:
+            status = str(response.status_code)
+            error_code = get_error_code(response)
+        else:
+            status = 'network_error'
+            error_code = None
+
+        with self._lock:
+            counter = self._latencies.setdefault(endpoint, {
+                'count': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'buckets': OrderedDict(
+                    (str(bucket), 0) for bucket in LATENCY_BUCKETS
+                ),
+                'statuses': dict(),
+                'error_codes': dict(),
+            })
+            counter['count'] += 1
+            counter['total'] += duration
+            counter['max'] = max(counter['max'], duration)
+            bucket = next(
+                (bucket for bucket in LATENCY_BUCKETS if duration <= bucket),
+                LATENCY_BUCKETS[-1],
+            )
+            counter['buckets'][str(bucket)] += 1
+            counter['statuses'][status] = (
+                counter['statuses'].get(status, 0) + 1
+            )
+            if error_code:
+                counter['error_codes'][error_code] = (
+                    counter['error_codes'].get(error_code, 0) + 1
+                )
+
+        logger.log(
+            logging.WARNING if response is None or response.status_code >= 500
+            else logging.INFO,
+            'paysafe_call method=%s endpoint=%s status=%s error_code=%s '
+            'duration_ms=%.1f',
+            method,
+            endpoint,
+            status,
+            error_code or '-',
+            duration * 1000,
+            extra={
+                'method': method,
+                'endpoint': endpoint,
+                'status': status,
+                'error_code': error_code,
+                'duration': duration,
+                'error': repr(error) if error else None,
+            },
+        )
+
+    def get_latencies(self):
+        """
+        Returns a snapshot of the metrics, with latencies in seconds, per
+        endpoint.
+        Buckets count the calls by latency, keyed by their upper bound.
+        Statuses count the calls by HTTP status and error codes count the
+        Paysafe error codes returned.
+        """
+        with self._lock:
+            latencies = dict()
+            for endpoint, counter in self._latencies.items():
+                latencies[endpoint] = deepcopy(counter)
+                latencies[endpoint]['average'] = (
+                    counter['total'] / counter['count']
+                )
+            return latencies
+
+    def reset_latencies(self):
+        with self._lock:
+            self._latencies = dict()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client_config():
+    return (
+        int(settings.PAYSAFE.get('POOL_SIZE', DEFAULT_POOL_SIZE)),
+        float(settings.PAYSAFE.get(
+            'CONNECT_TIMEOUT',
+            DEFAULT_CONNECT_TIMEOUT
+        )),
+        float(settings.PAYSAFE.get('READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        int(settings.PAYSAFE.get('MAX_RETRIES', DEFAULT_MAX_RETRIES)),
+        float(settings.PAYSAFE.get('RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF)),
+        int(settings.PAYSAFE.get(
+            'BREAKER_THRESHOLD',
+            DEFAULT_BREAKER_THRESHOLD
+        )),
+        float(settings.PAYSAFE.get(
+            'BREAKER_RESET_TIMEOUT',
+            DEFAULT_BREAKER_RESET_TIMEOUT
+        )),
+    )
+
+
+def get_client():
+    """
+    Returns the process-wide Paysafe client.
+    The client is rebuilt only if the pool, timeout, retry or circuit
+    breaker settings changed.
+    """
+    global _client
+
+    config = _get_client_config()
+    with _client_lock:
+        if _client is None or _client.config != config:
+            _client = PaysafeClient(*config)
+        return _client
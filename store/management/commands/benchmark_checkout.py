@@ -0,0 +1,264 @@
+import itertools
+import math
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from safedelete.models import HARD_DELETE
+
+from retirement.models import Retirement
+from store.fake_paysafe import FakePaysafeServer
+from store.models import Membership, Package
+from workplace.models import Period, TimeSlot, Workplace
+
+User = get_user_model()
+
+PRODUCTS = ('membership', 'package', 'timeslot', 'retirement')
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent order creation against a fake Paysafe ' \
+           'API. Benchmark data is created in the configured database and ' \
+           'deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', default=200, type=int)
+        parser.add_argument('--concurrency', default=10, type=int)
+        parser.add_argument(
+            '--products',
+            nargs='+',
+            default=list(PRODUCTS),
+            choices=PRODUCTS,
+            help='Products ordered, in turn, by the benchmark users',
+        )
+        parser.add_argument(
+            '--gateway_url',
+            type=str,
+            help='URL of an already running fake Paysafe API. A new one is '
+                 'started in-process if omitted.',
+        )
+        parser.add_argument('--latency', default=0, type=float)
+        parser.add_argument('--jitter', default=0, type=float)
+        parser.add_argument('--error_rate', default=0, type=float)
+        parser.add_argument('--error_codes', nargs='+', default=[], type=str)
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            dest='keep',
+            help='Do not delete the benchmark data',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            help='Allow the benchmark to run when DEBUG is False',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(
+                'The benchmark writes in the configured database. Use '
+                '--force to run it when DEBUG is False.'
+            )
+
+        server = None
+        base_url = options['gateway_url']
+        if not base_url:
+            try:
+                server = FakePaysafeServer(
+                    latency=options['latency'],
+                    jitter=options['jitter'],
+                    error_rate=options['error_rate'],
+                    error_codes=options['error_codes'],
+                    vault_url=settings.PAYSAFE['VAULT_URL'],
+                    card_url=settings.PAYSAFE['CARD_URL'],
+                ).start()
+            except ValueError as err:
+                raise CommandError(str(err))
+            base_url = server.base_url
+
+        paysafe = dict(settings.PAYSAFE)
+        paysafe['BASE_URL'] = base_url
+        paysafe['POOL_SIZE'] = options['concurrency']
+
+        run_id = 'benchmark-' + uuid.uuid4().hex[:8]
+        data = self.create_data(run_id, options['orders'])
+
+        try:
+            with override_settings(
+                PAYSAFE=paysafe,
+                ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver'],
+                EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+            ):
+                results = self.run_orders(data, options)
+        finally:
+            if server:
+                server.stop()
+            if not options['keep']:
+                self.delete_data(data)
+
+        self.report(results, options)
+
+    def create_data(self, run_id, orders):
+        now = timezone.now()
+        User.objects.bulk_create([
+            User(
+                username='{0}-{1}@example.com'.format(run_id, i),
+                email='{0}-{1}@example.com'.format(run_id, i),
+                first_name='Benchmark',
+                last_name=str(i),
+                phone='5555555555',
+                city='Montreal',
+                tickets=1,
+            ) for i in range(orders)
+        ])
+        users = User.objects.filter(username__startswith=run_id)
+
+        workplace = Workplace.objects.create(
+            name=run_id,
+            seats=orders,
+            address_line1='123 random street',
+            postal_code='123 456',
+            state_province='Random state',
+            country='Random country',
+        )
+        period = Period.objects.create(
+            name=run_id,
+            workplace=workplace,
+            start_date=now,
+            end_date=now + timedelta(weeks=4),
+            price=1,
+            is_active=True,
+        )
+
+        return {
+            'run_id': run_id,
+            'users': list(users.order_by('id')),
+            'workplace': workplace,
+            'membership': Membership.objects.create(
+                name=run_id,
+                price=50,
+                available=True,
+                duration=timedelta(days=365),
+            ),
+            'package': Package.objects.create(
+                name=run_id,
+                price=40,
+                reservations=10,
+                available=True,
+            ),
+            'timeslot': TimeSlot.objects.create(
+                name=run_id,
+                period=period,
+                price=1,
+                start_time=now + timedelta(days=7),
+                end_time=now + timedelta(days=7, hours=4),
+            ),
+            'retirement': Retirement.objects.create(
+                name=run_id,
+                seats=orders,
+                address_line1='123 random street',
+                postal_code='123 456',
+                state_province='Random state',
+                country='Random country',
+                price=199,
+                start_time=now + timedelta(days=30),
+                end_time=now + timedelta(days=32),
+                min_day_refund=7,
+                min_day_exchange=7,
+                refund_rate=50,
+                is_active=True,
+                accessibility=True,
+            ),
+        }
+
+    def delete_data(self, data):
+        User.objects.filter(username__startswith=data['run_id']).delete()
+        data['membership'].delete()
+        data['package'].delete()
+        data['retirement'].delete(force_policy=HARD_DELETE)
+        data['workplace'].delete(force_policy=HARD_DELETE)
+
+    def place_order(self, user, product, content_type):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        start = time.monotonic()
+        try:
+            response = client.post(
+                reverse('order-list'),
+                {
+                    'single_use_token': 'benchmark-' + uuid.uuid4().hex,
+                    'order_lines': [{
+                        'content_type': content_type,
+                        'object_id': product.id,
+                        'quantity': 1,
+                    }],
+                },
+                format='json',
+            )
+            status = response.status_code
+        except Exception as err:
+            status = type(err).__name__
+        finally:
+            connections.close_all()
+        return content_type, status, time.monotonic() - start
+
+    def run_orders(self, data, options):
+        products = itertools.cycle(options['products'])
+        start = time.monotonic()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            futures = [
+                executor.submit(
+                    self.place_order,
+                    user,
+                    data[content_type],
+                    content_type,
+                ) for user, content_type in zip(data['users'], products)
+            ]
+            results = [future.result() for future in futures]
+        return {
+            'duration': time.monotonic() - start,
+            'orders': results,
+        }
+
+    def report(self, results, options):
+        orders = results['orders']
+        durations = sorted(duration for _, _, duration in orders)
+        statuses = dict()
+        for content_type, status, _ in orders:
+            key = '{0} {1}'.format(content_type, status)
+            statuses[key] = statuses.get(key, 0) + 1
+
+        self.stdout.write('Orders: {0} ({1} concurrent)'.format(
+            len(orders),
+            options['concurrency'],
+        ))
+        for key in sorted(statuses):
+            self.stdout.write('  {0}: {1}'.format(key, statuses[key]))
+        self.stdout.write('Throughput: {0:.2f} orders/s'.format(
+            len(orders) / results['duration']
+        ))
+        self.stdout.write(self.style.SUCCESS(
+            'Latency (ms): p50={0:.1f} p95={1:.1f} p99={2:.1f}'.format(
+                percentile(durations, 50) * 1000,
+                percentile(durations, 95) * 1000,
+                percentile(durations, 99) * 1000,
+            )
+        ))
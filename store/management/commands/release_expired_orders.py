@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.services import release_expired_orders
+
+
+class Command(BaseCommand):
+    help = 'Release seats and tickets held by pending orders that were not ' \
+           'confirmed in time'
+
+    def handle(self, *args, **options):
+        released = release_expired_orders()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Released {0} expired pending orders'.format(released)
+        ))
@@ -0,0 +1,74 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from store.fake_paysafe import ERROR_CODES, FakePaysafeServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the Paysafe API. Point ' \
+           'PAYSAFE_BASE_URL to it to avoid reaching the real gateway.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', type=str)
+        parser.add_argument('--port', default=8090, type=int)
+        parser.add_argument(
+            '--latency',
+            default=0,
+            type=float,
+            help='Seconds to wait before answering each request',
+        )
+        parser.add_argument(
+            '--jitter',
+            default=0,
+            type=float,
+            help='Maximum number of seconds randomly added to the latency',
+        )
+        parser.add_argument(
+            '--error_rate',
+            default=0,
+            type=float,
+            help='Probability (0 to 1) of answering with an injected error',
+        )
+        parser.add_argument(
+            '--error_codes',
+            nargs='+',
+            default=[],
+            type=str,
+            help='Paysafe error codes to inject. Available codes: ' +
+                 ', '.join(sorted(ERROR_CODES.keys())),
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Log every request',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            server = FakePaysafeServer(
+                (options['host'], options['port']),
+                latency=options['latency'],
+                jitter=options['jitter'],
+                error_rate=options['error_rate'],
+                error_codes=options['error_codes'],
+                vault_url=settings.PAYSAFE['VAULT_URL'],
+                card_url=settings.PAYSAFE['CARD_URL'],
+                verbose=options['verbose'],
+            )
+        except ValueError as err:
+            raise CommandError(str(err))
+
+        server.start()
+        self.stdout.write(self.style.SUCCESS(
+            'Fake Paysafe API listening on {0}'.format(server.base_url)
+        ))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+
+from store.exceptions import PaymentAPIError
+from store.models import PaymentProfile
+from store.services import sync_external_cards
+
+
+class Command(BaseCommand):
+    help = 'Synchronize the local copy of the cards of payment profiles ' \
+           'with the external payment API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles',
+            nargs='+',
+            type=int,
+            help='IDs of the payment profiles to synchronize. All profiles '
+                 'are synchronized if omitted.',
+        )
+        parser.add_argument(
+            '--unsynced',
+            action='store_true',
+            dest='unsynced',
+            help='Only synchronize profiles that were never synchronized',
+        )
+
+    def handle(self, *args, **options):
+        profiles = PaymentProfile.objects.all()
+        if options['profiles']:
+            profiles = profiles.filter(id__in=options['profiles'])
+        if options['unsynced']:
+            profiles = profiles.filter(cards_synced_at__isnull=True)
+
+        # Profiles sharing an external profile are synchronized together
+        external_ids = profiles.order_by('external_api_id').values_list(
+            'external_api_id',
+            flat=True,
+        ).distinct()
+
+        synced = 0
+        failed = 0
+        for external_id in external_ids:
+            try:
+                sync_external_cards(external_id)
+                synced += 1
+            except PaymentAPIError as err:
+                failed += 1
+                self.stderr.write(
+                    'Failed to synchronize profile "{0}": {1}'.format(
+                        external_id,
+                        err,
+                    )
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            'Synchronized {0} external profiles ({1} failed)'.format(
+                synced,
+                failed,
+            )
+        ))
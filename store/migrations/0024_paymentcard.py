@@ -0,0 +1,52 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0023_couponuser_uniqueness'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_api_id', models.CharField(max_length=253, verbose_name='External card ID')),
+                ('card_bin', models.CharField(blank=True, max_length=253, null=True, verbose_name='Card BIN')),
+                ('card_expiry_month', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Card expiry month')),
+                ('card_expiry_year', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Card expiry year')),
+                ('card_type', models.CharField(blank=True, max_length=253, null=True, verbose_name='Card type')),
+                ('holder_name', models.CharField(blank=True, max_length=253, null=True, verbose_name='Holder name')),
+                ('last_digits', models.CharField(blank=True, max_length=253, null=True, verbose_name='Last digits')),
+                ('payment_token', models.CharField(blank=True, max_length=253, null=True, verbose_name='Payment token')),
+                ('status', models.CharField(blank=True, max_length=253, null=True, verbose_name='Status')),
+            ],
+            options={
+                'verbose_name': 'Payment card',
+                'verbose_name_plural': 'Payment cards',
+            },
+        ),
+        migrations.AddField(
+            model_name='historicalpaymentprofile',
+            name='cards_synced_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Cards synchronization date'),
+        ),
+        migrations.AddField(
+            model_name='paymentprofile',
+            name='cards_synced_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Cards synchronization date'),
+        ),
+        migrations.AddField(
+            model_name='paymentcard',
+            name='payment_profile',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cards', to='store.PaymentProfile', verbose_name='Payment profile'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='paymentcard',
+            unique_together={('payment_profile', 'external_api_id')},
+        ),
+    ]
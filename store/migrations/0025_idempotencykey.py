@@ -0,0 +1,37 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0024_paymentcard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=253, verbose_name='Key')),
+                ('request_path', models.CharField(max_length=253, verbose_name='Request path')),
+                ('request_hash', models.CharField(max_length=64, verbose_name='Request hash')),
+                ('response_status', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Response status')),
+                ('response_body', models.TextField(blank=True, null=True, verbose_name='Response body')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Creation date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Idempotency key',
+                'verbose_name_plural': 'Idempotency keys',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotencykey',
+            unique_together={('user', 'key')},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0025_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalorder',
+            name='pending_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Pending until'),
+        ),
+        migrations.AddField(
+            model_name='historicalorder',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Confirmed')], default='C', max_length=1, verbose_name='Status'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='pending_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Pending until'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Confirmed')], default='C', max_length=1, verbose_name='Status'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:32
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_coupon_uses(apps, schema_editor):
+    '''
+    Initialize the usage counter of existing coupons from the uses of their
+    (not deleted) CouponUser instances.
+    '''
+    Coupon = apps.get_model('store', 'Coupon')
+    CouponUser = apps.get_model('store', 'CouponUser')
+    uses = CouponUser.objects.filter(
+        coupon=OuterRef('pk'),
+        deleted__isnull=True,
+    ).values('coupon').annotate(total=Sum('uses')).values('total')
+    Coupon.objects.update(total_uses=Coalesce(Subquery(uses), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0026_order_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='total_uses',
+            field=models.PositiveIntegerField(default=0, verbose_name='Total uses'),
+        ),
+        migrations.AddField(
+            model_name='historicalcoupon',
+            name='total_uses',
+            field=models.PositiveIntegerField(default=0, verbose_name='Total uses'),
+        ),
+        migrations.RunPython(count_coupon_uses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.0.8 on 2026-10-18 03:36
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicate_codes(apps, schema_editor):
+    '''
+    Coupons sharing a code with an older coupon, deleted or not, get their id
+    appended to their code so the code can be made unique. A counter is also
+    appended if that code is already used.
+    '''
+    Coupon = apps.get_model('store', 'Coupon')
+    duplicate_codes = list(Coupon.objects.values('code').annotate(
+        count=Count('id'),
+    ).filter(count__gt=1).values_list('code', flat=True))
+    for code in duplicate_codes:
+        duplicates = list(Coupon.objects.filter(code=code).order_by('id')[1:])
+        for coupon in duplicates:
+            new_code = '{0}-{1}'.format(code, coupon.pk)
+            suffix = 1
+            while Coupon.objects.filter(code=new_code).exists():
+                new_code = '{0}-{1}-{2}'.format(code, coupon.pk, suffix)
+                suffix += 1
+            Coupon.objects.filter(pk=coupon.pk).update(code=new_code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0027_coupon_total_uses'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=253, unique=True, verbose_name='Code'),
+        ),
+        migrations.AlterField(
+            model_name='historicalcoupon',
+            name='code',
+            field=models.CharField(db_index=True, max_length=253, verbose_name='Code'),
+        ),
+    ]
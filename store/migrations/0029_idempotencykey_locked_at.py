@@ -0,0 +1,18 @@
+# Generated by Django 2.0.8 on 2026-10-18 05:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0028_coupon_code_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='locked_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Lock date'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.8 on 2026-10-18 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0029_idempotencykey_locked_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='historicalorder',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Confirmed'), ('F', 'Failed')], default='C', max_length=1, verbose_name='Status'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Confirmed'), ('F', 'Failed')], default='C', max_length=1, verbose_name='Status'),
+        ),
+    ]
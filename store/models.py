@@ -1,5 +1,7 @@
 import decimal
 from django.db import models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -24,6 +26,12 @@ class Order(models.Model):
         verbose_name = _("Order")
         verbose_name_plural = _("Orders")
 
+    STATUS = (
+        ('P', _("Pending")),
+        ('C', _("Confirmed")),
+        ('F', _("Failed")),
+    )
+
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -52,18 +60,33 @@ class Order(models.Model):
         blank=True,
     )
 
+    # Orders are pending while the user is charged. Seats and tickets held by
+    # a pending order are released if it is not confirmed in time. Failed
+    # orders keep track of charges made after their order was released that
+    # could not be refunded.
+    status = models.CharField(
+        verbose_name=_("Status"),
+        max_length=1,
+        choices=STATUS,
+        default='C',
+    )
+
+    pending_until = models.DateTimeField(
+        verbose_name=_("Pending until"),
+        null=True,
+        blank=True,
+    )
+
     history = HistoricalRecords()
 
     @property
     def total_cost(self):
+        # Order lines are filtered here to benefit from prefetched order lines
         cost = 0
-        orderlines = self.order_lines.filter(
-            models.Q(content_type__model='membership') |
-            models.Q(content_type__model='package') |
-            models.Q(content_type__model='retirement')
-        )
-        for orderline in orderlines:
-            cost += orderline.cost * orderline.quantity
+        for orderline in self.order_lines.all():
+            if orderline.product_type in ('membership', 'package',
+                                          'retirement'):
+                cost += orderline.cost * orderline.quantity
         return cost
 
     @property
@@ -71,7 +94,7 @@ class Order(models.Model):
         tickets = 0
         orderlines = self.order_lines.filter(
             content_type__model='timeslot'
-        )
+        ).with_content_objects()
         for orderline in orderlines:
             tickets += orderline.content_object.price * orderline.quantity
         return tickets
@@ -80,6 +103,18 @@ class Order(models.Model):
         return str(self.authorization_id)
 
 
+class OrderLineQuerySet(models.QuerySet):
+
+    def with_content_objects(self):
+        """
+        Load the content type and content object of order lines with one
+        query per content type instead of one query per order line.
+        """
+        return self.select_related('content_type').prefetch_related(
+            'content_object'
+        )
+
+
 class OrderLine(models.Model):
     """
     Represents a line of an order. Can specify the product/service with a
@@ -136,8 +171,15 @@ class OrderLine(models.Model):
         default=0,
     )
 
+    objects = OrderLineQuerySet.as_manager()
+
     history = HistoricalRecords()
 
+    @property
+    def product_type(self):
+        """Model name of the content object, without querying the database"""
+        return ContentType.objects.get_for_id(self.content_type_id).model
+
     def __str__(self):
         return str(self.content_object) + ', qt:' + str(self.quantity)
 
@@ -359,12 +401,101 @@ class PaymentProfile(models.Model):
         max_length=253,
     )
 
+    # Last time the local copy of the cards was synchronized with the
+    # external payment API. Cards are fetched from the API if None.
+    cards_synced_at = models.DateTimeField(
+        verbose_name=_("Cards synchronization date"),
+        null=True,
+        blank=True,
+    )
+
     history = HistoricalRecords()
 
     def __str__(self):
         return self.name
 
 
+class PaymentCard(models.Model):
+    """
+    Local copy of a card stored in the external payment API. It prevents a
+    call to the external API each time the cards of a profile are displayed.
+    """
+
+    class Meta:
+        verbose_name = _("Payment card")
+        verbose_name_plural = _("Payment cards")
+        unique_together = (('payment_profile', 'external_api_id'),)
+
+    payment_profile = models.ForeignKey(
+        PaymentProfile,
+        on_delete=models.CASCADE,
+        verbose_name=_("Payment profile"),
+        related_name='cards',
+    )
+
+    external_api_id = models.CharField(
+        verbose_name=_("External card ID"),
+        max_length=253,
+    )
+
+    card_bin = models.CharField(
+        verbose_name=_("Card BIN"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    card_expiry_month = models.PositiveSmallIntegerField(
+        verbose_name=_("Card expiry month"),
+        null=True,
+        blank=True,
+    )
+
+    card_expiry_year = models.PositiveSmallIntegerField(
+        verbose_name=_("Card expiry year"),
+        null=True,
+        blank=True,
+    )
+
+    card_type = models.CharField(
+        verbose_name=_("Card type"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    holder_name = models.CharField(
+        verbose_name=_("Holder name"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    last_digits = models.CharField(
+        verbose_name=_("Last digits"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    payment_token = models.CharField(
+        verbose_name=_("Payment token"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    status = models.CharField(
+        verbose_name=_("Status"),
+        max_length=253,
+        null=True,
+        blank=True,
+    )
+
+    def __str__(self):
+        return ', '.join([str(self.card_type), str(self.last_digits)])
+
+
 class Coupon(SafeDeleteModel):
     """
     Represents a coupon that provides a discount on various products.
@@ -383,12 +514,11 @@ class Coupon(SafeDeleteModel):
         null=True,
     )
 
-    # Code generator:
-    # ''.join(random.choices(string.ascii_uppercase.replace("O", "")
-    #                           + string.digits.replace("0", ""), k=8))
+    # Codes are generated by store.services.generate_coupon_codes
     code = models.CharField(
         verbose_name=_("Code"),
         max_length=253,
+        unique=True,
     )
 
     start_time = models.DateTimeField(verbose_name=_("Start time"), )
@@ -399,6 +529,13 @@ class Coupon(SafeDeleteModel):
 
     max_use_per_user = models.PositiveIntegerField()
 
+    # Sum of the uses of all CouponUser instances of this coupon, kept up to
+    # date with atomic updates so limits can be enforced without summing.
+    total_uses = models.PositiveIntegerField(
+        verbose_name=_("Total uses"),
+        default=0,
+    )
+
     owner = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -463,6 +600,29 @@ class Coupon(SafeDeleteModel):
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        # The usage counter is only changed by atomic updates. Don't overwrite
+        # it with a possibly outdated value when saving other changes.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'total_uses'
+            ]
+        super(Coupon, self).save(*args, **kwargs)
+
+    def update_total_uses(self):
+        """
+        Recompute the usage counter from the CouponUser instances. Used when
+        uses are edited by hand instead of through a coupon redemption.
+        """
+        uses = CouponUser.objects.filter(
+            coupon=OuterRef('pk'),
+        ).values('coupon').annotate(total=Sum('uses')).values('total')
+        Coupon.objects.filter(pk=self.pk).update(
+            total_uses=Coalesce(Subquery(uses), 0),
+        )
+        self.refresh_from_db(fields=['total_uses'])
+
 
 class CouponUser(SafeDeleteModel):
     """Contains uses of coupons by users."""
@@ -488,3 +648,68 @@ class CouponUser(SafeDeleteModel):
 
     def __str__(self):
         return ', '.join([str(self.coupon), str(self.user)])
+
+
+class IdempotencyKey(models.Model):
+    """
+    Result of a request sent with an "Idempotency-Key" header. It is replayed
+    to subsequent requests of the same user using the same key instead of
+    processing them again.
+    """
+
+    class Meta:
+        verbose_name = _("Idempotency key")
+        verbose_name_plural = _("Idempotency keys")
+        unique_together = (('user', 'key'),)
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name=_("User"),
+        related_name='idempotency_keys',
+    )
+
+    key = models.CharField(
+        verbose_name=_("Key"),
+        max_length=253,
+    )
+
+    request_path = models.CharField(
+        verbose_name=_("Request path"),
+        max_length=253,
+    )
+
+    request_hash = models.CharField(
+        verbose_name=_("Request hash"),
+        max_length=64,
+    )
+
+    # Null while the first request is being processed
+    response_status = models.PositiveSmallIntegerField(
+        verbose_name=_("Response status"),
+        null=True,
+        blank=True,
+    )
+
+    response_body = models.TextField(
+        verbose_name=_("Response body"),
+        null=True,
+        blank=True,
+    )
+
+    # Set while a request is being processed. A key whose lock has expired,
+    # because its worker died, can be taken over by a retry.
+    locked_at = models.DateTimeField(
+        verbose_name=_("Lock date"),
+        null=True,
+        blank=True,
+    )
+
+    created_at = models.DateTimeField(
+        verbose_name=_("Creation date"),
+        auto_now_add=True,
+        db_index=True,
+    )
+
+    def __str__(self):
+        return self.key
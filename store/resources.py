@@ -6,7 +6,6 @@ from import_export.widgets import (ForeignKeyWidget, ManyToManyWidget,
                                    DateTimeWidget)
 
 from blitz_api.models import AcademicLevel
-from blitz_api.services import get_model_from_name
 
 from .models import (Membership, Order, OrderLine, Package, CustomPayment,
                      Coupon, CouponUser, Refund, )
@@ -99,12 +98,10 @@ class OrderLineResource(resources.ModelResource):
     item_id = fields.Field()
 
     def dehydrate_item_name(self, orderline):
-        model = get_model_from_name(orderline.content_type.model)
-        return model.objects.get(id=orderline.object_id).name
+        return orderline.content_object.name
 
     def dehydrate_item_id(self, orderline):
-        model = get_model_from_name(orderline.content_type.model)
-        return model.objects.get(id=orderline.object_id).id
+        return orderline.object_id
 
     class Meta:
         model = OrderLine
@@ -201,8 +198,7 @@ class CouponResource(resources.ModelResource):
     total_use = fields.Field()
 
     def dehydrate_total_use(self, coupon):
-        uses = CouponUser.objects.filter(coupon=coupon)
-        return sum(uses.values_list('uses', flat=True))
+        return coupon.total_uses
 
     class Meta:
         model = Coupon
@@ -1,9 +1,9 @@
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 
+from collections import defaultdict
+from datetime import timedelta
 from decimal import Decimal
-import random
-import string
 import uuid
 
 from django.apps import apps
@@ -11,26 +11,33 @@ from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from django.db import transaction, models
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
 from django.conf import settings
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 
+from blitz_api.exceptions import InsufficientTicketsError
 from blitz_api.services import (remove_translation_fields,
-                                check_if_translated_field,)
-from workplace.models import Reservation
+                                check_if_translated_field,
+                                queue_mail, update_tickets, )
+from workplace.models import Reservation, TimeSlot
+from workplace.services import adjust_availability
 from retirement.models import Reservation as RetirementReservation
 from retirement.models import WaitQueueNotification, Retirement
 
 from .exceptions import PaymentAPIError
 from .models import (Package, Membership, Order, OrderLine, BaseProduct,
-                     PaymentProfile, CustomPayment, Coupon, CouponUser, Refund,
-                     )
-from .services import (charge_payment,
+                     PaymentProfile, PaymentCard, CustomPayment, Coupon,
+                     CouponUser, Refund, )
+from .services import (bulk_create_reservations,
+                       charge_payment,
                        create_external_payment_profile,
                        create_external_card,
-                       get_external_cards,
+                       generate_coupon_codes, COUPON_CREATION_TRIES,
+                       refund_amount,
+                       release_order,
+                       sync_external_cards,
+                       use_coupon,
                        PAYSAFE_CARD_TYPE,
                        validate_coupon_for_order, )
 
@@ -38,6 +45,14 @@ User = get_user_model()
 
 TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
 
+# Products that can be ordered, by content type model name
+ORDERABLE_PRODUCTS = {
+    'membership': Membership,
+    'package': Package,
+    'retirement': Retirement,
+    'timeslot': TimeSlot,
+}
+
 
 class BaseProductSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
@@ -177,45 +192,46 @@ class CustomPaymentSerializer(serializers.HyperlinkedModelSerializer):
             ]
             custom_payment.save()
 
-        # TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
+            # TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
 
-        items = [
-            {
-                'price': custom_payment.price,
-                'name': custom_payment.name,
-            }
-        ]
+            items = [
+                {
+                    'price': custom_payment.price,
+                    'name': custom_payment.name,
+                }
+            ]
 
-        # Send custom_payment confirmation email
-        merge_data = {
-            'STATUS': "APPROUVÉE",
-            'CARD_NUMBER': charge_res_content['card']['lastDigits'],
-            'CARD_TYPE': PAYSAFE_CARD_TYPE[
-                charge_res_content['card']['type']
-            ],
-            'DATETIME': timezone.localtime().strftime("%x %X"),
-            'ORDER_ID': custom_payment.id,
-            'CUSTOMER_NAME': user.first_name + " " + user.last_name,
-            'CUSTOMER_EMAIL': user.email,
-            'CUSTOMER_NUMBER': user.id,
-            'AUTHORIZATION': custom_payment.authorization_id,
-            'TYPE': "Achat",
-            'ITEM_LIST': items,
-            # No tax applied on custom payments.
-            'TAX': "0.00",
-            'COST': custom_payment.price,
-        }
+            # Send custom_payment confirmation email
+            merge_data = {
+                'STATUS': "APPROUVÉE",
+                'CARD_NUMBER': charge_res_content['card']['lastDigits'],
+                'CARD_TYPE': PAYSAFE_CARD_TYPE[
+                    charge_res_content['card']['type']
+                ],
+                'DATETIME': timezone.localtime().strftime("%x %X"),
+                'ORDER_ID': custom_payment.id,
+                'CUSTOMER_NAME': user.first_name + " " + user.last_name,
+                'CUSTOMER_EMAIL': user.email,
+                'CUSTOMER_NUMBER': user.id,
+                'AUTHORIZATION': custom_payment.authorization_id,
+                'TYPE': "Achat",
+                'ITEM_LIST': items,
+                # No tax applied on custom payments.
+                'TAX': "0.00",
+                'COST': custom_payment.price,
+            }
 
-        plain_msg = render_to_string("invoice.txt", merge_data)
-        msg_html = render_to_string("invoice.html", merge_data)
+            plain_msg = render_to_string("invoice.txt", merge_data)
+            msg_html = render_to_string("invoice.html", merge_data)
 
-        send_mail(
-            "Confirmation d'achat",
-            plain_msg,
-            settings.DEFAULT_FROM_EMAIL,
-            [custom_payment.user.email],
-            html_message=msg_html,
-        )
+            queue_mail(
+                "Confirmation d'achat",
+                plain_msg,
+                settings.DEFAULT_FROM_EMAIL,
+                [custom_payment.user.email],
+                html_message=msg_html,
+                on_commit=True,
+            )
 
         return custom_payment
 
@@ -232,12 +248,48 @@ class CustomPaymentSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
+class PaymentCardSerializer(serializers.ModelSerializer):
+    id = serializers.ReadOnlyField(source='external_api_id')
+    card_expiry = serializers.SerializerMethodField()
+
+    def get_card_expiry(self, obj):
+        return {
+            'month': obj.card_expiry_month,
+            'year': obj.card_expiry_year,
+        }
+
+    class Meta:
+        model = PaymentCard
+        fields = (
+            'id',
+            'card_bin',
+            'card_expiry',
+            'card_type',
+            'holder_name',
+            'last_digits',
+            'payment_token',
+            'status',
+        )
+
+
 class PaymentProfileSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
     cards = serializers.SerializerMethodField()
 
     def get_cards(self, obj):
-        return get_external_cards(obj.external_api_id)
+        # Cards are only fetched from the external API if they have never
+        # been synchronized. They are kept up to date by the services that
+        # add, update or delete cards afterward.
+        if obj.cards_synced_at is None:
+            # Profiles of a list sharing an external profile are synchronized
+            # only once.
+            synced_cards = self.context.setdefault('synced_cards', dict())
+            if obj.external_api_id not in synced_cards:
+                synced_cards[obj.external_api_id] = sync_external_cards(
+                    obj.external_api_id
+                )
+            return synced_cards[obj.external_api_id]
+        return PaymentCardSerializer(obj.cards.all(), many=True).data
 
     class Meta:
         model = PaymentProfile
@@ -257,9 +309,56 @@ class PaymentProfileSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
+def validate_product_for_user(user, model_name, product):
+    """
+    Ensure the user is allowed to order the product, given its membership and
+    academic level. Admins can order any product.
+    """
+    if user.is_staff:
+        return
+
+    if (model_name in ('package', 'retirement')
+            and product.exclusive_memberships.all()
+            and user.membership not in product.exclusive_memberships.all()):
+        raise serializers.ValidationError({
+            'object_id': [
+                _(
+                    "User does not have the required membership to order "
+                    "this package."
+                )
+            ],
+        })
+    if (model_name == 'membership'
+            and product.academic_levels.all()
+            and user.academic_level not in product.academic_levels.all()):
+        raise serializers.ValidationError({
+            'object_id': [
+                _(
+                    "User does not have the required academic_level to "
+                    "order this membership."
+                )
+            ],
+        })
+
+
+class ContentTypeField(serializers.SlugRelatedField):
+    """
+    Content type given by its model name. Content types of the orderable
+    products are read from the content types cache instead of the database.
+    """
+
+    def get_attribute(self, instance):
+        return ContentType.objects.get_for_id(instance.content_type_id)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and data in ORDERABLE_PRODUCTS:
+            return ContentType.objects.get_for_model(ORDERABLE_PRODUCTS[data])
+        return super(ContentTypeField, self).to_internal_value(data)
+
+
 class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
-    content_type = serializers.SlugRelatedField(
+    content_type = ContentTypeField(
         queryset=ContentType.objects.all(),
         slug_field='model',
     )
@@ -278,9 +377,6 @@ class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
 
         user = self.context['request'].user
 
-        user_membership = user.membership
-        user_academic_level = user.academic_level
-
         content_type = validated_data.get(
             'content_type',
             getattr(self.instance, 'content_type', None)
@@ -298,36 +394,14 @@ class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
                 ],
             })
 
-        if (not user.is_staff
-                and (content_type.model == 'package'
-                     or content_type.model == 'retirement')
-                and obj.exclusive_memberships.all()
-                and user_membership not in obj.exclusive_memberships.all()):
-            raise serializers.ValidationError({
-                'object_id': [
-                    _(
-                        "User does not have the required membership to order "
-                        "this package."
-                    )
-                ],
-            })
-        if (not user.is_staff and
-                content_type.model == 'membership' and
-                obj.academic_levels.all() and
-                user_academic_level not in obj.academic_levels.all()):
-            raise serializers.ValidationError({
-                'object_id': [
-                    _(
-                        "User does not have the required academic_level to "
-                        "order this membership."
-                    )
-                ],
-            })
+        validate_product_for_user(user, content_type.model, obj)
 
         if (content_type.model == 'membership'
                 or content_type.model == 'package'
                 or content_type.model == 'retirement'):
             attrs['cost'] = obj.price * validated_data.get('quantity')
+        # Keep the product fetched for validation to avoid querying it again
+        attrs['content_object'] = obj
 
         return attrs
 
@@ -432,23 +506,39 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                 )
             )
 
+        # Seats and tickets are held by a pending order while the user is
+        # charged, outside of any transaction, then the order is confirmed or
+        # released. Orders that expire are released by the
+        # "release_expired_orders" command.
+        validated_data['status'] = 'P'
+        validated_data['pending_until'] = timezone.now() + timedelta(
+            minutes=settings.LOCAL_SETTINGS['PENDING_ORDER_LIFETIME_MINUTES']
+        )
+
         with transaction.atomic():
             coupon = validated_data.pop('coupon', None)
             order = Order.objects.create(**validated_data)
             charge_response = None
             discount_amount = 0
-            for orderline_data in orderlines_data:
-                OrderLine.objects.create(order=order, **orderline_data)
+            new_orderlines = [
+                OrderLine(order=order, **orderline_data)
+                for orderline_data in orderlines_data
+            ]
 
             if coupon:
-                coupon_info = validate_coupon_for_order(coupon, order)
+                coupon_info = validate_coupon_for_order(
+                    coupon,
+                    user,
+                    new_orderlines,
+                )
+                if coupon_info['valid_use'] and not use_coupon(coupon, user):
+                    coupon_info['valid_use'] = False
+                    coupon_info['error'] = {
+                        'non_field_errors': [_(
+                            "Maximum number of uses exceeded for this coupon."
+                        )]
+                    }
                 if coupon_info['valid_use']:
-                    coupon_user = CouponUser.objects.get(
-                        user=user,
-                        coupon=coupon,
-                    )
-                    coupon_user.uses = coupon_user.uses + 1
-                    coupon_user.save()
                     discount_amount = coupon_info['value']
                     orderline_cost = coupon_info['orderline'].cost
                     coupon_info['orderline'].cost = (
@@ -459,28 +549,40 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                     coupon_info['orderline'].coupon_real_value = coupon_info[
                         'value'
                     ]
-                    coupon_info['orderline'].save()
                 else:
                     raise serializers.ValidationError(coupon_info['error'])
 
-            amount = order.total_cost
+            OrderLine.objects.bulk_create(new_orderlines)
+            if new_orderlines and new_orderlines[0].pk is None:
+                # Primary keys of bulk created objects are not set on all
+                # databases. Order lines are numbered in insertion order.
+                orderline_ids = order.order_lines.order_by(
+                    'pk'
+                ).values_list('pk', flat=True)
+                for orderline, pk in zip(new_orderlines, orderline_ids):
+                    orderline.pk = pk
+                    orderline._state.adding = False
+            OrderLine.history.bulk_history_create(new_orderlines)
+
+            # Same as Order.total_cost, without querying the order lines
+            amount = sum(
+                orderline.cost * orderline.quantity
+                for orderline in new_orderlines
+                if orderline.product_type in ('membership', 'package',
+                                              'retirement')
+            )
             tax = amount * Decimal(repr(TAX_RATE))
             tax = tax.quantize(Decimal('0.01'))
             amount *= Decimal(repr(TAX_RATE + 1))
             amount = round(amount * 100, 2)
 
-            membership_orderlines = order.order_lines.filter(
-                content_type__model="membership"
-            )
-            package_orderlines = order.order_lines.filter(
-                content_type__model="package"
-            )
-            reservation_orderlines = order.order_lines.filter(
-                content_type__model="timeslot"
-            )
-            retirement_orderlines = order.order_lines.filter(
-                content_type__model="retirement"
-            )
+            orderlines_by_type = defaultdict(list)
+            for orderline in new_orderlines:
+                orderlines_by_type[orderline.product_type].append(orderline)
+            membership_orderlines = orderlines_by_type['membership']
+            package_orderlines = orderlines_by_type['package']
+            reservation_orderlines = orderlines_by_type['timeslot']
+            retirement_orderlines = orderlines_by_type['retirement']
             need_transaction = False
 
             if membership_orderlines:
@@ -492,24 +594,43 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                             "You already have an active membership."
                         )]
                     })
-                user.membership = membership_orderlines[0].content_object
-                user.membership_end = (
-                    timezone.now().date() + user.membership.duration
-                )
-                user.save()
             if package_orderlines:
                 need_transaction = True
-                for package_orderline in package_orderlines:
-                    user.tickets += (
-                        package_orderline.content_object.reservations *
-                        package_orderline.quantity
-                    )
-                    user.save()
+                package_tickets = sum(
+                    package_orderline.content_object.reservations *
+                    package_orderline.quantity
+                    for package_orderline in package_orderlines
+                )
+                user.tickets += package_tickets
+                update_tickets({user.id: package_tickets}, 'P')
             if reservation_orderlines:
+                active_reservations = Q(
+                    reservations__is_active=True,
+                    reservations__deleted__isnull=True,
+                )
+                timeslots = TimeSlot.objects.filter(
+                    pk__in=[
+                        orderline.object_id
+                        for orderline in reservation_orderlines
+                    ],
+                ).select_related('period__workplace').annotate(
+                    reserved=Count(
+                        'reservations',
+                        filter=active_reservations,
+                        distinct=True,
+                    ),
+                    reserved_by_user=Count(
+                        'reservations',
+                        filter=(
+                            active_reservations &
+                            Q(reservations__user=user)
+                        ),
+                        distinct=True,
+                    ),
+                ).in_bulk()
+                new_reservations = []
                 for reservation_orderline in reservation_orderlines:
-                    timeslot = reservation_orderline.content_object
-                    reservations = timeslot.reservations.filter(is_active=True)
-                    reserved = reservations.count()
+                    timeslot = timeslots[reservation_orderline.object_id]
                     if timeslot.price > user.tickets:
                         raise serializers.ValidationError({
                             'non_field_errors': [_(
@@ -517,7 +638,7 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                                 "reservation."
                             )]
                         })
-                    if reservations.filter(user=user):
+                    if timeslot.reserved_by_user:
                         raise serializers.ValidationError({
                             'non_field_errors': [_(
                                 "You already are registered to this timeslot: "
@@ -525,18 +646,20 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                             )]
                         })
                     if (timeslot.period.workplace and
-                            timeslot.period.workplace.seats - reserved > 0):
-                        Reservation.objects.create(
+                            timeslot.period.workplace.seats -
+                            timeslot.reserved > 0):
+                        new_reservations.append(Reservation(
                             user=user,
                             timeslot=timeslot,
                             is_active=True
-                        )
+                        ))
                         # Decrement user tickets for each reservation.
                         # OrderLine's quantity and TimeSlot's price will be
                         # used in the future if we want to allow multiple
                         # reservations of the same timeslot.
                         user.tickets -= 1
-                        user.save()
+                        # A timeslot can't be reserved twice in the order
+                        timeslot.reserved_by_user += 1
                     else:
                         raise serializers.ValidationError({
                             'non_field_errors': [_(
@@ -544,6 +667,26 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                                 "timeslot."
                             )]
                         })
+                bulk_create_reservations(
+                    Reservation,
+                    new_reservations,
+                    'timeslot_id',
+                )
+                # The balance is checked again by the debit, in case
+                # tickets were spent by a concurrent order.
+                try:
+                    update_tickets({user.id: -len(new_reservations)}, 'R')
+                except InsufficientTicketsError:
+                    raise serializers.ValidationError({
+                        'non_field_errors': [_(
+                            "You don't have enough tickets to make this "
+                            "reservation."
+                        )]
+                    })
+                adjust_availability({
+                    reservation.timeslot_id: 1
+                    for reservation in new_reservations
+                })
             if retirement_orderlines:
                 need_transaction = True
                 if not (user.phone and user.city):
@@ -555,39 +698,59 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                         )]
                     })
 
+                active_reservations = Q(
+                    reservations__is_active=True,
+                    reservations__deleted__isnull=True,
+                )
+                retirements = Retirement.objects.filter(
+                    pk__in=[
+                        orderline.object_id
+                        for orderline in retirement_orderlines
+                    ],
+                ).annotate(
+                    reserved=Count(
+                        'reservations',
+                        filter=active_reservations,
+                        distinct=True,
+                    ),
+                    reserved_by_user=Count(
+                        'reservations',
+                        filter=(
+                            active_reservations &
+                            Q(reservations__user=user)
+                        ),
+                        distinct=True,
+                    ),
+                    user_notified=Count(
+                        'wait_queue_notifications',
+                        filter=Q(wait_queue_notifications__user=user),
+                        distinct=True,
+                    ),
+                ).in_bulk()
+                new_reservations = []
                 for retirement_orderline in retirement_orderlines:
-                    retirement = retirement_orderline.content_object
-                    user_waiting = retirement.wait_queue.filter(user=user)
-                    reservations = retirement.reservations.filter(
-                        is_active=True
-                    )
-                    reserved = reservations.count()
-                    if reservations.filter(user=user):
+                    retirement = retirements[retirement_orderline.object_id]
+                    if retirement.reserved_by_user:
                         raise serializers.ValidationError({
                             'non_field_errors': [_(
                                 "You already are registered to this "
                                 "retirement: {0}.".format(str(retirement))
                             )]
                         })
-                    if (((retirement.seats - retirement.total_reservations -
+                    # Reserved seats are only decremented once the order is
+                    # confirmed.
+                    if (((retirement.seats - retirement.reserved -
                           retirement.reserved_seats) > 0)
                             or (retirement.reserved_seats
-                                and WaitQueueNotification.objects.filter(
-                                    user=user, retirement=retirement))):
-                        retirement_reservations.append(
-                            RetirementReservation.objects.create(
-                                user=user,
-                                retirement=retirement,
-                                order_line=retirement_orderline,
-                                is_active=True
-                            )
-                        )
-                        # Decrement reserved_seats if > 0
-                        if retirement.reserved_seats:
-                            retirement.reserved_seats = (
-                                retirement.reserved_seats - 1
-                            )
-                            retirement.save()
+                                and retirement.user_notified)):
+                        new_reservations.append(RetirementReservation(
+                            user=user,
+                            retirement=retirement,
+                            order_line=retirement_orderline,
+                            is_active=True
+                        ))
+                        # A retirement can't be reserved twice in the order
+                        retirement.reserved_by_user += 1
                     else:
                         raise serializers.ValidationError({
                             'non_field_errors': [_(
@@ -595,157 +758,233 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                                 "retirement."
                             )]
                         })
-                    if user_waiting:
-                        user_waiting.delete()
+                retirement_reservations = bulk_create_reservations(
+                    RetirementReservation,
+                    new_reservations,
+                    'retirement_id',
+                )
 
+            if (need_transaction and int(amount) and
+                    not (payment_token or single_use_token)):
+                raise serializers.ValidationError({
+                    'non_field_errors': [_(
+                        "A payment_token or single_use_token is required to "
+                        "create an order."
+                    )]
+                })
+
+        try:
             if need_transaction and payment_token and int(amount):
                 # Charge the order with the external payment API
-                try:
-                    charge_response = charge_payment(
-                        int(round(amount)),
-                        payment_token,
-                        str(order.id)
-                    )
-                except PaymentAPIError as err:
-                    raise serializers.ValidationError({
-                        'non_field_errors': [err]
-                    })
-
+                charge_response = charge_payment(
+                    int(round(amount)),
+                    payment_token,
+                    str(order.id)
+                )
             elif need_transaction and single_use_token and int(amount):
                 # Add card to the external profile & charge user
+                card_create_response = create_external_card(
+                    profile.external_api_id,
+                    single_use_token
+                )
+                charge_response = charge_payment(
+                    int(round(amount)),
+                    card_create_response.json()['paymentToken'],
+                    str(order.id)
+                )
+        except PaymentAPIError as err:
+            release_order(order)
+            raise serializers.ValidationError({
+                'non_field_errors': [err]
+            })
+        except Exception:
+            release_order(order)
+            raise
+
+        if charge_response:
+            # A charged order keeps its charge reference even if it can't be
+            # confirmed, so that it is never released without a refund.
+            charge_res_content = charge_response.json()
+            charge = dict(
+                authorization_id=charge_res_content['id'],
+                settlement_id=charge_res_content['settlements'][0]['id'],
+                reference_number=charge_res_content['merchantRefNum'],
+            )
+            is_charged = Order.objects.filter(
+                pk=order.pk,
+                status='P',
+            ).update(**charge)
+            if not is_charged:
+                # The order expired and was released while the user was
+                # charged.
                 try:
-                    card_create_response = create_external_card(
-                        profile.external_api_id,
-                        single_use_token
-                    )
-                    charge_response = charge_payment(
-                        int(round(amount)),
-                        card_create_response.json()['paymentToken'],
-                        str(order.id)
+                    refund_amount(charge['settlement_id'], int(round(amount)))
+                except PaymentAPIError:
+                    # The charge is kept in a failed order, without order
+                    # lines, to be refunded by an admin.
+                    Order.objects.create(
+                        user=user,
+                        transaction_date=timezone.now(),
+                        status='F',
+                        **charge
                     )
-                except PaymentAPIError as err:
                     raise serializers.ValidationError({
-                        'non_field_errors': [err]
+                        'non_field_errors': [_(
+                            "Your order expired before the payment was "
+                            "completed. You will be refunded shortly."
+                        )]
                     })
-            elif (membership_orderlines
-                  or package_orderlines
-                  or retirement_orderlines) and int(amount):
                 raise serializers.ValidationError({
                     'non_field_errors': [_(
-                        "A payment_token or single_use_token is required to "
-                        "create an order."
+                        "Your order expired before the payment was completed. "
+                        "You have not been charged."
                     )]
                 })
 
-            if need_transaction:
-                if charge_response:
-                    charge_res_content = charge_response.json()
-                    order.authorization_id = charge_res_content['id']
-                    order.settlement_id = charge_res_content['settlements'][0][
-                        'id'
-                    ]
-                    order.reference_number = charge_res_content[
-                        'merchantRefNum'
-                    ]
-                else:
-                    charge_res_content = {
-                        'card': {
-                            'lastDigits': None,
-                            'type': "NONE"
-                        }
-                    }
-                    order.authorization_id = 0
-                    order.settlement_id = 0
-                    order.reference_number = "charge-" + str(uuid.uuid4())
-                order.save()
-
-        if need_transaction:
-            # Send order email
-            orderlines = order.order_lines.filter(
-                models.Q(content_type__model='membership') |
-                models.Q(content_type__model='package') |
-                models.Q(content_type__model='retirement')
-            )
-
-            # Here, the 'details' key is used to provide details of the
-            #  item to the email template.
-            # As of now, only 'retirement' objects have the 'email_content'
-            #  key that is used here. There is surely a better way to
-            #  to handle that logic that will be more generic.
-            items = [
-                {
-                    'price': orderline.content_object.price,
-                    'name': "{0}: {1}".format(
-                        str(orderline.content_type),
-                        orderline.content_object.name
-                    ),
-                    # Removed details section because it was only used
-                    # for retirements. Retirements instead have another
-                    # unique email containing details of the event.
-                    # 'details':
-                    #    orderline.content_object.email_content if hasattr(
-                    #         orderline.content_object, 'email_content'
-                    #     ) else ""
-                } for orderline in orderlines
-            ]
-
-            # Send order confirmation email
-            merge_data = {
-                'STATUS': "APPROUVÉE",
-                'CARD_NUMBER': charge_res_content['card']['lastDigits'],
-                'CARD_TYPE': PAYSAFE_CARD_TYPE[
-                    charge_res_content['card']['type']
-                ],
-                'DATETIME': timezone.localtime().strftime("%x %X"),
-                'ORDER_ID': order.id,
-                'CUSTOMER_NAME': user.first_name + " " + user.last_name,
-                'CUSTOMER_EMAIL': user.email,
-                'CUSTOMER_NUMBER': user.id,
-                'AUTHORIZATION': order.authorization_id,
-                'TYPE': "Achat",
-                'ITEM_LIST': items,
-                'TAX': tax,
-                'DISCOUNT': discount_amount,
-                'COUPON': coupon,
-                'SUBTOTAL': round(amount / 100 - tax, 2),
-                'COST': round(amount / 100, 2),
-            }
-
-            plain_msg = render_to_string("invoice.txt", merge_data)
-            msg_html = render_to_string("invoice.html", merge_data)
+        with transaction.atomic():
+            # The order may have expired and been released while it was
+            # processed.
+            is_pending = Order.objects.select_for_update().filter(
+                pk=order.pk,
+                status='P',
+            ).exists()
+            if not is_pending:
+                raise serializers.ValidationError({
+                    'non_field_errors': [_(
+                        "Your order expired before the payment was completed. "
+                        "You have not been charged."
+                    )]
+                })
 
-            send_mail(
-                "Confirmation d'achat",
-                plain_msg,
-                settings.DEFAULT_FROM_EMAIL,
-                [order.user.email],
-                html_message=msg_html,
-            )
+            if membership_orderlines:
+                user.membership = membership_orderlines[0].content_object
+                user.membership_end = (
+                    timezone.now().date() + user.membership.duration
+                )
+                user.save(update_fields=['membership', 'membership_end'])
+            for retirement_reservation in retirement_reservations:
+                # Decrement reserved_seats if > 0
+                Retirement.objects.filter(
+                    pk=retirement_reservation.retirement_id,
+                    reserved_seats__gt=0,
+                ).update(reserved_seats=F('reserved_seats') - 1)
+                retirement_reservation.retirement.wait_queue.filter(
+                    user=user
+                ).delete()
+
+            if charge_response:
+                charge_res_content = charge_response.json()
+                order.authorization_id = charge_res_content['id']
+                order.settlement_id = charge_res_content['settlements'][0][
+                    'id'
+                ]
+                order.reference_number = charge_res_content[
+                    'merchantRefNum'
+                ]
+            elif need_transaction:
+                charge_res_content = {
+                    'card': {
+                        'lastDigits': None,
+                        'type': "NONE"
+                    }
+                }
+                order.authorization_id = 0
+                order.settlement_id = 0
+                order.reference_number = "charge-" + str(uuid.uuid4())
+            order.status = 'C'
+            order.pending_until = None
+            order.save()
 
-        # Send retirement informations emails
-        for retirement_reservation in retirement_reservations:
-            # Send info email
-            merge_data = {
-                'RETIREMENT': retirement_reservation.retirement,
-                'USER': user,
-            }
+            if need_transaction:
+                # Send order email
+                invoiced_orderlines = [
+                    orderline for orderline in new_orderlines
+                    if orderline.product_type in ('membership',
+                                                  'package',
+                                                  'retirement')
+                ]
+
+                # Here, the 'details' key is used to provide details of the
+                #  item to the email template.
+                # As of now, only 'retirement' objects have the 'email_content'
+                #  key that is used here. There is surely a better way to
+                #  to handle that logic that will be more generic.
+                items = [
+                    {
+                        'price': orderline.content_object.price,
+                        'name': "{0}: {1}".format(
+                            str(orderline.content_type),
+                            orderline.content_object.name
+                        ),
+                        # Removed details section because it was only used
+                        # for retirements. Retirements instead have another
+                        # unique email containing details of the event.
+                        # 'details':
+                        #    orderline.content_object.email_content if hasattr(
+                        #         orderline.content_object, 'email_content'
+                        #     ) else ""
+                    } for orderline in invoiced_orderlines
+                ]
+
+                # Send order confirmation email
+                merge_data = {
+                    'STATUS': "APPROUVÉE",
+                    'CARD_NUMBER': charge_res_content['card']['lastDigits'],
+                    'CARD_TYPE': PAYSAFE_CARD_TYPE[
+                        charge_res_content['card']['type']
+                    ],
+                    'DATETIME': timezone.localtime().strftime("%x %X"),
+                    'ORDER_ID': order.id,
+                    'CUSTOMER_NAME': user.first_name + " " + user.last_name,
+                    'CUSTOMER_EMAIL': user.email,
+                    'CUSTOMER_NUMBER': user.id,
+                    'AUTHORIZATION': order.authorization_id,
+                    'TYPE': "Achat",
+                    'ITEM_LIST': items,
+                    'TAX': tax,
+                    'DISCOUNT': discount_amount,
+                    'COUPON': coupon,
+                    'SUBTOTAL': round(amount / 100 - tax, 2),
+                    'COST': round(amount / 100, 2),
+                }
+
+                plain_msg = render_to_string("invoice.txt", merge_data)
+                msg_html = render_to_string("invoice.html", merge_data)
+
+                queue_mail(
+                    "Confirmation d'achat",
+                    plain_msg,
+                    settings.DEFAULT_FROM_EMAIL,
+                    [order.user.email],
+                    html_message=msg_html,
+                    on_commit=True,
+                )
 
-            plain_msg = render_to_string(
-                "retirement_info.txt",
-                merge_data
-            )
-            msg_html = render_to_string(
-                "retirement_info.html",
-                merge_data
-            )
+            # Send retirement informations emails
+            for retirement_reservation in retirement_reservations:
+                # Send info email
+                merge_data = {
+                    'RETIREMENT': retirement_reservation.retirement,
+                    'USER': user,
+                }
+
+                plain_msg = render_to_string(
+                    "retirement_info.txt",
+                    merge_data
+                )
+                msg_html = render_to_string(
+                    "retirement_info.html",
+                    merge_data
+                )
 
-            send_mail(
-                "Confirmation d'inscription à la retraite",
-                plain_msg,
-                settings.DEFAULT_FROM_EMAIL,
-                [retirement_reservation.user.email],
-                html_message=msg_html,
-            )
+                queue_mail(
+                    "Confirmation d'inscription à la retraite",
+                    plain_msg,
+                    settings.DEFAULT_FROM_EMAIL,
+                    [retirement_reservation.user.email],
+                    html_message=msg_html,
+                    on_commit=True,
+                )
 
         return order
 
@@ -763,7 +1002,7 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Order
-        fields = '__all__'
+        exclude = ('status', 'pending_until', )
         extra_kwargs = {
             'transaction_date': {
                 'read_only': True,
@@ -774,6 +1013,81 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
+class OrderLineQuoteSerializer(serializers.Serializer):
+    content_type = serializers.ChoiceField(
+        choices=list(ORDERABLE_PRODUCTS),
+        error_messages={
+            'invalid_choice': _('Object with model={input} does not exist.'),
+        },
+    )
+    object_id = serializers.IntegerField(min_value=0)
+    quantity = serializers.IntegerField(min_value=0)
+
+
+class OrderQuoteSerializer(serializers.Serializer):
+    """
+    Validates the order lines and the coupon of an order without creating it.
+    Products are fetched with one query by type of product, whatever the
+    number of order lines.
+    """
+    order_lines = OrderLineQuoteSerializer(many=True)
+    coupon = serializers.SlugRelatedField(
+        slug_field='code',
+        queryset=Coupon.objects.all(),
+        allow_null=True,
+        required=False,
+    )
+
+    def validate_order_lines(self, orderlines_data):
+        """
+        Build unsaved order lines linked to their products, and priced as they
+        would be by OrderLineSerializer.
+        """
+        user = self.context['request'].user
+
+        product_ids = defaultdict(set)
+        for orderline_data in orderlines_data:
+            product_ids[orderline_data['content_type']].add(
+                orderline_data['object_id']
+            )
+        products = {}
+        for model_name, ids in product_ids.items():
+            queryset = ORDERABLE_PRODUCTS[model_name].objects.filter(
+                pk__in=ids,
+            )
+            if model_name in ('package', 'retirement'):
+                queryset = queryset.prefetch_related('exclusive_memberships')
+            elif model_name == 'membership':
+                queryset = queryset.prefetch_related('academic_levels')
+            products[model_name] = {
+                product.pk: product for product in queryset
+            }
+
+        orderlines = []
+        for orderline_data in orderlines_data:
+            model_name = orderline_data['content_type']
+            product = products[model_name].get(orderline_data['object_id'])
+            if product is None:
+                raise serializers.ValidationError({
+                    'object_id': [
+                        _("The referenced object does not exist.")
+                    ],
+                })
+            validate_product_for_user(user, model_name, product)
+
+            orderline = OrderLine(
+                content_type=ContentType.objects.get_for_model(product),
+                object_id=product.pk,
+                quantity=orderline_data['quantity'],
+            )
+            orderline.content_object = product
+            if model_name in ('membership', 'package', 'retirement'):
+                orderline.cost = product.price * orderline.quantity
+            orderlines.append(orderline)
+
+        return orderlines
+
+
 class CouponSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
     applicable_product_types = serializers.SlugRelatedField(
@@ -786,7 +1100,7 @@ class CouponSerializer(serializers.HyperlinkedModelSerializer):
         allow_blank=True,
         required=False,
         validators=[
-            UniqueValidator(queryset=Coupon.objects.all()),
+            UniqueValidator(queryset=Coupon.all_objects.all()),
         ]
     )
     value = serializers.DecimalField(
@@ -832,26 +1146,39 @@ class CouponSerializer(serializers.HyperlinkedModelSerializer):
     def create(self, validated_data):
         """
         Generate coupon's code and create the coupon.
+
+        A code can be used by another request between its validation and the
+        creation of the coupon: a generated code is then replaced by a new
+        one, a given code is rejected.
         """
-        code = validated_data.get('code', None)
-
-        used_code = Coupon.objects.all().values_list('code', flat=True)
-        n = 0
-        while ((not code or code in used_code) and (n < 100)):
-            code = ''.join(
-                random.choices(
-                    string.ascii_uppercase.replace("O", "").replace("I", "") +
-                    string.digits.replace("0", ""),
-                    k=8))
-            n += 1
-        if n >= 100:
-            raise serializers.ValidationError({
-                'non_field_errors': [_(
-                    "Can't generate new unique codes. Delete old coupons."
-                )]
-            })
-        validated_data['code'] = code
-        return super(CouponSerializer, self).create(validated_data)
+        if validated_data.get('code', None):
+            try:
+                with transaction.atomic():
+                    return super(CouponSerializer, self).create(
+                        validated_data
+                    )
+            except IntegrityError:
+                raise serializers.ValidationError({
+                    'code': [_("coupon with this code already exists.")]
+                })
+
+        for tries in range(COUPON_CREATION_TRIES):
+            codes = generate_coupon_codes(1)
+            if not codes:
+                break
+            validated_data['code'] = codes.pop()
+            try:
+                with transaction.atomic():
+                    return super(CouponSerializer, self).create(
+                        validated_data
+                    )
+            except IntegrityError:
+                continue
+        raise serializers.ValidationError({
+            'non_field_errors': [_(
+                "Can't generate new unique codes. Delete old coupons."
+            )]
+        })
 
     def update(self, instance, validated_data):
 
@@ -885,48 +1212,51 @@ class CouponSerializer(serializers.HyperlinkedModelSerializer):
         return super(CouponSerializer, self).update(instance, validated_data)
 
     def to_representation(self, instance):
+        """
+        Applicable products are listed with their id and name, unless their
+        field is in the "expand" query parameter of a list, e.g.
+        "?expand=applicable_retirements,applicable_timeslots". They are always
+        expanded when a single coupon is retrieved.
+        """
         data = super(CouponSerializer, self).to_representation(instance)
         from workplace.serializers import TimeSlotSerializer
         from retirement.serializers import RetirementSerializer
         action = self.context['view'].action
         if action == 'retrieve' or action == 'list':
-            data['applicable_retirements'] = RetirementSerializer(
-                instance.applicable_retirements,
-                many=True,
-                context={
-                    'request': self.context['request'],
-                    'view': self.context['view'],
-                },
-            ).data
-            data['applicable_timeslots'] = TimeSlotSerializer(
-                instance.applicable_timeslots,
-                many=True,
-                context={
-                    'request': self.context['request'],
-                    'view': self.context['view'],
-                },
-            ).data
-            data['applicable_packages'] = PackageSerializer(
-                instance.applicable_packages,
-                many=True,
-                context={
-                    'request': self.context['request'],
-                    'view': self.context['view'],
-                },
-            ).data
-            data['applicable_memberships'] = MembershipSerializer(
-                instance.applicable_memberships,
-                many=True,
-                context={
-                    'request': self.context['request'],
-                    'view': self.context['view'],
-                },
-            ).data
+            nested_serializers = {
+                'applicable_retirements': RetirementSerializer,
+                'applicable_timeslots': TimeSlotSerializer,
+                'applicable_packages': PackageSerializer,
+                'applicable_memberships': MembershipSerializer,
+            }
+            if action == 'retrieve':
+                expand = nested_serializers.keys()
+            else:
+                expand = self.context['request'].query_params.get(
+                    'expand',
+                    '',
+                ).split(',')
+            for field, serializer_class in nested_serializers.items():
+                products = getattr(instance, field).all()
+                if field in expand:
+                    data[field] = serializer_class(
+                        products,
+                        many=True,
+                        context={
+                            'request': self.context['request'],
+                            'view': self.context['view'],
+                        },
+                    ).data
+                else:
+                    data[field] = [
+                        {'id': product.id, 'name': product.name}
+                        for product in products
+                    ]
         return data
 
     class Meta:
         model = Coupon
-        exclude = ('deleted', )
+        exclude = ('deleted', 'total_uses', )
         extra_kwargs = {
             'applicable_retirements': {
                 'required': False,
@@ -944,6 +1274,17 @@ class CouponSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
+class CouponBatchSerializer(CouponSerializer):
+    """
+    Attributes shared by a batch of coupons, created with generated codes.
+    """
+    code = serializers.ReadOnlyField()
+    count = serializers.IntegerField(
+        min_value=1,
+        max_value=10000,
+    )
+
+
 class CouponUserSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
 
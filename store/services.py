@@ -1,18 +1,38 @@
+from datetime import timedelta
 from decimal import Decimal
+import functools
+import hashlib
 import json
 import random
 import requests
+import string
 import uuid
 
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db.models import Q
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, prefetch_related_objects
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from safedelete.models import HARD_DELETE
+
+from blitz_api.services import queue_mail, queue_mass_mail, update_tickets
+from retirement.models import Reservation as RetirementReservation
+from workplace.models import Reservation
+from workplace.services import adjust_availability
 
 from .exceptions import PaymentAPIError
-from .models import CouponUser
+from .gateway import get_client
+from .models import (Coupon, CouponUser, IdempotencyKey, Order, PaymentCard,
+                     PaymentProfile)
+
+User = get_user_model()
+
+TAX_RATE = settings.LOCAL_SETTINGS['SELLING_TAX']
 
 
 ###############################################################################
@@ -123,21 +143,17 @@ def charge_payment(amount, payment_token, reference_number):
     }
 
     try:
-        r = requests.post(
-            auth_url,
-            auth=(
-                settings.PAYSAFE['USER'],
-                settings.PAYSAFE['PASSWORD'],
-            ),
-            json=data,
-        )
+        r = get_client().post('card.auths', auth_url, json=data)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         try:
             print(json.loads(err.response.content))
             err_code = json.loads(err.response.content)['error']['code']
             if err_code in PAYSAFE_EXCEPTION:
-                raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+                raise PaymentAPIError(
+                    PAYSAFE_EXCEPTION[err_code],
+                    code=err_code,
+                )
         except json.decoder.JSONDecodeError as err:
             print(err.response)
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
@@ -145,15 +161,19 @@ def charge_payment(amount, payment_token, reference_number):
     return r
 
 
-def refund_amount(settlement_id, amount):
+def refund_amount(settlement_id, amount, merchant_ref_num=None):
     """
     This method is used to refund an amount to the same card that was used for
     buying the products contained in the order.
     This is tigthly coupled with Paysafe for now, but this should be made
     generic in the future to ease migrations to another payment patform.
 
-    settlement_id: ID for the Paysafe settlement
-    amount:        Positive number representing the amount to be refunded back
+    settlement_id:    ID for the Paysafe settlement
+    amount:           Positive number representing the amount to be refunded
+                      back
+    merchant_ref_num: Reference of the refund, generated if not provided. A
+                      refund retried with the same reference is not issued
+                      twice by Paysafe.
     """
     refund_url = '{0}{1}{2}{3}{4}'.format(
         settings.PAYSAFE['BASE_URL'],
@@ -164,18 +184,16 @@ def refund_amount(settlement_id, amount):
     )
 
     data = {
-        "merchantRefNum": "refund-" + str(uuid.uuid4()),
+        "merchantRefNum": merchant_ref_num or "refund-" + str(uuid.uuid4()),
         "amount": amount,
     }
 
     try:
-        r = requests.post(
+        r = get_client().post(
+            'card.refunds',
             refund_url,
-            auth=(
-                settings.PAYSAFE['USER'],
-                settings.PAYSAFE['PASSWORD'],
-            ),
             json=data,
+            idempotent=True,
         )
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
@@ -183,7 +201,10 @@ def refund_amount(settlement_id, amount):
             print(json.loads(err.response.content))
             err_code = json.loads(err.response.content)['error']['code']
             if err_code in PAYSAFE_EXCEPTION:
-                raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+                raise PaymentAPIError(
+                    PAYSAFE_EXCEPTION[err_code],
+                    code=err_code,
+                )
         except json.decoder.JSONDecodeError as err:
             print(err.response)
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
@@ -215,12 +236,9 @@ def create_external_payment_profile(user):
     }
 
     try:
-        r = requests.post(
+        r = get_client().post(
+            'vault.create_profile',
             create_profile_url,
-            auth=(
-                settings.PAYSAFE['USER'],
-                settings.PAYSAFE['PASSWORD']
-            ),
             json=data,
         )
         r.raise_for_status()
@@ -228,7 +246,10 @@ def create_external_payment_profile(user):
         print(json.loads(err.response.content))
         err_code = json.loads(err.response.content)['error']['code']
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
     return r
@@ -250,16 +271,16 @@ def get_external_payment_profile(profile_id):
     )
 
     try:
-        r = requests.get(
-            get_profile_url,
-            auth=(settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
-        )
+        r = get_client().get('vault.get_profile', get_profile_url)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         print(json.loads(err.response.content))
         err_code = json.loads(err.response.content)['error']['code']
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
     return r
@@ -287,19 +308,20 @@ def update_external_card(profile_id, card_id, single_use_token):
     }
 
     try:
-        r = requests.put(
-            put_cards_url,
-            auth=(settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
-            json=data,
-        )
+        r = get_client().put('vault.update_card', put_cards_url, json=data)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         print(json.loads(err.response.content))
         err_code = json.loads(err.response.content)['error']['code']
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
+    save_payment_card(profile_id, r.json())
+
     return r
 
 
@@ -324,11 +346,7 @@ def create_external_card(profile_id, single_use_token):
     }
 
     try:
-        r = requests.post(
-            post_cards_url,
-            auth=(settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
-            json=data,
-        )
+        r = get_client().post('vault.create_card', post_cards_url, json=data)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         err = json.loads(err.response.content)
@@ -340,27 +358,52 @@ def create_external_card(profile_id, single_use_token):
                 )
                 card_data = json.loads(r.content)
                 delete_external_card(profile_id, card_data['id'])
-                r = requests.post(
+                r = get_client().post(
+                    'vault.create_card',
                     post_cards_url,
-                    auth=(
-                        settings.PAYSAFE['USER'],
-                        settings.PAYSAFE['PASSWORD']
-                    ),
                     json=data,
                 )
                 r.raise_for_status()
+                save_payment_card(profile_id, r.json())
                 return r
             except requests.exceptions.HTTPError as err:
                 if err_code in PAYSAFE_EXCEPTION:
-                    raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+                    raise PaymentAPIError(
+                        PAYSAFE_EXCEPTION[err_code],
+                        code=err_code,
+                    )
                 raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
+    save_payment_card(profile_id, r.json())
+
     return r
 
 
+def format_external_card(card):
+    """
+    This method is used to format a card returned by the external payment API
+    the way it is displayed in payment profiles.
+
+    card:   Card as returned by the external payment API
+    """
+    return {
+        'id': card.get('id'),
+        'card_bin': card.get('cardBin'),
+        'card_expiry': card.get('cardExpiry'),
+        'card_type': card.get('cardType'),
+        'holder_name': card.get('holderName'),
+        'last_digits': card.get('lastDigits'),
+        'payment_token': card.get('paymentToken'),
+        'status': card.get('status'),
+    }
+
+
 def get_external_cards(profile_id):
     """
     This method is used to get cards of a payment profile from an external
@@ -372,20 +415,7 @@ def get_external_cards(profile_id):
     """
     profile = get_external_payment_profile(profile_id).json()
 
-    cards = list()
-
-    for idx, card in enumerate(profile['cards']):
-        cards.insert(idx, dict())
-        cards[idx]['id'] = card.get('id')
-        cards[idx]['card_bin'] = card.get('cardBin')
-        cards[idx]['card_expiry'] = card.get('cardExpiry')
-        cards[idx]['card_type'] = card.get('cardType')
-        cards[idx]['holder_name'] = card.get('holderName')
-        cards[idx]['last_digits'] = card.get('lastDigits')
-        cards[idx]['payment_token'] = card.get('paymentToken')
-        cards[idx]['status'] = card.get('status')
-
-    return cards
+    return [format_external_card(card) for card in profile['cards']]
 
 
 def get_external_card(card_id):
@@ -404,15 +434,15 @@ def get_external_card(card_id):
     )
 
     try:
-        r = requests.get(
-            get_card_url,
-            auth=(settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
-        )
+        r = get_client().get('vault.get_card', get_card_url)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         err_code = json.loads(err.response.content)['error']['code']
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
     return r
@@ -435,38 +465,235 @@ def delete_external_card(profile_id, card_id):
     )
 
     try:
-        r = requests.delete(
-            delete_card_url,
-            auth=(settings.PAYSAFE['USER'], settings.PAYSAFE['PASSWORD']),
-        )
+        r = get_client().delete('vault.delete_card', delete_card_url)
         r.raise_for_status()
     except requests.exceptions.HTTPError as err:
         print(json.loads(err.response.content))
         err_code = json.loads(err.response.content)['error']['code']
         if err_code in PAYSAFE_EXCEPTION:
-            raise PaymentAPIError(PAYSAFE_EXCEPTION[err_code])
+            raise PaymentAPIError(
+                PAYSAFE_EXCEPTION[err_code],
+                code=err_code,
+            )
         raise PaymentAPIError(PAYSAFE_EXCEPTION['unknown'])
 
+    PaymentCard.objects.filter(
+        payment_profile__external_api_id=profile_id,
+        external_api_id=card_id,
+    ).delete()
+
     return r
 
 
+###############################################################################
+#                       LOCAL COPY OF EXTERNAL CARDS                          #
+###############################################################################
+
+
+def _get_payment_card_fields(card):
+    card_expiry = card.get('card_expiry') or {}
+    return {
+        'card_bin': card.get('card_bin'),
+        'card_expiry_month': card_expiry.get('month'),
+        'card_expiry_year': card_expiry.get('year'),
+        'card_type': card.get('card_type'),
+        'holder_name': card.get('holder_name'),
+        'last_digits': card.get('last_digits'),
+        'payment_token': card.get('payment_token'),
+        'status': card.get('status'),
+    }
+
+
+def save_payment_card(profile_id, card):
+    """
+    This method is used to keep the local copy of a card up to date after it
+    has been added or updated in the external payment API.
+
+    profile_id: External profile ID
+    card:       Card as returned by the external payment API
+    """
+    card = format_external_card(card)
+    profiles = PaymentProfile.objects.filter(external_api_id=profile_id)
+    for profile in profiles:
+        PaymentCard.objects.update_or_create(
+            payment_profile=profile,
+            external_api_id=card['id'],
+            defaults=_get_payment_card_fields(card),
+        )
+
+
+def sync_external_cards(profile_id):
+    """
+    This method is used to replace the local copy of the cards of a payment
+    profile with the cards stored in the external payment API.
+
+    profile_id:   External profile ID
+
+    Returns the cards formatted like get_external_cards does.
+    """
+    cards = get_external_cards(profile_id)
+
+    with transaction.atomic():
+        profiles = list(
+            PaymentProfile.objects.filter(external_api_id=profile_id)
+        )
+        PaymentCard.objects.filter(payment_profile__in=profiles).delete()
+        PaymentCard.objects.bulk_create([
+            PaymentCard(
+                payment_profile=profile,
+                external_api_id=card['id'],
+                **_get_payment_card_fields(card)
+            ) for profile in profiles for card in cards
+        ])
+        PaymentProfile.objects.filter(
+            id__in=[profile.id for profile in profiles]
+        ).update(cards_synced_at=timezone.now())
+
+    return cards
+
+
 ###############################################################################
 #                               OTHER SERVICES                                #
 ###############################################################################
 
 
-def validate_coupon_for_order(coupon, order):
+# Coupon fields listing the products, by type, to which a coupon applies
+COUPON_APPLICABLE_PRODUCTS = {
+    'package': 'applicable_packages',
+    'timeslot': 'applicable_timeslots',
+    'membership': 'applicable_memberships',
+    'retirement': 'applicable_retirements',
+}
+
+# Characters of generated coupon codes, without the ambiguous O, I and 0
+COUPON_CODE_CHARACTERS = (
+    string.ascii_uppercase.replace("O", "").replace("I", "") +
+    string.digits.replace("0", "")
+)
+COUPON_CODE_LENGTH = 8
+
+# Coupons and codes are handled by chunks to stay below the number of query
+# parameters allowed by the database.
+COUPON_BATCH_SIZE = 500
+
+# Coupons whose generated codes were used by a concurrent request first are
+# created again with new codes, at most this number of times.
+COUPON_CREATION_TRIES = 5
+
+
+def generate_coupon_codes(count, max_tries=100):
+    """
+    Generate random codes that are not used by any coupon, deleted or not.
+
+    Codes colliding with existing ones are generated again, at most max_tries
+    times. Returns a set that holds less than count codes if there are not
+    enough unused codes left.
+    """
+    codes = set()
+    tries = 0
+    while len(codes) < count and tries < max_tries:
+        candidates = list(set(
+            ''.join(random.choices(COUPON_CODE_CHARACTERS,
+                                   k=COUPON_CODE_LENGTH))
+            for i in range(count - len(codes))
+        ) - codes)
+        for start in range(0, len(candidates), COUPON_BATCH_SIZE):
+            chunk = candidates[start:start + COUPON_BATCH_SIZE]
+            used_codes = Coupon.all_objects.filter(
+                code__in=chunk,
+            ).values_list('code', flat=True)
+            codes.update(set(chunk) - set(used_codes))
+        tries += 1
+    return codes
+
+
+def create_coupons(codes, **attrs):
+    """
+    Create a coupon for each code, all with the same attributes. Products to
+    which the coupons apply are given as lists of instances under the name of
+    their many-to-many field.
+
+    Coupons, their history and their applicable products are inserted in bulk
+    by chunks of COUPON_BATCH_SIZE. Returns the created coupons.
+    """
+    m2m_fields = [
+        field for field in Coupon._meta.many_to_many
+        if field.name in attrs
+    ]
+    attrs = dict(attrs)
+    m2m_values = {field.name: attrs.pop(field.name) for field in m2m_fields}
+    codes = list(codes)
+
+    with transaction.atomic():
+        Coupon.objects.bulk_create(
+            [Coupon(code=code, **attrs) for code in codes],
+            batch_size=COUPON_BATCH_SIZE,
+        )
+        # Primary keys of bulk created objects are not set on all databases
+        coupons = []
+        for start in range(0, len(codes), COUPON_BATCH_SIZE):
+            coupons += Coupon.objects.filter(
+                code__in=codes[start:start + COUPON_BATCH_SIZE],
+            )
+        Coupon.history.bulk_history_create(
+            coupons,
+            batch_size=COUPON_BATCH_SIZE,
+        )
+
+        for field in m2m_fields:
+            through = field.remote_field.through
+            through.objects.bulk_create(
+                [
+                    through(**{
+                        field.m2m_field_name(): coupon,
+                        field.m2m_reverse_field_name(): related,
+                    })
+                    for coupon in coupons
+                    for related in m2m_values[field.name]
+                ],
+                batch_size=COUPON_BATCH_SIZE,
+            )
+
+    return coupons
+
+
+def create_generated_coupons(count, **attrs):
     """
-    coupon: Coupon model instance
-    order: Order model instance
+    Create count coupons with generated codes, all with the same attributes
+    (see create_coupons).
+
+    Codes are checked against existing coupons when generated, but another
+    request can use them before the coupons are inserted: the coupons are
+    then created again with new codes. Returns the created coupons, or an
+    empty list if not enough unused codes could be generated.
+    """
+    for tries in range(COUPON_CREATION_TRIES):
+        codes = generate_coupon_codes(count)
+        if len(codes) < count:
+            break
+        try:
+            with transaction.atomic():
+                return create_coupons(codes, **attrs)
+        except IntegrityError:
+            continue
+    return []
+
+
+def validate_coupon_for_order(coupon, user, orderlines):
+    """
+    coupon:     Coupon model instance
+    user:       User model instance using the coupon
+    orderlines: OrderLine model instances, saved or not
+
+    Nothing is written to the database and the number of queries does not
+    depend on the number of order lines.
 
-    THIS DOES NOT RECORD COUPON USE. Linked CouponUser instance needs to be
-    updated outside of this function!
+    THIS DOES NOT RECORD COUPON USE. Use "use_coupon" once the order is
+    created to record it!
 
     Returns a dict containing informations concerning the coupon use.
     """
     now = timezone.now()
-    user = order.user
     coupon_info = {
         'valid_use': False,
         'error': None,
@@ -500,18 +727,13 @@ def validate_coupon_for_order(coupon, order):
         return coupon_info
 
     # Check if the maximum number of use for this coupon is exceeded
-    coupon_user, created = CouponUser.objects.get_or_create(
+    user_uses = CouponUser.objects.filter(
         coupon=coupon,
         user=user,
-        defaults={'uses': 0},
-    )
-    total_coupon_uses = CouponUser.objects.filter(coupon=coupon)
-    total_coupon_uses = sum(
-        total_coupon_uses.values_list('uses', flat=True)
-    )
-    valid_use = coupon_user.uses < coupon.max_use_per_user
+    ).values_list('uses', flat=True).first() or 0
+    valid_use = user_uses < coupon.max_use_per_user
     valid_use = valid_use or not coupon.max_use_per_user
-    valid_use = valid_use and (total_coupon_uses < coupon.max_use
+    valid_use = valid_use and (coupon.total_uses < coupon.max_use
                                or not coupon.max_use)
     if not valid_use:
         coupon_info['error'] = {
@@ -522,21 +744,24 @@ def validate_coupon_for_order(coupon, order):
         return coupon_info
 
     # Check if the coupon can be applied to a product in the order
-    applicable_orderlines = order.order_lines.filter(
-        Q(content_type__in=coupon.applicable_product_types.all())
-        | Q(content_type__model='package',
-            object_id__in=coupon.applicable_packages.all().
-            values_list('id', flat=True))
-        | Q(content_type__model='timeslot',
-            object_id__in=coupon.applicable_timeslots.all().
-            values_list('id', flat=True))
-        | Q(content_type__model='membership',
-            object_id__in=coupon.applicable_memberships.all().
-            values_list('id', flat=True))
-        | Q(content_type__model='retirement',
-            object_id__in=coupon.applicable_retirements.all().
-            values_list('id', flat=True))
+    product_types = set(
+        coupon.applicable_product_types.values_list('id', flat=True)
     )
+    ordered_types = set(orderline.product_type for orderline in orderlines)
+    applicable_products = {
+        product_type: set(
+            getattr(coupon, field).values_list('id', flat=True)
+        ) for product_type, field in COUPON_APPLICABLE_PRODUCTS.items()
+        if product_type in ordered_types
+    }
+    applicable_orderlines = [
+        orderline for orderline in orderlines
+        if orderline.content_type_id in product_types or
+        orderline.object_id in applicable_products.get(
+            orderline.product_type,
+            ()
+        )
+    ]
     if not applicable_orderlines:
         coupon_info['error'] = {
             'non_field_errors': [_(
@@ -548,6 +773,7 @@ def validate_coupon_for_order(coupon, order):
     # The coupon is valid and can be used.
     # We find the product to which it applies.
     # We calculate the official amount to be discounted.
+    prefetch_related_objects(applicable_orderlines, 'content_object')
     coupon_info['valid_use'] = True
     most_exp_product = applicable_orderlines[0].content_object
     coupon_info['orderline'] = applicable_orderlines[0]
@@ -569,10 +795,96 @@ def validate_coupon_for_order(coupon, order):
     return coupon_info
 
 
-def notify_for_coupon(email, coupon):
+def quote_order(user, orderlines, coupon=None):
+    """
+    user:       User model instance placing the order
+    orderlines: Unsaved OrderLine model instances, priced and linked to their
+                products
+    coupon:     Coupon model instance to apply, if any
+
+    Compute what the order would cost, as it would be charged when created.
+    Nothing is written to the database.
+
+    Returns a dict containing the order lines, the discount, the tax and the
+    total, or the error if the coupon can't be used.
+    """
+    discount = 0
+    if coupon:
+        coupon_info = validate_coupon_for_order(coupon, user, orderlines)
+        if not coupon_info['valid_use']:
+            return {'error': coupon_info['error']}
+        discount = coupon_info['value']
+        coupon_info['orderline'].cost -= discount
+        coupon_info['orderline'].coupon = coupon
+        coupon_info['orderline'].coupon_real_value = discount
+
+    # Same as Order.total_cost
+    subtotal = sum(
+        orderline.cost * orderline.quantity for orderline in orderlines
+        if orderline.product_type in ('membership', 'package', 'retirement')
+    )
+    tax = (subtotal * Decimal(repr(TAX_RATE))).quantize(Decimal('0.01'))
+    total = subtotal * Decimal(repr(TAX_RATE + 1))
+
+    return {
+        'order_lines': [
+            {
+                'content_type': orderline.product_type,
+                'object_id': orderline.object_id,
+                'quantity': orderline.quantity,
+                'cost': orderline.cost,
+                'coupon': coupon.code if orderline.coupon else None,
+                'coupon_real_value': orderline.coupon_real_value,
+            } for orderline in orderlines
+        ],
+        'discount': discount,
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': total.quantize(Decimal('0.01')),
+    }
+
+
+def use_coupon(coupon, user):
+    """
+    Record a use of the coupon by the user. The counters are incremented by
+    conditional updates, so the limits of the coupon hold even when it is used
+    in concurrent orders.
+
+    Returns False, without recording anything, if the coupon reached its
+    maximum number of uses or the user reached its maximum number of uses.
+    """
+    coupon_user, created = CouponUser.objects.get_or_create(
+        user=user,
+        coupon=coupon,
+        defaults={'uses': 0},
+    )
+
+    with transaction.atomic():
+        coupons = Coupon.objects.filter(pk=coupon.pk)
+        if coupon.max_use:
+            coupons = coupons.filter(total_uses__lt=coupon.max_use)
+        coupon_users = CouponUser.objects.filter(pk=coupon_user.pk)
+        if coupon.max_use_per_user:
+            coupon_users = coupon_users.filter(
+                uses__lt=coupon.max_use_per_user
+            )
+
+        if not coupons.update(total_uses=F('total_uses') + 1):
+            return False
+        if not coupon_users.update(uses=F('uses') + 1):
+            transaction.set_rollback(True)
+            return False
+
+    return True
+
+
+def notify_for_coupon(email_list, coupon):
     """
-    This function sends an email to notify a user that he has access to a
-    coupon code for his next purchase.
+    This function sends an email to each address of the list to notify its
+    owner of a coupon code for their next purchase. The email is rendered once
+    for all the addresses.
+
+    Returns the delivery status of each address.
     """
 
     merge_data = {'COUPON': coupon}
@@ -580,10 +892,237 @@ def notify_for_coupon(email, coupon):
     plain_msg = render_to_string("coupon_code.txt", merge_data)
     msg_html = render_to_string("coupon_code.html", merge_data)
 
-    return send_mail(
+    return queue_mass_mail(
         "Coupon rabais",
         plain_msg,
         settings.DEFAULT_FROM_EMAIL,
-        [email],
+        email_list,
         html_message=msg_html,
     )
+
+
+def bulk_create_reservations(model, reservations, key):
+    """
+    model:        Reservation model of the reserved objects
+    reservations: Unsaved active reservations of a single user
+    key:          Attribute holding the id of the reserved object, which a
+                  user can't reserve twice (ie: "timeslot_id")
+
+    Insert the reservations and their history in bulk. Primary keys are set on
+    the given reservations, even on databases where bulk_create doesn't.
+
+    Returns the reservations.
+    """
+    model.objects.bulk_create(reservations)
+    if reservations and reservations[0].pk is None:
+        pks = dict(model.objects.filter(**{
+            'user_id': reservations[0].user_id,
+            'is_active': True,
+            key + '__in': [
+                getattr(reservation, key) for reservation in reservations
+            ],
+        }).values_list(key, 'pk'))
+        for reservation in reservations:
+            reservation.pk = pks[getattr(reservation, key)]
+            reservation._state.adding = False
+    model.history.bulk_history_create(reservations)
+    return reservations
+
+
+def release_order(order):
+    """
+    Cancel a pending order that was not paid: its reservations are deleted,
+    tickets and coupon uses are given back and the order is deleted.
+
+    Returns False if the order is no longer pending, meaning it has already
+    been confirmed or released.
+    """
+    with transaction.atomic():
+        is_pending = Order.objects.select_for_update().filter(
+            pk=order.pk,
+            status='P',
+        ).exists()
+        if not is_pending:
+            return False
+
+        tickets = 0
+        released_seats = dict()
+        orderlines = order.order_lines.select_related('content_type')
+        for orderline in orderlines:
+            model = orderline.content_type.model
+            if model == 'package':
+                tickets -= (
+                    orderline.content_object.reservations *
+                    orderline.quantity
+                )
+            elif model == 'timeslot':
+                # A user can't hold two active reservations on the same
+                # timeslot, so this is the one made with the order.
+                reservations = Reservation.objects.filter(
+                    user_id=order.user_id,
+                    timeslot_id=orderline.object_id,
+                    is_active=True,
+                )
+                count = reservations.count()
+                tickets += count
+                reservations.delete(force_policy=HARD_DELETE)
+                released_seats[orderline.object_id] = -count
+            elif model == 'retirement':
+                RetirementReservation.objects.filter(
+                    order_line=orderline,
+                ).delete(force_policy=HARD_DELETE)
+
+            if orderline.coupon_id:
+                CouponUser.objects.filter(
+                    user_id=order.user_id,
+                    coupon_id=orderline.coupon_id,
+                    uses__gt=0,
+                ).update(uses=F('uses') - 1)
+                Coupon.objects.filter(
+                    pk=orderline.coupon_id,
+                    total_uses__gt=0,
+                ).update(total_uses=F('total_uses') - 1)
+
+        if tickets < 0:
+            # Tickets of the order's packages that were already spent can't
+            # be taken back.
+            balance = User.objects.select_for_update().filter(
+                pk=order.user_id,
+            ).values_list('tickets', flat=True).get()
+            tickets = max(tickets, -(balance or 0))
+        update_tickets({order.user_id: tickets}, 'O')
+        adjust_availability(released_seats)
+        order.delete()
+
+    return True
+
+
+def release_expired_orders():
+    """
+    Release pending orders that were not confirmed in time and return how
+    many were released. Orders that were charged but could not be confirmed
+    have a settlement and are left to be handled by an admin.
+    """
+    expired_orders = Order.objects.filter(
+        status='P',
+        pending_until__lte=timezone.now(),
+        settlement_id='0',
+    )
+    return len([order for order in expired_orders if release_order(order)])
+
+
+def idempotent_request(view_method):
+    """
+    Decorator for viewset actions that must not be processed twice, like
+    actions charging users.
+
+    When the request has an "Idempotency-Key" header, the response of the
+    first successful request is stored and replayed, without processing the
+    request, to subsequent requests of the same user with the same key.
+    A key can't be reused with a different request. Failed requests are not
+    stored so they can be retried with the same key. A key is locked while
+    its request is processed. A retry gets a conflict until the lock expires
+    after IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS, then takes the key over.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key or not request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+
+        if len(key) > 253:
+            return Response(
+                {'non_field_errors': [_(
+                    "The Idempotency-Key header must be at most 253 "
+                    "characters long."
+                )]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        lifetime = timedelta(
+            hours=settings.LOCAL_SETTINGS['IDEMPOTENCY_KEY_LIFETIME_HOURS']
+        )
+        IdempotencyKey.objects.filter(
+            created_at__lt=timezone.now() - lifetime
+        ).delete()
+
+        request_path = ' '.join([request.method, request.path])
+        request_hash = hashlib.sha256(
+            json.dumps(request.data, sort_keys=True, cls=JSONEncoder).encode()
+        ).hexdigest()
+
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                idempotency_key = IdempotencyKey.objects.create(
+                    user=request.user,
+                    key=key,
+                    request_path=request_path,
+                    request_hash=request_hash,
+                    locked_at=now,
+                )
+        except IntegrityError:
+            idempotency_key = IdempotencyKey.objects.get(
+                user=request.user,
+                key=key,
+            )
+            if (idempotency_key.request_path != request_path or
+                    idempotency_key.request_hash != request_hash):
+                return Response(
+                    {'non_field_errors': [_(
+                        "This Idempotency-Key has already been used for "
+                        "another request."
+                    )]},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if idempotency_key.response_status is not None:
+                response = Response(
+                    json.loads(idempotency_key.response_body),
+                    status=idempotency_key.response_status,
+                )
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            # The worker processing the first request may have died: its
+            # lock can be taken over once it has expired.
+            lock_timeout = timedelta(seconds=settings.LOCAL_SETTINGS[
+                'IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS'
+            ])
+            taken_over = IdempotencyKey.objects.filter(
+                Q(locked_at__isnull=True) |
+                Q(locked_at__lt=now - lock_timeout),
+                pk=idempotency_key.pk,
+                response_status__isnull=True,
+            ).update(locked_at=now)
+            if not taken_over:
+                return Response(
+                    {'non_field_errors': [_(
+                        "A request with this Idempotency-Key is already "
+                        "being processed."
+                    )]},
+                    status=status.HTTP_409_CONFLICT,
+                )
+
+        # Only the request holding the lock saves or deletes the key
+        locked_key = IdempotencyKey.objects.filter(
+            pk=idempotency_key.pk,
+            locked_at=now,
+        )
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            locked_key.delete()
+            raise
+
+        if status.is_success(response.status_code):
+            locked_key.update(
+                response_status=response.status_code,
+                response_body=json.dumps(response.data, cls=JSONEncoder),
+                locked_at=None,
+            )
+        else:
+            locked_key.delete()
+
+        return response
+
+    return wrapper
@@ -177,6 +177,14 @@ SAMPLE_NO_AMOUNT_TO_REFUND = {
     }
 }
 
+SAMPLE_DUPLICATE_TRANSACTION = {
+    "error": {
+        "code": "5031",
+        "message": "The transaction you have submitted has already been "
+                   "processed.",
+    },
+}
+
 UNKNOWN_EXCEPTION = {
     "error": {
         "code": "9999",
@@ -0,0 +1,47 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+
+from retirement.models import Retirement
+from workplace.models import Workplace
+
+from ..models import Membership, Order, Package
+
+User = get_user_model()
+
+
+class BenchmarkCheckoutTest(TransactionTestCase):
+
+    @override_settings(DEBUG=True)
+    def test_benchmark_checkout(self):
+        out = StringIO()
+
+        call_command(
+            'benchmark_checkout',
+            '--orders=4',
+            '--concurrency=1',
+            stdout=out
+        )
+
+        self.assertIn('Orders: 4 (1 concurrent)', out.getvalue())
+        self.assertIn('membership 201: 1', out.getvalue())
+        self.assertIn('package 201: 1', out.getvalue())
+        self.assertIn('timeslot 201: 1', out.getvalue())
+        self.assertIn('retirement 201: 1', out.getvalue())
+        self.assertIn('Latency (ms): p50=', out.getvalue())
+
+        # Benchmark data is deleted
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Membership.objects.exists())
+        self.assertFalse(Package.objects.exists())
+        self.assertFalse(Retirement.objects.all_with_deleted().exists())
+        self.assertFalse(Workplace.objects.all_with_deleted().exists())
+
+    def test_benchmark_checkout_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_checkout', '--orders=1')
@@ -0,0 +1,164 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from blitz_api.factories import UserFactory
+from blitz_api.models import TicketEntry
+from workplace.models import Period, Reservation, TimeSlot, Workplace
+
+from ..models import Order, OrderLine, Package
+
+
+class ReleaseExpiredOrdersTest(TestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.user.tickets = 99
+        self.user.save()
+        self.workplace = Workplace.objects.create(
+            name="random_workplace",
+            seats=40,
+            address_line1="123 random street",
+            postal_code="123 456",
+            state_province="Random state",
+            country="Random country",
+        )
+        self.period = Period.objects.create(
+            name="random_period_active",
+            workplace=self.workplace,
+            start_date=timezone.now(),
+            end_date=timezone.now() + timedelta(weeks=4),
+            price=3,
+            is_active=True,
+        )
+        self.time_slot = TimeSlot.objects.create(
+            name="morning_time_slot",
+            period=self.period,
+            price=1,
+            start_time=timezone.now() + timedelta(days=1),
+            end_time=timezone.now() + timedelta(days=1, hours=4),
+        )
+        self.package = Package.objects.create(
+            name="extreme_package",
+            available=True,
+            price=40,
+            reservations=100,
+        )
+
+    def create_order(self, status, pending_until=None):
+        return Order.objects.create(
+            user=self.user,
+            transaction_date=timezone.now(),
+            authorization_id=0,
+            settlement_id=0,
+            reference_number=0,
+            status=status,
+            pending_until=pending_until,
+        )
+
+    def test_release_expired_orders(self):
+        """
+        Ensure only expired pending orders are released, with the tickets and
+        seats they were holding.
+        """
+        expired_order = self.create_order(
+            'P',
+            timezone.now() - timedelta(minutes=1),
+        )
+        pending_order = self.create_order(
+            'P',
+            timezone.now() + timedelta(minutes=10),
+        )
+        confirmed_order = self.create_order('C')
+        # The expired order got the package's tickets and used one of them
+        OrderLine.objects.create(
+            order=expired_order,
+            quantity=1,
+            content_type=ContentType.objects.get_for_model(Package),
+            object_id=self.package.id,
+            cost=self.package.price,
+        )
+        OrderLine.objects.create(
+            order=expired_order,
+            quantity=1,
+            content_type=ContentType.objects.get_for_model(TimeSlot),
+            object_id=self.time_slot.id,
+            cost=0,
+        )
+        Reservation.objects.create(
+            user=self.user,
+            timeslot=self.time_slot,
+            is_active=True,
+        )
+
+        out = StringIO()
+        call_command('release_expired_orders', stdout=out)
+
+        self.assertIn('Released 1 expired pending orders', out.getvalue())
+
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 0)
+        self.assertFalse(Order.objects.filter(pk=expired_order.pk).exists())
+        self.assertTrue(Order.objects.filter(pk=pending_order.pk).exists())
+        self.assertTrue(Order.objects.filter(pk=confirmed_order.pk).exists())
+        self.assertFalse(
+            Reservation.objects.all_with_deleted().filter(
+                user=self.user,
+            ).exists()
+        )
+
+    def test_release_expired_orders_charged(self):
+        """
+        Ensure expired orders that were charged but not confirmed are not
+        released.
+        """
+        charged_order = self.create_order(
+            'P',
+            timezone.now() - timedelta(minutes=1),
+        )
+        charged_order.settlement_id = '1'
+        charged_order.save()
+
+        out = StringIO()
+        call_command('release_expired_orders', stdout=out)
+
+        self.assertIn('Released 0 expired pending orders', out.getvalue())
+        self.assertTrue(Order.objects.filter(pk=charged_order.pk).exists())
+
+    def test_release_expired_orders_spent_tickets(self):
+        """
+        Ensure tickets of a package that were already spent are not taken
+        back and that the ledger matches the balance.
+        """
+        self.user.tickets = 40
+        self.user.save()
+        expired_order = self.create_order(
+            'P',
+            timezone.now() - timedelta(minutes=1),
+        )
+        OrderLine.objects.create(
+            order=expired_order,
+            quantity=1,
+            content_type=ContentType.objects.get_for_model(Package),
+            object_id=self.package.id,
+            cost=self.package.price,
+        )
+
+        call_command('release_expired_orders', stdout=StringIO())
+
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.tickets, 0)
+        self.assertEqual(
+            list(
+                TicketEntry.objects.filter(user=self.user).values_list(
+                    'amount', 'reason',
+                )
+            ),
+            [(-40, 'O')],
+        )
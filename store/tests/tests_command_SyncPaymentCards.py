@@ -0,0 +1,98 @@
+from io import StringIO
+
+import responses
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from blitz_api.factories import UserFactory
+
+from .paysafe_sample_responses import (SAMPLE_PROFILE_RESPONSE,
+                                       UNKNOWN_EXCEPTION, )
+
+from ..models import PaymentProfile
+
+
+@override_settings(
+    PAYSAFE={
+        'ACCOUNT_NUMBER': "0123456789",
+        'USER': "user",
+        'PASSWORD': "password",
+        'BASE_URL': "http://example.com/",
+        'VAULT_URL': "customervault/v1/",
+        'CARD_URL': "cardpayments/v1/"
+    }
+)
+class SyncPaymentCardsTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(SyncPaymentCardsTest, cls).setUpClass()
+        cls.user = UserFactory()
+        cls.payment_profile = PaymentProfile.objects.create(
+            name="Test profile",
+            owner=cls.user,
+            external_api_id="123",
+            external_api_url="https://example.com/customervault/v1/"
+                             "profiles/",
+        )
+        cls.payment_profile_2 = PaymentProfile.objects.create(
+            name="Test profile 2",
+            owner=cls.user,
+            external_api_id="456",
+            external_api_url="https://example.com/customervault/v1/"
+                             "profiles/",
+        )
+
+    @responses.activate
+    def test_sync_payment_cards(self):
+        out = StringIO()
+        err = StringIO()
+
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/456?fields=cards",
+            json=UNKNOWN_EXCEPTION,
+            status=400
+        )
+
+        call_command('sync_payment_cards', stdout=out, stderr=err)
+
+        self.assertIn(
+            'Synchronized 1 external profiles (1 failed)',
+            out.getvalue()
+        )
+        self.assertIn('Failed to synchronize profile "456"', err.getvalue())
+        self.assertEqual(self.payment_profile.cards.count(), 1)
+        self.assertFalse(self.payment_profile_2.cards.exists())
+
+    @responses.activate
+    def test_sync_payment_cards_filtered(self):
+        out = StringIO()
+
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+
+        call_command(
+            'sync_payment_cards',
+            '--profiles=1',
+            '--unsynced',
+            stdout=out
+        )
+
+        self.assertIn(
+            'Synchronized 1 external profiles (0 failed)',
+            out.getvalue()
+        )
+        self.assertEqual(len(responses.calls), 1)
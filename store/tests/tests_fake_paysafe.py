@@ -0,0 +1,97 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from blitz_api.factories import UserFactory
+
+from ..exceptions import PaymentAPIError
+from ..fake_paysafe import FakePaysafeServer
+from ..services import (charge_payment,
+                        create_external_card,
+                        create_external_payment_profile,
+                        delete_external_card,
+                        get_external_card,
+                        get_external_cards,
+                        refund_amount,
+                        update_external_card,
+                        PAYSAFE_EXCEPTION)
+
+
+class FakePaysafeTests(TestCase):
+
+    def setUp(self):
+        self.server = FakePaysafeServer().start()
+        self.settings_override = override_settings(PAYSAFE={
+            'ACCOUNT_NUMBER': "0123456789",
+            'USER': "user",
+            'PASSWORD': "password",
+            'BASE_URL': self.server.base_url,
+            'VAULT_URL': "customervault/v1/",
+            'CARD_URL': "cardpayments/v1/",
+        })
+        self.settings_override.enable()
+        self.user = UserFactory()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.stop()
+
+    def test_checkout_and_refund(self):
+        """
+        Ensure all services used by the checkout work with the fake API.
+        """
+        profile = create_external_payment_profile(self.user).json()
+        card = create_external_card(profile['id'], "SINGLE_USE").json()
+
+        self.assertEqual(
+            [c['id'] for c in get_external_cards(profile['id'])],
+            [card['id']],
+        )
+        self.assertEqual(get_external_card(card['id']).json(), card)
+
+        card = update_external_card(
+            profile['id'],
+            card['id'],
+            "OTHER_SINGLE_USE",
+        ).json()
+
+        charge = charge_payment(1000, card['paymentToken'], "1").json()
+        settlement_id = charge['settlements'][0]['id']
+
+        self.assertEqual(charge['card']['lastDigits'], card['lastDigits'])
+
+        refund_amount(settlement_id, 600)
+
+        with self.assertRaises(PaymentAPIError) as context:
+            refund_amount(settlement_id, 600)
+
+        self.assertEqual(context.exception.args[0], PAYSAFE_EXCEPTION['3406'])
+
+        delete_external_card(profile['id'], card['id'])
+
+        self.assertEqual(get_external_cards(profile['id']), [])
+        self.assertEqual(
+            self.server.requests_count['vault.get_profile'],
+            2,
+        )
+
+    def test_error_injection(self):
+        """
+        Ensure injected error codes are returned on applicable endpoints only.
+        """
+        self.server.error_rate = 1
+        self.server.error_codes = ['3022']
+
+        profile = create_external_payment_profile(self.user).json()
+        card = create_external_card(profile['id'], "SINGLE_USE").json()
+
+        with self.assertRaises(PaymentAPIError) as context:
+            charge_payment(1000, card['paymentToken'], "1")
+
+        self.assertEqual(context.exception.args[0], PAYSAFE_EXCEPTION['3022'])
+
+    def test_invalid_error_code(self):
+        """
+        Ensure only known error codes can be injected.
+        """
+        with self.assertRaises(ValueError):
+            FakePaysafeServer(error_codes=['1234'])
@@ -0,0 +1,291 @@
+import logging
+
+import requests
+import responses
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .paysafe_sample_responses import (SAMPLE_PROFILE_RESPONSE,
+                                       UNKNOWN_EXCEPTION, )
+
+from ..exceptions import GatewayUnavailableError
+from ..gateway import CircuitBreaker, PaysafeClient, get_client
+from ..services import get_external_payment_profile
+
+CARD_URL = "http://example.com/customervault/v1/cards/1"
+
+
+@override_settings(
+    PAYSAFE={
+        'ACCOUNT_NUMBER': "0123456789",
+        'USER': "user",
+        'PASSWORD': "password",
+        'BASE_URL': "http://example.com/",
+        'VAULT_URL': "customervault/v1/",
+        'CARD_URL': "cardpayments/v1/",
+        'POOL_SIZE': 4,
+        'CONNECT_TIMEOUT': 1,
+        'READ_TIMEOUT': 5,
+    }
+)
+class GatewayTests(TestCase):
+
+    def test_get_client_is_shared(self):
+        """
+        Ensure the same client, and thus the same session, is reused.
+        """
+        client = get_client()
+
+        self.assertIs(get_client(), client)
+        self.assertEqual(client.timeout, (1, 5))
+
+        adapter = client.session.get_adapter('https://example.com/')
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_get_client_settings_changed(self):
+        """
+        Ensure a new client is built when pool or timeouts settings change.
+        """
+        client = get_client()
+
+        with self.settings(PAYSAFE={
+            'USER': "user",
+            'PASSWORD': "password",
+            'POOL_SIZE': 2,
+        }):
+            new_client = get_client()
+
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.config[0], 2)
+
+    @responses.activate
+    def test_request_timeout_and_auth(self):
+        """
+        Ensure requests are sent with credentials and default timeouts.
+        """
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/cards/1",
+            json={},
+            status=200
+        )
+        client = PaysafeClient(connect_timeout=1, read_timeout=5)
+
+        response = client.get(
+            'vault.get_card',
+            "http://example.com/customervault/v1/cards/1",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            responses.calls[0].request.headers['Authorization'],
+            'Basic dXNlcjpwYXNzd29yZA==',
+        )
+
+    @responses.activate
+    def test_latencies(self):
+        """
+        Ensure latencies are recorded per endpoint for every service call.
+        """
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+        client = get_client()
+        client.reset_latencies()
+
+        get_external_payment_profile('123')
+        get_external_payment_profile('123')
+
+        latencies = client.get_latencies()
+
+        self.assertEqual(list(latencies.keys()), ['vault.get_profile'])
+        self.assertEqual(latencies['vault.get_profile']['count'], 2)
+        self.assertGreaterEqual(
+            latencies['vault.get_profile']['max'],
+            latencies['vault.get_profile']['average'],
+        )
+
+        client.reset_latencies()
+
+        self.assertEqual(client.get_latencies(), {})
+
+    @responses.activate
+    def test_request_retry(self):
+        """
+        Ensure idempotent requests are retried after a server error.
+        """
+        responses.add(responses.GET, CARD_URL, json={}, status=503)
+        responses.add(responses.GET, CARD_URL, json={}, status=200)
+        client = PaysafeClient(retry_backoff=0)
+
+        response = client.get('vault.get_card', CARD_URL)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(client.get_latencies()['vault.get_card']['count'], 2)
+
+    @responses.activate
+    def test_request_retry_exhausted(self):
+        """
+        Ensure the last response is returned once retries are exhausted and
+        that requests that are not idempotent are never retried.
+        """
+        responses.add(responses.GET, CARD_URL, json={}, status=503)
+        responses.add(responses.POST, CARD_URL, json={}, status=503)
+        client = PaysafeClient(
+            max_retries=2,
+            retry_backoff=0,
+            breaker_threshold=10,
+        )
+
+        response = client.get('vault.get_card', CARD_URL)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(responses.calls), 3)
+
+        response = client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(responses.calls), 4)
+
+        client.post('card.refunds', CARD_URL, idempotent=True)
+
+        self.assertEqual(len(responses.calls), 7)
+
+    @responses.activate
+    def test_request_unreachable(self):
+        """
+        Ensure network errors are reported as an unavailable gateway.
+        """
+        client = PaysafeClient(retry_backoff=0)
+
+        with self.assertRaises(GatewayUnavailableError):
+            # No response is registered: the connection is refused
+            client.get('vault.get_card', CARD_URL)
+
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_circuit_breaker(self):
+        """
+        Ensure requests fail fast once the circuit is open and that it closes
+        again after a successful trial request.
+        """
+        responses.add(responses.POST, CARD_URL, json={}, status=500)
+        client = PaysafeClient(breaker_threshold=2, breaker_reset_timeout=60)
+
+        client.post('vault.create_card', CARD_URL)
+        client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(client.breaker.state, 'open')
+
+        with self.assertRaises(GatewayUnavailableError):
+            client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(len(responses.calls), 2)
+
+        responses.replace(responses.POST, CARD_URL, json={}, status=201)
+        client.breaker.reset_timeout = 0
+
+        self.assertEqual(client.breaker.state, 'half-open')
+
+        response = client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_circuit_breaker_trial(self):
+        """
+        Ensure a single trial request is let through while half-open and
+        that the circuit opens again if it fails.
+        """
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+        breaker.reset_timeout = 60
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow_request())
+
+    @responses.activate
+    def test_circuit_breaker_trial_error(self):
+        """
+        Ensure the circuit doesn't stay half-open when its trial request
+        fails with an error other than a network error.
+        """
+        responses.add(responses.POST, CARD_URL, json={}, status=500)
+        client = PaysafeClient(breaker_threshold=1, breaker_reset_timeout=0)
+
+        client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(client.breaker.state, 'half-open')
+
+        responses.replace(
+            responses.POST,
+            CARD_URL,
+            body=requests.exceptions.ChunkedEncodingError(),
+        )
+
+        with self.assertRaises(GatewayUnavailableError):
+            client.post('vault.create_card', CARD_URL)
+
+        responses.replace(responses.POST, CARD_URL, json={}, status=201)
+
+        response = client.post('vault.create_card', CARD_URL)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    @responses.activate
+    def test_metrics(self):
+        """
+        Ensure statuses, Paysafe error codes and a latency histogram are
+        recorded per endpoint, and that each call is logged.
+        """
+        responses.add(responses.GET, CARD_URL, json={}, status=200)
+        responses.add(
+            responses.POST,
+            CARD_URL,
+            json=UNKNOWN_EXCEPTION,
+            status=400,
+        )
+        client = PaysafeClient()
+
+        logging.disable(logging.NOTSET)
+        try:
+            with self.assertLogs('store.gateway', level='INFO') as logs:
+                client.get('vault.get_card', CARD_URL)
+                client.post('vault.create_card', CARD_URL)
+        finally:
+            logging.disable(logging.CRITICAL)
+
+        latencies = client.get_latencies()
+
+        self.assertEqual(latencies['vault.get_card']['statuses'], {'200': 1})
+        self.assertEqual(latencies['vault.get_card']['error_codes'], {})
+        self.assertEqual(
+            sum(latencies['vault.get_card']['buckets'].values()),
+            1,
+        )
+        self.assertEqual(
+            latencies['vault.create_card']['statuses'],
+            {'400': 1},
+        )
+        self.assertEqual(
+            latencies['vault.create_card']['error_codes'],
+            {'9999': 1},
+        )
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn(
+            'endpoint=vault.create_card status=400 error_code=9999',
+            logs.output[1],
+        )
+        self.assertEqual(logs.records[1].error_code, '9999')
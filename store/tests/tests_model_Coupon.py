@@ -4,7 +4,7 @@ from rest_framework.test import APITestCase
 
 from blitz_api.factories import UserFactory
 
-from ..models import Package, Coupon
+from ..models import Package, Coupon, CouponUser
 
 
 class CouponTests(APITestCase):
@@ -43,3 +43,36 @@ class CouponTests(APITestCase):
         )
 
         self.assertEqual(str(coupon), "12345678")
+
+    def test_update_total_uses(self):
+        """
+        Ensure the usage counter can be recomputed from the coupon's users.
+        """
+        CouponUser.objects.create(
+            coupon=self.coupon,
+            user=self.user,
+            uses=2,
+        )
+        CouponUser.objects.create(
+            coupon=self.coupon,
+            user=UserFactory(),
+            uses=3,
+        )
+
+        self.coupon.update_total_uses()
+
+        self.assertEqual(self.coupon.total_uses, 5)
+
+    def test_save_keeps_total_uses(self):
+        """
+        Ensure saving an outdated instance doesn't overwrite the uses counted
+        since it was loaded.
+        """
+        Coupon.objects.filter(pk=self.coupon.pk).update(total_uses=4)
+
+        self.coupon.details = "New details"
+        self.coupon.save()
+        self.coupon.refresh_from_db()
+
+        self.assertEqual(self.coupon.details, "New details")
+        self.assertEqual(self.coupon.total_uses, 4)
@@ -84,3 +84,18 @@ class OrderTests(APITestCase):
     #     total_cost = decimal.Decimal(str(999 * 400 + 999 * 400 * TAX), 2)
     #     self.assertEqual(self.order.total_ticket, 2 * 3)
     #     self.assertEqual(self.order.total_cost, total_cost)
+
+    def test_properties_queries(self):
+        """
+        Ensure that products of order lines are loaded in bulk.
+        """
+        order = Order.objects.prefetch_related('order_lines').get(
+            pk=self.order.pk,
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(order.total_cost, 0)
+
+        # One query for the order lines and one for the timeslots
+        with self.assertNumQueries(2):
+            self.assertEqual(order.total_ticket, 2 * 3)
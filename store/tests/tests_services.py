@@ -10,17 +10,20 @@ from rest_framework.test import APITestCase
 from blitz_api.factories import UserFactory
 
 from .paysafe_sample_responses import (UNKNOWN_EXCEPTION,
+                                       SAMPLE_CARD_RESPONSE,
                                        SAMPLE_INVALID_PAYMENT_TOKEN,
                                        SAMPLE_PROFILE_RESPONSE,)
 
 from ..exceptions import PaymentAPIError
-from ..models import PaymentProfile
+from ..models import Coupon, CouponUser, PaymentCard, PaymentProfile
 from ..services import (charge_payment,
                         get_external_payment_profile,
                         create_external_payment_profile,
                         update_external_card,
                         delete_external_card,
-                        create_external_card,)
+                        create_external_card,
+                        sync_external_cards,
+                        use_coupon,)
 
 User = get_user_model()
 
@@ -52,6 +55,41 @@ class ServicesTests(APITestCase):
                              "profiles/",
         )
 
+    def test_use_coupon(self):
+        """
+        Ensure coupon uses are counted and can't exceed the coupon's limits.
+        """
+        other_user = UserFactory()
+        coupon = Coupon.objects.create(
+            value=13,
+            code="ASD1234E",
+            start_time="2019-01-06T15:11:05-05:00",
+            end_time="2020-01-06T15:11:06-05:00",
+            max_use=3,
+            max_use_per_user=2,
+            owner=self.user,
+        )
+
+        self.assertTrue(use_coupon(coupon, self.user))
+        self.assertTrue(use_coupon(coupon, self.user))
+        # The user reached its maximum number of uses
+        self.assertFalse(use_coupon(coupon, self.user))
+        self.assertTrue(use_coupon(coupon, other_user))
+        # The coupon reached its maximum number of uses
+        self.assertFalse(use_coupon(coupon, other_user))
+
+        coupon.refresh_from_db()
+
+        self.assertEqual(coupon.total_uses, 3)
+        self.assertEqual(
+            CouponUser.objects.get(coupon=coupon, user=self.user).uses,
+            2,
+        )
+        self.assertEqual(
+            CouponUser.objects.get(coupon=coupon, user=other_user).uses,
+            1,
+        )
+
     @responses.activate
     def test_get_external_payment_profile(self):
         """
@@ -144,6 +182,73 @@ class ServicesTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(json.loads(response.content), SAMPLE_PROFILE_RESPONSE)
 
+    @responses.activate
+    def test_create_external_card_local_copy(self):
+        """
+        Ensure cards created in the external API are copied locally.
+        """
+        responses.add(
+            responses.POST,
+            "http://example.com/customervault/v1/profiles/123/cards/",
+            json=SAMPLE_CARD_RESPONSE,
+            status=200
+        )
+        create_external_card(
+            self.payment_profile.external_api_id,
+            SINGLE_USE_TOKEN,
+        )
+
+        card = PaymentCard.objects.get(payment_profile=self.payment_profile)
+
+        self.assertEqual(card.external_api_id, SAMPLE_CARD_RESPONSE['id'])
+        self.assertEqual(card.last_digits, "2345")
+        self.assertEqual(card.card_expiry_month, 2)
+        self.assertEqual(card.card_expiry_year, 2019)
+        self.assertEqual(card.payment_token, "CYQ3O0svO35unUI")
+
+        responses.add(
+            responses.DELETE,
+            "http://example.com/customervault/v1/profiles/123/cards/" +
+            SAMPLE_CARD_RESPONSE['id'],
+            json='',
+            status=204
+        )
+        delete_external_card(
+            self.payment_profile.external_api_id,
+            SAMPLE_CARD_RESPONSE['id'],
+        )
+
+        self.assertFalse(self.payment_profile.cards.exists())
+
+    @responses.activate
+    def test_sync_external_cards(self):
+        """
+        Ensure the local copy of cards is replaced by the external cards.
+        """
+        PaymentCard.objects.create(
+            payment_profile=self.payment_profile,
+            external_api_id="deleted_card",
+        )
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+
+        cards = sync_external_cards(self.payment_profile.external_api_id)
+
+        self.assertEqual(cards[0]['id'], "456")
+        self.assertEqual(
+            list(self.payment_profile.cards.values_list(
+                'external_api_id',
+                flat=True
+            )),
+            ["456"],
+        )
+        self.payment_profile.refresh_from_db()
+        self.assertTrue(self.payment_profile.cards_synced_at)
+
     @responses.activate
     def test_charge_payment(self):
         """
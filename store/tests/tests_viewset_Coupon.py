@@ -2,6 +2,7 @@ import json
 import pytz
 
 from datetime import datetime, timedelta
+from smtplib import SMTPException
 
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
@@ -405,12 +406,21 @@ class CouponTests(APITestCase):
             format='json',
         )
 
+        content = {
+            'results': [
+                {'email': "fake@fake.com", 'status': 'sent'},
+                {'email': "whatever@whatever.com", 'status': 'sent'},
+            ]
+        }
+
         self.assertEqual(
             response.status_code,
-            status.HTTP_204_NO_CONTENT,
+            status.HTTP_200_OK,
             response.content,
         )
 
+        self.assertEqual(json.loads(response.content), content)
+
         self.assertEqual(len(mail.outbox), 2)
 
     def test_notify_email_for_coupon_owner(self):
@@ -435,14 +445,70 @@ class CouponTests(APITestCase):
             format='json',
         )
 
+        content = {
+            'results': [
+                {'email': "fake@fake.com", 'status': 'sent'},
+                {'email': "whatever@whatever.com", 'status': 'sent'},
+            ]
+        }
+
         self.assertEqual(
             response.status_code,
-            status.HTTP_204_NO_CONTENT,
+            status.HTTP_200_OK,
             response.content,
         )
 
+        self.assertEqual(json.loads(response.content), content)
+
         self.assertEqual(len(mail.outbox), 2)
 
+    @mock.patch(
+        'django.core.mail.EmailMultiAlternatives.send',
+        side_effect=[SMTPException("Recipient refused"), 1],
+    )
+    def test_notify_email_for_coupon_failed(self, send):
+        """
+        Ensure that an address that can't be reached is reported without
+        preventing the others from being notified.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "email_list": [
+                "fake@fake.com",
+                "whatever@whatever.com",
+            ]
+        }
+
+        response = self.client.post(
+            reverse(
+                'coupon-notify',
+                kwargs={'pk': 1},
+            ),
+            data,
+            format='json',
+        )
+
+        content = {
+            'results': [{
+                'email': "fake@fake.com",
+                'status': 'failed',
+                'error': "SMTPException: Recipient refused",
+            }, {
+                'email': "whatever@whatever.com",
+                'status': 'sent',
+            }]
+        }
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            response.content,
+        )
+
+        self.assertEqual(json.loads(response.content), content)
+        self.assertEqual(send.call_count, 2)
+
     def test_notify_email_for_coupon_random_user(self):
         """
         Ensure that a random authenticated user can't notify for coupon.
@@ -610,7 +676,7 @@ class CouponTests(APITestCase):
             "owner": "http://testserver/users/1",
         }
         with mock.patch(
-                'store.serializers.random.choices', return_value="ABCDEFGH"):
+                'store.services.random.choices', return_value="ABCDEFGH"):
             response = self.client.post(
                 reverse('coupon-list'),
                 data,
@@ -634,6 +700,181 @@ class CouponTests(APITestCase):
             content
         )
 
+    def test_batch(self):
+        """
+        Ensure an admin can create many coupons at once, with generated codes.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "count": 30,
+            "applicable_product_types": [
+                "package"
+            ],
+            "applicable_timeslots": [
+                "http://testserver/time_slots/" + str(self.time_slot.id),
+            ],
+            "value": "13.00",
+            "start_time": "2019-01-06T15:11:05-05:00",
+            "end_time": "2020-01-06T15:11:06-05:00",
+            "max_use": 1,
+            "max_use_per_user": 1,
+            "details": "Campaign coupons",
+            "owner": "http://testserver/users/1",
+        }
+
+        # The first generated codes collide with an existing coupon
+        codes = ["ABCDEFGH"] * 5 + ["CODE{0:04d}".format(i) for i in range(30)]
+        with mock.patch(
+                'store.services.random.choices', side_effect=codes):
+            response = self.client.post(
+                reverse('coupon-batch'),
+                data,
+                format='json',
+            )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+
+        response_data = json.loads(response.content)
+        coupons = Coupon.objects.filter(details="Campaign coupons")
+
+        self.assertEqual(response_data['count'], 30)
+        self.assertEqual(
+            sorted(response_data['codes']),
+            sorted(codes[5:]),
+        )
+        self.assertEqual(coupons.count(), 30)
+        self.assertEqual(
+            Coupon.history.filter(details="Campaign coupons").count(),
+            30,
+        )
+        for coupon in coupons:
+            self.assertEqual(
+                list(coupon.applicable_product_types.all()),
+                [self.package_type],
+            )
+            self.assertEqual(
+                list(coupon.applicable_timeslots.all()),
+                [self.time_slot],
+            )
+
+    def test_create_code_collision(self):
+        """
+        Ensure a coupon is created with a new code if its generated code is
+        used by another coupon before it is saved.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "applicable_product_types": [
+                "package"
+            ],
+            "value": "13.00",
+            "start_time": "2019-01-06T15:11:05-05:00",
+            "end_time": "2020-01-06T15:11:06-05:00",
+            "max_use": 100,
+            "max_use_per_user": 2,
+            "details": "Any package for clients",
+            "owner": "http://testserver/users/1",
+        }
+        # The first generated code was available when it was checked
+        with mock.patch(
+                'store.serializers.generate_coupon_codes',
+                side_effect=[["ABCDEFGH"], ["NEWCODE1"]]):
+            response = self.client.post(
+                reverse('coupon-list'),
+                data,
+                format='json',
+            )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+        self.assertEqual(json.loads(response.content)['code'], "NEWCODE1")
+        self.assertEqual(Coupon.objects.filter(code="ABCDEFGH").count(), 1)
+
+    def test_batch_code_collision(self):
+        """
+        Ensure coupons are created with new codes if one of their generated
+        codes is used by another coupon before they are saved.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "count": 3,
+            "applicable_product_types": [
+                "package"
+            ],
+            "value": "13.00",
+            "start_time": "2019-01-06T15:11:05-05:00",
+            "end_time": "2020-01-06T15:11:06-05:00",
+            "max_use": 1,
+            "max_use_per_user": 1,
+            "details": "Campaign coupons",
+            "owner": "http://testserver/users/1",
+        }
+        # The first generated codes were available when they were checked
+        codes = [
+            ["CODE0001", "ABCDEFGH", "CODE0002"],
+            ["CODE0003", "CODE0004", "CODE0005"],
+        ]
+        with mock.patch(
+                'store.services.generate_coupon_codes', side_effect=codes):
+            response = self.client.post(
+                reverse('coupon-batch'),
+                data,
+                format='json',
+            )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+        self.assertEqual(
+            sorted(json.loads(response.content)['codes']),
+            codes[1],
+        )
+        self.assertEqual(
+            sorted(
+                Coupon.objects.filter(
+                    details="Campaign coupons",
+                ).values_list('code', flat=True)
+            ),
+            codes[1],
+        )
+
+    def test_batch_without_permission(self):
+        """
+        Ensure we can't create a batch of coupons if user has no permission.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        data = {
+            "count": 2,
+            "value": "13.00",
+            "start_time": "2019-01-06T15:11:05-05:00",
+            "end_time": "2020-01-06T15:11:06-05:00",
+            "max_use": 1,
+            "max_use_per_user": 1,
+            "owner": "http://testserver/users/1",
+        }
+
+        response = self.client.post(
+            reverse('coupon-batch'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Coupon.objects.count(), 2)
+
     def test_create_without_permission(self):
         """
         Ensure we can't create a coupon if user has no permission.
@@ -1042,6 +1283,85 @@ class CouponTests(APITestCase):
 
         data = json.loads(response.content)
 
+        content = {
+            'count': 1,
+            'next': None,
+            'previous': None,
+            'results': [{
+                "url": "http://testserver/coupons/1",
+                "id": 1,
+                "applicable_product_types": [
+                    "package"
+                ],
+                "value": "13.00",
+                "percent_off": None,
+                "code": data['results'][0]['code'],
+                "start_time": "2019-01-06T15:11:05-05:00",
+                "end_time": "2020-01-06T15:11:06-05:00",
+                "max_use": 100,
+                "max_use_per_user": 2,
+                "details": "Any package for clients",
+                "owner": "http://testserver/users/1",
+                "applicable_memberships": [{
+                    'id': 1,
+                    'name': 'basic_membership',
+                }],
+                "applicable_packages": [{
+                    'id': 1,
+                    'name': 'extreme_package',
+                }],
+                "applicable_retirements": [{
+                    'id': 1,
+                    'name': 'mega_retirement',
+                }],
+                "applicable_timeslots": [{
+                    'id': 1,
+                    'name': 'morning_time_slot',
+                }],
+                "users": []
+            }]
+        }
+
+        self.assertEqual(data, content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.coupon.applicable_retirements.set([])
+        self.coupon.applicable_timeslots.set([])
+        self.coupon.applicable_packages.set([])
+        self.coupon.applicable_memberships.set([])
+
+    def test_list_expand(self):
+        """
+        Ensure we can list owned coupons with a nested repr of the applicable
+        products given in the "expand" parameter.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        self.coupon.applicable_retirements.set([
+            self.retirement,
+        ])
+        self.coupon.applicable_timeslots.set([
+            self.time_slot,
+        ])
+        self.coupon.applicable_packages.set([
+            self.package,
+        ])
+        self.coupon.applicable_memberships.set([
+            self.membership,
+        ])
+
+        response = self.client.get(
+            reverse('coupon-list'),
+            {
+                'expand': 'applicable_retirements,applicable_timeslots,'
+                          'applicable_packages,applicable_memberships',
+            },
+            format='json',
+        )
+
+        data = json.loads(response.content)
+
         content = {
             'count': 1,
             'next': None,
@@ -1165,6 +1485,28 @@ class CouponTests(APITestCase):
         self.coupon.applicable_packages.set([])
         self.coupon.applicable_memberships.set([])
 
+    def test_list_queries(self):
+        """
+        Ensure the number of queries to list coupons doesn't depend on the
+        number of coupons or of applicable products.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        for coupon in [self.coupon, self.coupon2]:
+            coupon.applicable_retirements.set([self.retirement])
+            coupon.applicable_timeslots.set([self.time_slot])
+            coupon.applicable_packages.set([self.package])
+            coupon.applicable_memberships.set([self.membership])
+
+        # Count, coupons, then 1 query by prefetched many-to-many field
+        with self.assertNumQueries(8):
+            response = self.client.get(
+                reverse('coupon-list'),
+                format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_list_as_admin(self):
         """
         Ensure we can list all coupons as an admin.
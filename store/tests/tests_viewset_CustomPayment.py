@@ -38,6 +38,8 @@ LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
         'CARD_URL': "cardpayments/v1/"
     }
 )
+# Test transactions are never committed: commit hooks are run right away
+@mock.patch('django.db.transaction.on_commit', new=lambda func: func())
 class CustomPaymentTests(APITestCase):
 
     @classmethod
@@ -120,6 +122,43 @@ class CustomPaymentTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    @responses.activate
+    def test_create_idempotency_key(self):
+        """
+        Ensure a custom payment sent twice with the same Idempotency-Key is
+        only charged once.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_PAYMENT_RESPONSE,
+            status=200
+        )
+
+        data = {
+            'single_use_token': "SChsxyprFn176yhD",
+            'price': "123.00",
+            'name': "name of the payment",
+            'details': "Description of the payment",
+            'user': reverse('user-detail', args=[self.user.id]),
+        }
+
+        responses_content = [
+            json.loads(self.client.post(
+                reverse('custompayment-list'),
+                data,
+                format='json',
+                HTTP_IDEMPOTENCY_KEY='payment-key',
+            ).content) for _ in range(2)
+        ]
+
+        self.assertEqual(responses_content[0]['id'], 3)
+        self.assertEqual(responses_content[0], responses_content[1])
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
     @responses.activate
     def test_create_with_invalid_single_use_token(self):
         """
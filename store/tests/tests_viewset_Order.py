@@ -1,6 +1,8 @@
+import hashlib
 import json
 
 from datetime import datetime, timedelta
+from smtplib import SMTPException
 
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
@@ -9,7 +11,8 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.core import mail
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from django.urls import reverse
 
@@ -17,11 +20,15 @@ import pytz
 import responses
 from unittest import mock
 
+from blitz_api.exceptions import InsufficientTicketsError
 from blitz_api.factories import UserFactory, AdminFactory
 from blitz_api.models import AcademicLevel
 
-from workplace.models import TimeSlot, Period, Workplace
+from workplace.models import (TimeSlot, Period, Workplace,
+                              TimeSlotAvailability, )
+from workplace.services import update_availability
 from retirement.models import Retirement, WaitQueueNotification, WaitQueue
+from retirement.models import Reservation as RetirementReservation
 
 from .paysafe_sample_responses import (SAMPLE_PROFILE_RESPONSE,
                                        SAMPLE_PAYMENT_RESPONSE,
@@ -29,11 +36,14 @@ from .paysafe_sample_responses import (SAMPLE_PROFILE_RESPONSE,
                                        SAMPLE_INVALID_PAYMENT_TOKEN,
                                        SAMPLE_INVALID_SINGLE_USE_TOKEN,
                                        SAMPLE_CARD_ALREADY_EXISTS,
-                                       SAMPLE_CARD_REFUSED,)
+                                       SAMPLE_CARD_REFUSED,
+                                       SAMPLE_REFUND_RESPONSE,
+                                       UNKNOWN_EXCEPTION,)
 
 
 from ..models import (Package, Order, OrderLine, Membership, PaymentProfile,
-                      Coupon, CouponUser, )
+                      Coupon, CouponUser, IdempotencyKey, )
+from ..services import release_expired_orders
 
 User = get_user_model()
 
@@ -50,6 +60,8 @@ LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
         'CARD_URL': "cardpayments/v1/"
     }
 )
+# Test transactions are never committed: commit hooks are run right away
+@mock.patch('django.db.transaction.on_commit', new=lambda func: func())
 class OrderTests(APITestCase):
 
     @classmethod
@@ -216,6 +228,7 @@ class OrderTests(APITestCase):
             uses=5,
             coupon=cls.coupon,
         )
+        cls.coupon.update_total_uses()
 
     @responses.activate
     def test_create_with_payment_token(self):
@@ -329,6 +342,10 @@ class OrderTests(APITestCase):
         self.coupon_user.refresh_from_db()
         self.assertEqual(self.coupon_user.uses, old_uses + 1)
 
+        old_total_uses = self.coupon.total_uses
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.total_uses, old_total_uses + 1)
+
         admin = self.admin
         admin.refresh_from_db()
 
@@ -352,6 +369,202 @@ class OrderTests(APITestCase):
         # 1 email for the retirement informations
         self.assertEqual(len(mail.outbox), 2)
 
+    @responses.activate
+    def test_create_idempotency_key(self):
+        """
+        Ensure an order sent twice with the same Idempotency-Key is only
+        created and charged once.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_PAYMENT_RESPONSE,
+            status=200
+        )
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+        orders_count = Order.objects.count()
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='order-key',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+        replayed_response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='order-key',
+        )
+
+        self.assertEqual(replayed_response.status_code, response.status_code)
+        self.assertEqual(
+            json.loads(replayed_response.content),
+            json.loads(response.content),
+        )
+        self.assertEqual(replayed_response['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(Order.objects.count(), orders_count + 1)
+
+        # The key can't be reused for another request
+        data['order_lines'][0]['quantity'] = 2
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='order-key',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            response.content,
+        )
+
+        admin = self.admin
+        admin.membership = None
+        admin.save()
+
+        # 1 email for the order details
+        self.assertEqual(len(mail.outbox), 1)
+
+    @responses.activate
+    def test_create_idempotency_key_failed_request(self):
+        """
+        Ensure a failed order can be retried with the same Idempotency-Key.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_CARD_REFUSED,
+            status=400
+        )
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+
+        for _ in range(2):
+            response = self.client.post(
+                reverse('order-list'),
+                data,
+                format='json',
+                HTTP_IDEMPOTENCY_KEY='order-key',
+            )
+
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_400_BAD_REQUEST,
+                response.content,
+            )
+            # The authenticated user instance is modified by the failed
+            # request even if the changes are not saved.
+            self.admin.membership = None
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_create_idempotency_key_in_flight(self):
+        """
+        Ensure a request with the Idempotency-Key of a request that is still
+        processed is refused, until the lock of the key expires and the
+        retry takes the key over.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_PAYMENT_RESPONSE,
+            status=200
+        )
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+        idempotency_key = IdempotencyKey.objects.create(
+            user=self.admin,
+            key='order-key',
+            request_path=' '.join(['POST', reverse('order-list')]),
+            request_hash=hashlib.sha256(
+                json.dumps(data, sort_keys=True).encode()
+            ).hexdigest(),
+            locked_at=timezone.now(),
+        )
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='order-key',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_409_CONFLICT,
+            response.content,
+        )
+
+        # The worker processing the first request died
+        idempotency_key.locked_at = timezone.now() - timedelta(
+            seconds=settings.LOCAL_SETTINGS[
+                'IDEMPOTENCY_KEY_LOCK_TIMEOUT_SECONDS'
+            ] + 1
+        )
+        idempotency_key.save()
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+            HTTP_IDEMPOTENCY_KEY='order-key',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content,
+        )
+
+        idempotency_key.refresh_from_db()
+
+        self.assertEqual(idempotency_key.response_status, 201)
+        self.assertIsNone(idempotency_key.locked_at)
+
+        admin = self.admin
+        admin.membership = None
+        admin.save()
+
     @responses.activate
     def test_create_reservation_only(self):
         """
@@ -420,6 +633,152 @@ class OrderTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
     @responses.activate
+    def test_create_email_error(self):
+        """
+        Ensure an order that has been charged stays confirmed when its
+        confirmation email can't be sent.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_PAYMENT_RESPONSE,
+            status=200
+        )
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'package',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+
+        with mock.patch(
+                'blitz_api.services.django_send_mail',
+                side_effect=SMTPException):
+            response = self.client.post(
+                reverse('order-list'),
+                data,
+                format='json',
+            )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content
+        )
+
+        order = Order.objects.latest('id')
+        self.assertEqual(order.status, 'C')
+        self.assertEqual(order.authorization_id, '1')
+
+    def test_create_reservation_tickets_spent(self):
+        """
+        Ensure a reservation is rejected when the tickets of the user were
+        spent by a concurrent order.
+        """
+        user = UserFactory()
+        self.client.force_authenticate(user=user)
+
+        data = {
+            'order_lines': [{
+                'content_type': 'timeslot',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+
+        with mock.patch(
+                'store.serializers.update_tickets',
+                side_effect=InsufficientTicketsError):
+            response = self.client.post(
+                reverse('order-list'),
+                data,
+                format='json',
+            )
+
+        content = {
+            'non_field_errors': [
+                "You don't have enough tickets to make this reservation."
+            ]
+        }
+
+        self.assertEqual(json.loads(response.content), content)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(
+            Order.objects.filter(user=user).exists()
+        )
+
+    @responses.activate
+    def test_create_reservations_queries(self):
+        """
+        Ensure the number of queries to create an order only grows with its
+        number of order lines while validating their product.
+        """
+        user = UserFactory(tickets=10)
+        self.client.force_authenticate(user=user)
+        time_slots = [
+            TimeSlot.objects.create(
+                name="time_slot_{0}".format(index),
+                period=self.period,
+                price=1,
+                start_time=self.time_slot.start_time,
+                end_time=self.time_slot.end_time,
+            ) for index in range(4)
+        ]
+        update_availability([time_slot.id for time_slot in time_slots])
+        # Warm up the content types cache
+        ContentType.objects.get_for_model(TimeSlot)
+
+        def create_order(time_slots):
+            data = {
+                'order_lines': [{
+                    'content_type': 'timeslot',
+                    'object_id': time_slot.id,
+                    'quantity': 1,
+                } for time_slot in time_slots],
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('order-list'),
+                    data,
+                    format='json',
+                )
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_201_CREATED,
+                response.content,
+            )
+            return len(queries)
+
+        queries = create_order(time_slots[:1])
+
+        # Each additional order line only fetches its product
+        self.assertEqual(create_order(time_slots[1:]), queries + 2)
+
+        user.refresh_from_db()
+
+        self.assertEqual(user.tickets, 6)
+        self.assertEqual(
+            TimeSlot.objects.filter(
+                reservations__user=user,
+                reservations__is_active=True,
+            ).count(),
+            4,
+        )
+        # Availability calendars are updated with the reservations
+        self.assertEqual(
+            list(
+                TimeSlotAvailability.objects.filter(
+                    timeslot__in=time_slots,
+                ).values_list('reserved', flat=True)
+            ),
+            [1, 1, 1, 1],
+        )
+
     def test_create_reservation_twice(self):
         """
         Ensure we can't create an order for the same reservation twice.
@@ -1706,6 +2065,194 @@ class OrderTests(APITestCase):
         self.assertEqual(user.tickets, 1)
         self.assertEqual(user.membership, None)
 
+    @responses.activate
+    def test_create_payment_issue_releases_order(self):
+        """
+        Ensure seats, tickets and coupon uses held while charging the user
+        are released when the payment fails.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            json=SAMPLE_CARD_REFUSED,
+            status=400
+        )
+
+        orders = Order.objects.count()
+        tickets = User.objects.get(pk=self.admin.pk).tickets
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'coupon': "ABCD1234",
+            'order_lines': [{
+                'content_type': 'package',
+                'object_id': 1,
+                'quantity': 1,
+            }, {
+                'content_type': 'timeslot',
+                'object_id': self.time_slot.id,
+                'quantity': 1,
+            }, {
+                'content_type': 'retirement',
+                'object_id': self.retirement.id,
+                'quantity': 1,
+            }],
+        }
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.admin.refresh_from_db()
+        self.retirement.refresh_from_db()
+        self.coupon_user.refresh_from_db()
+
+        self.assertEqual(Order.objects.count(), orders)
+        self.assertEqual(self.admin.tickets, tickets)
+        self.assertEqual(self.coupon_user.uses, 5)
+        self.assertEqual(self.retirement.reserved_seats, 1)
+        self.assertFalse(
+            self.time_slot.reservations.filter(user=self.admin).exists()
+        )
+        self.assertFalse(
+            RetirementReservation.objects.filter(user=self.admin).exists()
+        )
+
+    @responses.activate
+    def test_create_order_expired_during_payment(self):
+        """
+        Ensure the user is refunded when the order expires and is released
+        while the payment is processed.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        def expire_order(request):
+            Order.objects.filter(status='P').update(
+                pending_until=timezone.now() - timedelta(minutes=1)
+            )
+            release_expired_orders()
+            return 200, {}, json.dumps(SAMPLE_PAYMENT_RESPONSE)
+
+        responses.add_callback(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            callback=expire_order,
+            content_type='application/json',
+        )
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/"
+            "settlements/1/refunds",
+            json=SAMPLE_REFUND_RESPONSE,
+            status=200
+        )
+
+        orders = Order.objects.count()
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': self.membership.id,
+                'quantity': 1,
+            }],
+        }
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'non_field_errors': [
+                "Your order expired before the payment was completed. "
+                "You have not been charged."
+            ]
+        }
+
+        self.assertEqual(json.loads(response.content), content)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.admin.refresh_from_db()
+
+        self.assertEqual(Order.objects.count(), orders)
+        self.assertEqual(self.admin.membership, None)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_create_order_expired_during_payment_refund_error(self):
+        """
+        Ensure a charge is kept in a failed order when the order expires and
+        is released while the payment is processed, and the user can't be
+        refunded.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        def expire_order(request):
+            Order.objects.filter(status='P').update(
+                pending_until=timezone.now() - timedelta(minutes=1)
+            )
+            release_expired_orders()
+            return 200, {}, json.dumps(SAMPLE_PAYMENT_RESPONSE)
+
+        responses.add_callback(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/auths/",
+            callback=expire_order,
+            content_type='application/json',
+        )
+
+        responses.add(
+            responses.POST,
+            "http://example.com/cardpayments/v1/accounts/0123456789/"
+            "settlements/1/refunds",
+            json=UNKNOWN_EXCEPTION,
+            status=400
+        )
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': self.membership.id,
+                'quantity': 1,
+            }],
+        }
+
+        response = self.client.post(
+            reverse('order-list'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'non_field_errors': [
+                "Your order expired before the payment was completed. "
+                "You will be refunded shortly."
+            ]
+        }
+
+        self.assertEqual(json.loads(response.content), content)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        failed_order = Order.objects.get(status='F')
+
+        self.assertEqual(failed_order.user, self.admin)
+        self.assertEqual(failed_order.settlement_id, '1')
+        self.assertEqual(failed_order.reference_number, '751')
+        self.assertFalse(failed_order.order_lines.exists())
+        self.assertEqual(len(responses.calls), 2)
+
     @responses.activate
     def test_create_with_single_use_token_existing_card(self):
         """
@@ -2315,6 +2862,216 @@ class OrderTests(APITestCase):
 
         self.assertEqual(response_data, content)
 
+    def test_validate_coupon_read_only(self):
+        """
+        Ensure that validating a coupon doesn't write in the database.
+        """
+        user = UserFactory(
+            faculty="Random faculty",
+            student_number="Random code",
+            academic_program_code="Random code",
+        )
+        self.client.force_authenticate(user=user)
+
+        data = {
+            'order_lines': [{
+                'content_type': 'package',
+                'object_id': 1,
+                'quantity': 2,
+            }, {
+                'content_type': 'retirement',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+            'coupon': "ABCD1234",
+        }
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('order-validate-coupon'),
+                data,
+                format='json',
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        statements = [query['sql'].split()[0] for query in queries]
+
+        self.assertNotIn('INSERT', statements)
+        self.assertNotIn('UPDATE', statements)
+        self.assertNotIn('DELETE', statements)
+        self.assertFalse(
+            CouponUser.objects.filter(user=user).exists()
+        )
+
+    def test_quote(self):
+        """
+        Ensure we can get the cost of an order before creating it.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            'payment_token': "CZgD1NlBzPuSefg",
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': 1,
+                'quantity': 1,
+            }, {
+                'content_type': 'package',
+                'object_id': 1,
+                'quantity': 2,
+            }, {
+                'content_type': 'timeslot',
+                'object_id': 1,
+                'quantity': 1,
+            }, {
+                'content_type': 'retirement',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+            'coupon': "ABCD1234",
+        }
+
+        response = self.client.post(
+            reverse('order-quote'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            response.content,
+        )
+
+        content = {
+            'order_lines': [{
+                'content_type': 'membership',
+                'object_id': 1,
+                'quantity': 1,
+                'cost': 50.0,
+                'coupon': None,
+                'coupon_real_value': 0.0,
+            }, {
+                'content_type': 'package',
+                'object_id': 1,
+                'quantity': 2,
+                'cost': 70.0,
+                'coupon': "ABCD1234",
+                'coupon_real_value': 10.0,
+            }, {
+                'content_type': 'timeslot',
+                'object_id': 1,
+                'quantity': 1,
+                'cost': 0.0,
+                'coupon': None,
+                'coupon_real_value': 0.0,
+            }, {
+                'content_type': 'retirement',
+                'object_id': 1,
+                'quantity': 1,
+                'cost': 199.0,
+                'coupon': None,
+                'coupon_real_value': 0.0,
+            }],
+            'discount': 10.0,
+            'subtotal': 389.0,
+            'tax': 58.25,
+            'total': 447.25,
+        }
+
+        self.assertEqual(json.loads(response.content), content)
+
+    def test_quote_invalid_product(self):
+        """
+        Ensure we can't get the cost of an order with unknown products.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            'order_lines': [{
+                'content_type': 'package',
+                'object_id': 999,
+                'quantity': 1,
+            }, {
+                'content_type': 'invalid',
+                'object_id': 1,
+                'quantity': 1,
+            }],
+        }
+
+        response = self.client.post(
+            reverse('order-quote'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'order_lines': [
+                {},
+                {'content_type': ['Object with model=invalid does not exist.']}
+            ]
+        }
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), content)
+
+        del data['order_lines'][1]
+
+        response = self.client.post(
+            reverse('order-quote'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'order_lines': {
+                'object_id': ['The referenced object does not exist.']
+            }
+        }
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), content)
+
+    def test_quote_queries(self):
+        """
+        Ensure the number of queries to get the cost of an order doesn't
+        depend on its number of order lines, and that nothing is written.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        def quote(package_ids):
+            data = {
+                'order_lines': [{
+                    'content_type': 'package',
+                    'object_id': package_id,
+                    'quantity': 1,
+                } for package_id in package_ids],
+                'coupon': "ABCD1234",
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('order-quote'),
+                    data,
+                    format='json',
+                )
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_200_OK,
+                response.content,
+            )
+            return [query['sql'].split()[0] for query in queries]
+
+        statements = quote([self.package.id])
+
+        self.assertEqual(
+            len(quote([self.package.id, self.package2.id] * 5)),
+            len(statements),
+        )
+        self.assertNotIn('INSERT', statements)
+        self.assertNotIn('UPDATE', statements)
+        self.assertNotIn('DELETE', statements)
+
     def test_validate_coupon_full_discount(self):
         """
         Ensure that we can validate a coupon with 100% discount.
@@ -9,6 +9,8 @@ from django.utils import timezone
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from blitz_api.factories import UserFactory, AdminFactory
 from blitz_api.models import AcademicLevel
@@ -589,6 +591,37 @@ class OrderLineTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_admin_queries(self):
+        """
+        Ensure the number of queries doesn't grow with the number of listed
+        order lines.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(
+                reverse('orderline-list'),
+                format='json',
+            )
+
+        OrderLine.objects.bulk_create([
+            OrderLine(
+                order=self.order_admin,
+                quantity=1,
+                content_type=self.package_type,
+                object_id=self.package.id,
+                cost=self.package.price,
+            ) for _ in range(5)
+        ])
+
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(
+                reverse('orderline-list'),
+                format='json',
+            )
+
+        self.assertEqual(json.loads(response.content)['count'], 7)
+
     def test_read_unauthenticated(self):
         """
         Ensure we can't read an order line as an unauthenticated user.
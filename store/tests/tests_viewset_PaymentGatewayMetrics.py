@@ -0,0 +1,95 @@
+import responses
+
+from django.test.utils import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+
+from blitz_api.factories import AdminFactory, UserFactory
+
+from ..gateway import get_client
+from ..services import get_external_payment_profile
+from .paysafe_sample_responses import SAMPLE_PROFILE_RESPONSE
+
+
+@override_settings(
+    PAYSAFE={
+        'ACCOUNT_NUMBER': "0123456789",
+        'USER': "user",
+        'PASSWORD': "password",
+        'BASE_URL': "http://example.com/",
+        'VAULT_URL': "customervault/v1/",
+        'CARD_URL': "cardpayments/v1/",
+    }
+)
+class PaymentGatewayMetricsTests(APITestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(PaymentGatewayMetricsTests, cls).setUpClass()
+        cls.client = APIClient()
+        cls.user = UserFactory()
+        cls.admin = AdminFactory()
+
+    def setUp(self):
+        get_client().reset_latencies()
+
+    @responses.activate
+    def test_list(self):
+        """
+        Ensure admins can see the metrics of the payment API calls.
+        """
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+        get_external_payment_profile('123')
+
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get(reverse('payment_gateway_metrics-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        content = response.json()
+
+        self.assertEqual(content['circuit_breaker'], 'closed')
+        self.assertEqual(list(content['endpoints']), ['vault.get_profile'])
+        self.assertEqual(
+            content['endpoints']['vault.get_profile']['statuses'],
+            {'200': 1},
+        )
+
+    def test_list_without_permission(self):
+        """
+        Ensure users can't see the metrics.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.get(reverse('payment_gateway_metrics-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @responses.activate
+    def test_reset(self):
+        """
+        Ensure admins can reset the metrics.
+        """
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+        get_external_payment_profile('123')
+
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.delete(
+            reverse('payment_gateway_metrics-reset'),
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(get_client().get_latencies(), {})
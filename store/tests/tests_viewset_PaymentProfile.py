@@ -231,6 +231,70 @@ class PaymentProfileTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    @responses.activate
+    def test_read_local_cards(self):
+        """
+        Ensure cards are only fetched from the external API once.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+
+        self.client.get(reverse('paymentprofile-list'))
+        response = self.client.get(
+            reverse(
+                'paymentprofile-detail',
+                kwargs={'pk': 1},
+            ),
+        )
+
+        data = json.loads(response.content)
+
+        self.assertEqual(data['cards'][0]['id'], '456')
+        self.assertEqual(
+            data['cards'][0]['card_expiry'],
+            {'month': 12, 'year': 2019},
+        )
+        # Both profiles share the same external profile
+        self.assertEqual(len(responses.calls), 1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @responses.activate
+    def test_refresh_cards(self):
+        """
+        Ensure we can synchronize the cards of our payment profile.
+        """
+        self.client.force_authenticate(user=self.user)
+        self.payment_profile.cards.create(external_api_id="1")
+
+        responses.add(
+            responses.GET,
+            "http://example.com/customervault/v1/profiles/123?fields=cards",
+            json=SAMPLE_PROFILE_RESPONSE,
+            status=200
+        )
+
+        response = self.client.post(
+            reverse(
+                'paymentprofile-refresh-cards',
+                kwargs={'pk': 1},
+            ),
+        )
+
+        data = json.loads(response.content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [card['id'] for card in data['cards']],
+            ['456'],
+        )
+
     def test_read_without_permission(self):
         """
         Ensure a user can't read other users payment profile.
@@ -348,6 +412,38 @@ class PaymentProfileTests(APITestCase):
             response.content
         )
 
+    @responses.activate
+    def test_delete_card_local_copy(self):
+        """
+        Ensure the local copy of a deleted card is removed.
+        """
+        self.client.force_authenticate(user=self.user)
+        self.payment_profile.cards.create(external_api_id="1")
+
+        responses.add(
+            responses.DELETE,
+            "http://example.com/customervault/v1/profiles/123/cards/1",
+            json="",
+            status=204
+        )
+
+        response = self.client.delete(
+            reverse(
+                'paymentprofile-cards',
+                kwargs={
+                    'pk': self.payment_profile.pk,
+                    'card_id': 1,
+                },
+            ),
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_204_NO_CONTENT,
+            response.content
+        )
+        self.assertFalse(self.payment_profile.cards.exists())
+
     @responses.activate
     def test_delete_card_as_admin(self):
         """
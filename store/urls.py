@@ -39,6 +39,11 @@ router.register('custom_payments', views.CustomPaymentViewSet)
 router.register('coupons', views.CouponViewSet)
 router.register('coupon_uses', views.CouponUserViewSet)
 router.register('refunds', views.RefundViewSet)
+router.register(
+    'payment_gateway_metrics',
+    views.PaymentGatewayMetricsViewSet,
+    base_name='payment_gateway_metrics',
+)
 # router.register('payment_profiles', views.PaymentProfileViewSet)
 
 router.registry.extend(router_extra.registry)
@@ -3,8 +3,8 @@ import pytz
 from datetime import datetime
 
 from django.conf import settings
+from django.db.models import Prefetch
 from django.http import Http404, HttpResponse
-from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from rest_framework import viewsets, status, mixins, exceptions
@@ -13,9 +13,10 @@ from rest_framework.decorators import action, permission_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 
-from blitz_api.services import ExportPagination
+from blitz_api.services import ExportPagination, stream_export
 
 from .exceptions import PaymentAPIError
+from .gateway import get_client
 from .models import (Package, Membership, Order, OrderLine, PaymentProfile,
                      CustomPayment, Coupon, CouponUser, Refund, )
 from .permissions import IsOwner
@@ -23,7 +24,9 @@ from .resources import (MembershipResource, PackageResource, OrderResource,
                         OrderLineResource, CustomPaymentResource,
                         CouponResource, CouponUserResource, RefundResource, )
 from .services import (delete_external_card, validate_coupon_for_order,
-                       notify_for_coupon, )
+                       notify_for_coupon, sync_external_cards,
+                       idempotent_request, create_generated_coupons,
+                       quote_order, )
 
 from . import serializers, permissions
 
@@ -61,6 +64,14 @@ class MembershipViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                MembershipResource(),
+                queryset,
+                'Membership',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -124,6 +135,14 @@ class PackageViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                PackageResource(),
+                queryset,
+                'Package',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -167,6 +186,10 @@ class PaymentProfileViewSet(
 
     list:
     Return a list of all the existing payment profiles.
+
+    refresh_cards:
+    Synchronize the cards of the given payment profile with the external
+    payment API.
     """
     serializer_class = serializers.PaymentProfileSerializer
     queryset = PaymentProfile.objects.all()
@@ -192,14 +215,31 @@ class PaymentProfileViewSet(
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=['post'])
+    def refresh_cards(self, request, pk=None):
+        payment_profile = self.get_object()
+        try:
+            sync_external_cards(payment_profile.external_api_id)
+        except PaymentAPIError as err:
+            return Response(
+                {'message': str(err)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = self.get_serializer(self.get_object())
+
+        return Response(serializer.data)
+
     def get_queryset(self):
         """
         This viewset should return a user's credit cards except if the
         currently authenticated user is an admin (is_staff).
         """
         if self.request.user.is_staff:
-            return PaymentProfile.objects.all()
-        return PaymentProfile.objects.filter(owner=self.request.user)
+            queryset = PaymentProfile.objects.all()
+        else:
+            queryset = PaymentProfile.objects.filter(owner=self.request.user)
+        return queryset.prefetch_related('cards')
 
 
 class OrderViewSet(viewsets.ModelViewSet):
@@ -212,17 +252,25 @@ class OrderViewSet(viewsets.ModelViewSet):
 
     create:
     Create a new order instance.
+    Requests sent with an "Idempotency-Key" header are processed only once.
     """
     serializer_class = serializers.OrderSerializer
     queryset = Order.objects.all()
     permission_classes = (permissions.IsAdminOrCreateReadOnly, IsAuthenticated)
 
+    @idempotent_request
+    def create(self, request, *args, **kwargs):
+        return super(OrderViewSet, self).create(request, *args, **kwargs)
+
     @action(detail=False, permission_classes=[IsAdminUser])
     def export(self, request):
         # Use custom paginator (by page, min/max 1000 objects/page)
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(request, OrderResource(), queryset, 'Order')
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -242,10 +290,7 @@ class OrderViewSet(viewsets.ModelViewSet):
     def validate_coupon(self, request, pk=None):
         """
         This validates if a coupon can be used in an order.
-        It has to create temporary objects to be able to use querysets.
-        Temporary objects are then deleted.
-
-        This is not the best way to do it and it could be improved.
+        Nothing is saved: the coupon is evaluated on unsaved order lines.
         """
         serializer = serializers.OrderSerializer(
             data=request.data,
@@ -260,26 +305,15 @@ class OrderViewSet(viewsets.ModelViewSet):
             return Response(error, status=status.HTTP_400_BAD_REQUEST)
         orderlines = serializer.validated_data.pop('order_lines', None)
         coupon = serializer.validated_data.pop('coupon', None)
-        serializer.validated_data.pop('payment_token', None)
-        serializer.validated_data.pop('single_use_token', None)
-        order = Order(
-            **serializer.validated_data,
-            transaction_date=timezone.now(),
-            user=request.user,
+        orderline_list = [
+            OrderLine(**orderline) for orderline in orderlines
+        ]
+
+        response = validate_coupon_for_order(
+            coupon,
+            request.user,
+            orderline_list,
         )
-        order.save()
-
-        orderline_list = []
-        for idx, orderline in enumerate(orderlines):
-            orderline_list.append(
-                OrderLine(
-                    **orderline,
-                    order=order,
-                )
-            )
-            orderline_list[idx].save()
-
-        response = validate_coupon_for_order(coupon, order)
         response['orderline'] = serializers.OrderLineSerializerNoOrder(
             response['orderline'],
             context={'request': request}
@@ -290,23 +324,54 @@ class OrderViewSet(viewsets.ModelViewSet):
         response['orderline'].pop('coupon', None)
         response['orderline'].pop('coupon_real_value', None)
         response['orderline'].pop('cost', None)
-        order.delete()
-        for orderline in orderline_list:
-            orderline.delete()
         if response['valid_use']:
             response.pop('valid_use', None)
             response.pop('error', None)
             return Response(response)
         return Response(response['error'], status=status.HTTP_400_BAD_REQUEST)
 
+    @action(
+        methods=['post'], detail=False, permission_classes=[IsAuthenticated])
+    def quote(self, request):
+        """
+        This computes the cost of an order, with its coupon discount and tax,
+        from the payload used to create it. Nothing is saved.
+        """
+        serializer = serializers.OrderQuoteSerializer(
+            data=request.data,
+            context={'request': request}
+        )
+        serializer.is_valid(raise_exception=True)
+
+        response = quote_order(
+            request.user,
+            serializer.validated_data['order_lines'],
+            serializer.validated_data.get('coupon'),
+        )
+        if 'error' in response:
+            return Response(
+                response['error'],
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(response)
+
     def get_queryset(self):
         """
         This viewset should return owned orders except if
         the currently authenticated user is an admin (is_staff).
         """
+        queryset = Order.objects.prefetch_related(
+            Prefetch(
+                'order_lines',
+                queryset=OrderLine.objects.select_related(
+                    'content_type',
+                    'coupon',
+                ),
+            )
+        )
         if self.request.user.is_staff:
-            return Order.objects.all()
-        return Order.objects.filter(user=self.request.user.id)
+            return queryset
+        return queryset.filter(user=self.request.user.id)
 
 
 class OrderLineViewSet(viewsets.ModelViewSet):
@@ -329,7 +394,15 @@ class OrderLineViewSet(viewsets.ModelViewSet):
         # Use custom paginator (by page, min/max 1000 objects/page)
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
-        queryset = self.get_queryset().order_by('pk')
+        queryset = self.get_queryset().with_content_objects().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                OrderLineResource(),
+                queryset,
+                'OrderLine',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -349,9 +422,10 @@ class OrderLineViewSet(viewsets.ModelViewSet):
         This viewset should return owned order lines except if
         the currently authenticated user is an admin (is_staff).
         """
+        queryset = OrderLine.objects.select_related('content_type', 'coupon')
         if self.request.user.is_staff:
-            return OrderLine.objects.all()
-        return OrderLine.objects.filter(order__user=self.request.user)
+            return queryset
+        return queryset.filter(order__user=self.request.user)
 
 
 class CustomPaymentViewSet(viewsets.ModelViewSet):
@@ -364,18 +438,35 @@ class CustomPaymentViewSet(viewsets.ModelViewSet):
 
     create:
     Create a new custom payment instance.
+    Requests sent with an "Idempotency-Key" header are processed only once.
     """
     serializer_class = serializers.CustomPaymentSerializer
     queryset = CustomPayment.objects.all()
     permission_classes = (IsAuthenticated, permissions.IsAdminOrReadOnly)
     filter_fields = '__all__'
 
+    @idempotent_request
+    def create(self, request, *args, **kwargs):
+        return super(CustomPaymentViewSet, self).create(
+            request,
+            *args,
+            **kwargs
+        )
+
     @action(detail=False, permission_classes=[IsAdminUser])
     def export(self, request):
         # Use custom paginator (by page, min/max 1000 objects/page)
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                CustomPaymentResource(),
+                queryset,
+                'CustomPayment',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -425,6 +516,9 @@ class CouponViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(request, CouponResource(), queryset, 'Coupon')
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -439,6 +533,37 @@ class CouponViewSet(viewsets.ModelViewSet):
         ])
         return response
 
+    @action(methods=['post'], detail=False, permission_classes=[IsAdminUser])
+    def batch(self, request):
+        """
+        That custom action creates "count" coupons at once, with generated
+        codes and the other attributes of a coupon. Only the generated codes
+        are returned.
+        """
+        serializer = serializers.CouponBatchSerializer(
+            data=request.data,
+            context=self.get_serializer_context(),
+        )
+        serializer.is_valid(raise_exception=True)
+        attrs = serializer.validated_data
+        count = attrs.pop('count')
+
+        coupons = create_generated_coupons(count, **attrs)
+        if not coupons:
+            raise exceptions.ValidationError({
+                'non_field_errors': [_(
+                    "Can't generate new unique codes. Delete old coupons."
+                )]
+            })
+
+        return Response(
+            {
+                'count': len(coupons),
+                'codes': [coupon.code for coupon in coupons],
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
     @action(methods=['post'], detail=True, permission_classes=[IsOwner])
     def notify(self, request, pk=None):
         """
@@ -474,23 +599,27 @@ class CouponViewSet(viewsets.ModelViewSet):
                 "email_list": [str(msg) for msg in err.detail]
             })
 
-        for email in email_list:
-            # Notify every user in the list
-            notify_for_coupon(
-                email,
-                self.get_object(),
-            )
+        coupon = self.get_object()
+        results = notify_for_coupon(email_list, coupon)
 
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response({'results': results}, status=status.HTTP_200_OK)
 
     def get_queryset(self):
         """
         This viewset should return owned coupons except if
         the currently authenticated user is an admin (is_staff).
         """
+        queryset = Coupon.objects.prefetch_related(
+            'applicable_product_types',
+            'applicable_retirements',
+            'applicable_timeslots',
+            'applicable_packages',
+            'applicable_memberships',
+            'users',
+        )
         if self.request.user.is_staff:
-            return Coupon.objects.all()
-        return Coupon.objects.filter(owner=self.request.user)
+            return queryset
+        return queryset.filter(owner=self.request.user)
 
     def destroy(self, request, *args, **kwargs):
         try:
@@ -509,6 +638,19 @@ class CouponUserViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, IsAdminUser)
     filter_fields = '__all__'
 
+    def perform_create(self, serializer):
+        serializer.save().coupon.update_total_uses()
+
+    def perform_update(self, serializer):
+        coupon = serializer.instance.coupon
+        serializer.save().coupon.update_total_uses()
+        if coupon != serializer.instance.coupon:
+            coupon.update_total_uses()
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        instance.coupon.update_total_uses()
+
     @action(detail=False, permission_classes=[IsAdminUser])
     def export(self, request):
         # Use custom paginator (by page, min/max 1000 objects/page)
@@ -517,6 +659,14 @@ class CouponUserViewSet(viewsets.ModelViewSet):
         queryset = self.get_queryset().order_by('pk')
         # Filter queryset
         queryset = self.filter_queryset(queryset)
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                CouponUserResource(),
+                queryset,
+                'CouponUser',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -562,6 +712,9 @@ class RefundViewSet(viewsets.GenericViewSet,
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(request, RefundResource(), queryset, 'Refund')
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -585,3 +738,28 @@ class RefundViewSet(viewsets.GenericViewSet,
         return Refund.objects.filter(
             orderline__order__user=self.request.user
         )
+
+
+class PaymentGatewayMetricsViewSet(viewsets.ViewSet):
+    """
+    list:
+    Return the metrics of the calls made by this process to the external
+    payment API: latency histogram, HTTP statuses and Paysafe error codes
+    per endpoint, and the state of the circuit breaker.
+
+    reset:
+    Reset the metrics.
+    """
+    permission_classes = (IsAdminUser, )
+
+    def list(self, request):
+        client = get_client()
+        return Response({
+            'circuit_breaker': client.breaker.state,
+            'endpoints': client.get_latencies(),
+        })
+
+    @action(detail=False, methods=['delete'])
+    def reset(self, request):
+        get_client().reset_latencies()
+        return Response(status=status.HTTP_204_NO_CONTENT)
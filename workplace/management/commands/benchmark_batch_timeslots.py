@@ -0,0 +1,166 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from safedelete.models import HARD_DELETE
+
+from workplace.models import Period, TimeSlot, Workplace
+from workplace.serializers import BatchTimeSlotSerializer
+
+LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the batch creation of timeslot schedules, one per ' \
+           'workplace. Benchmark data is created in the configured ' \
+           'database and deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workplaces', default=5, type=int)
+        parser.add_argument('--days', default=365, type=int)
+        parser.add_argument(
+            '--time_ranges',
+            default=2,
+            type=int,
+            help='Number of daily timeslots, each lasting 2 hours',
+        )
+        parser.add_argument(
+            '--max_duration',
+            type=float,
+            help='Fail if creating all the schedules takes longer, in seconds',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            dest='keep',
+            help='Do not delete the benchmark data',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            help='Allow the benchmark to run when DEBUG is False',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(
+                'The benchmark writes in the configured database. Use '
+                '--force to run it when DEBUG is False.'
+            )
+        if not 0 < options['time_ranges'] <= 8:
+            raise CommandError('--time_ranges must be between 1 and 8.')
+
+        run_id = 'benchmark-' + uuid.uuid4().hex[:8]
+        periods = self.create_data(run_id, options)
+
+        try:
+            results = self.run_batches(periods, options)
+        finally:
+            if not options['keep']:
+                self.delete_data(run_id)
+
+        self.report(results, options)
+
+        if (options['max_duration'] is not None and
+                results['duration'] > options['max_duration']):
+            raise CommandError(
+                'Schedules were created in {0:.3f}s, more than the maximum '
+                'of {1}s.'.format(results['duration'], options['max_duration'])
+            )
+
+    def create_data(self, run_id, options):
+        start = LOCAL_TIMEZONE.localize(
+            datetime.combine(datetime.now().date(), datetime.min.time())
+        ) + timedelta(days=1)
+        periods = []
+        for i in range(options['workplaces']):
+            workplace = Workplace.objects.create(
+                name='{0}-{1}'.format(run_id, i),
+                seats=40,
+                address_line1='123 random street',
+                postal_code='123 456',
+                state_province='Random state',
+                country='Random country',
+                timezone=settings.TIME_ZONE,
+            )
+            periods.append(Period.objects.create(
+                name=run_id,
+                workplace=workplace,
+                start_date=start,
+                end_date=start + timedelta(days=options['days']),
+                price=1,
+                is_active=True,
+            ))
+        return periods
+
+    def delete_data(self, run_id):
+        Period.objects.filter(name=run_id).delete(force_policy=HARD_DELETE)
+        Workplace.objects.filter(
+            name__startswith=run_id,
+        ).delete(force_policy=HARD_DELETE)
+
+    def run_batches(self, periods, options):
+        data = {
+            'start_date': periods[0].start_date.date(),
+            'end_date': (
+                periods[0].start_date + timedelta(days=options['days'] - 1)
+            ).date(),
+            'weekdays': list(range(7)),
+            'time_ranges': [
+                {
+                    'start_time': '{0:02d}:00:00'.format(8 + i * 2),
+                    'end_time': '{0:02d}:00:00'.format(8 + i * 2 + 2),
+                }
+                for i in range(options['time_ranges'])
+            ],
+        }
+        validation = creation = 0
+        timeslots = 0
+        for period in periods:
+            start = time.monotonic()
+            serializer = BatchTimeSlotSerializer(data=dict(
+                data,
+                period=reverse('period-detail', args=[period.id]),
+            ))
+            serializer.is_valid(raise_exception=True)
+            validation += time.monotonic() - start
+
+            start = time.monotonic()
+            timeslots += len(serializer.save())
+            creation += time.monotonic() - start
+
+        return {
+            'duration': validation + creation,
+            'validation': validation,
+            'creation': creation,
+            'timeslots': timeslots,
+            'created': TimeSlot.objects.filter(period__in=periods).count(),
+        }
+
+    def report(self, results, options):
+        self.stdout.write(
+            'Schedules: {0} workplaces, {1} days, {2} timeslots/day'.format(
+                options['workplaces'],
+                options['days'],
+                options['time_ranges'],
+            )
+        )
+        self.stdout.write('Timeslots: {timeslots} ({created} saved)'.format(
+            **results
+        ))
+        self.stdout.write(
+            'Generation and validation: {0:.3f}s'.format(results['validation'])
+        )
+        self.stdout.write('Creation: {0:.3f}s'.format(results['creation']))
+        self.stdout.write(self.style.SUCCESS(
+            'Total: {0:.3f}s ({1:.0f} timeslots/s)'.format(
+                results['duration'],
+                results['timeslots'] / results['duration']
+                if results['duration'] else 0,
+            )
+        ))
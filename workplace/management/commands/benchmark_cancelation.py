@@ -0,0 +1,186 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from safedelete.models import HARD_DELETE
+
+from workplace.models import Period, Reservation, TimeSlot, Workplace
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the deletion of a period whose timeslots have many ' \
+           'reservations. Benchmark data is created in the configured ' \
+           'database and deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reservations', default=5000, type=int)
+        parser.add_argument('--users', default=1000, type=int)
+        parser.add_argument('--timeslots', default=50, type=int)
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            dest='keep',
+            help='Do not delete the benchmark data',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            help='Allow the benchmark to run when DEBUG is False',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(
+                'The benchmark writes in the configured database. Use '
+                '--force to run it when DEBUG is False.'
+            )
+        if options['reservations'] > options['users'] * options['timeslots']:
+            raise CommandError(
+                'A user can only reserve each timeslot once: --reservations '
+                'must be at most --users times --timeslots.'
+            )
+
+        run_id = 'benchmark-' + uuid.uuid4().hex[:8]
+        data = self.create_data(run_id, options)
+
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver'],
+                EMAIL_BACKEND='django.core.mail.backends.dummy.EmailBackend',
+                LOCAL_SETTINGS=dict(
+                    settings.LOCAL_SETTINGS,
+                    EMAIL_OUTBOX=False,
+                ),
+            ):
+                results = self.delete_period(data)
+        finally:
+            if not options['keep']:
+                self.delete_data(data)
+
+        self.report(results)
+
+    def create_data(self, run_id, options):
+        now = timezone.now()
+        User.objects.bulk_create([
+            User(
+                username='{0}-{1}@example.com'.format(run_id, i),
+                email='{0}-{1}@example.com'.format(run_id, i),
+                first_name='Benchmark',
+                last_name=str(i),
+                tickets=0,
+            ) for i in range(options['users'])
+        ])
+        users = list(
+            User.objects.filter(username__startswith=run_id).order_by('id')
+        )
+        admin = User.objects.create(
+            username='{0}-admin@example.com'.format(run_id),
+            email='{0}-admin@example.com'.format(run_id),
+            is_staff=True,
+        )
+
+        workplace = Workplace.objects.create(
+            name=run_id,
+            seats=options['users'],
+            address_line1='123 random street',
+            postal_code='123 456',
+            state_province='Random state',
+            country='Random country',
+        )
+        period = Period.objects.create(
+            name=run_id,
+            workplace=workplace,
+            start_date=now,
+            end_date=now + timedelta(days=options['timeslots'] + 1),
+            price=1,
+            is_active=True,
+        )
+        TimeSlot.objects.bulk_create([
+            TimeSlot(
+                period=period,
+                price=1,
+                start_time=now + timedelta(days=i + 1),
+                end_time=now + timedelta(days=i + 1, hours=4),
+            ) for i in range(options['timeslots'])
+        ])
+        timeslots = list(period.time_slots.order_by('id'))
+
+        Reservation.objects.bulk_create([
+            Reservation(
+                user=users[i % len(users)],
+                timeslot=timeslots[i // len(users)],
+                is_active=True,
+            ) for i in range(options['reservations'])
+        ], batch_size=500)
+
+        return {
+            'run_id': run_id,
+            'admin': admin,
+            'workplace': workplace,
+            'period': period,
+        }
+
+    def delete_data(self, data):
+        # Soft-deleted timeslots are not collected when their period is
+        # deleted, they are deleted first.
+        TimeSlot.objects.all_with_deleted().filter(
+            period=data['period'],
+        ).delete(force_policy=HARD_DELETE)
+        data['period'].delete(force_policy=HARD_DELETE)
+        data['workplace'].delete(force_policy=HARD_DELETE)
+        User.objects.filter(username__startswith=data['run_id']).delete()
+
+    def delete_period(self, data):
+        client = APIClient()
+        client.force_authenticate(user=data['admin'])
+        reservations = Reservation.objects.filter(
+            timeslot__period=data['period'],
+            is_active=True,
+        ).count()
+
+        start = time.monotonic()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.delete(
+                reverse('period-detail', args=[data['period'].id]),
+                {'force_delete': True},
+                format='json',
+            )
+        duration = time.monotonic() - start
+
+        return {
+            'status': response.status_code,
+            'duration': duration,
+            'queries': len(queries),
+            'reservations': reservations,
+            'canceled': Reservation.objects.filter(
+                timeslot__period_id=data['period'].id,
+                cancelation_reason='TD',
+            ).count(),
+        }
+
+    def report(self, results):
+        self.stdout.write('Status: {status}'.format(**results))
+        self.stdout.write(
+            'Reservations: {reservations} ({canceled} canceled)'.format(
+                **results
+            )
+        )
+        self.stdout.write('Queries: {queries}'.format(**results))
+        self.stdout.write(self.style.SUCCESS(
+            'Duration: {0:.3f}s ({1:.0f} reservations/s)'.format(
+                results['duration'],
+                results['reservations'] / results['duration']
+                if results['duration'] else 0,
+            )
+        ))
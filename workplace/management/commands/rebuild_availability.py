@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from workplace.models import TimeSlotAvailability
+from workplace.services import rebuild_availability
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the availability of every timeslot from its active ' \
+           'reservations.'
+
+    def handle(self, *args, **options):
+        rebuild_availability()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt the availability of {0} timeslots'.format(
+                TimeSlotAvailability.objects.count()
+            )
+        ))
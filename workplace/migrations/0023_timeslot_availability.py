@@ -0,0 +1,72 @@
+# Generated by Django 2.0.8 on 2026-10-18 04:13
+
+import pytz
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def compute_availability(apps, schema_editor):
+    '''
+    Initialize the availability of the existing (not deleted) time slots
+    from their active reservations.
+    '''
+    TimeSlot = apps.get_model('workplace', 'TimeSlot')
+    TimeSlotAvailability = apps.get_model('workplace', 'TimeSlotAvailability')
+    timeslots = TimeSlot.objects.filter(
+        deleted__isnull=True,
+        period__deleted__isnull=True,
+        period__workplace__isnull=False,
+    ).select_related('period__workplace').annotate(
+        reserved=Count(
+            'reservations',
+            filter=Q(
+                reservations__is_active=True,
+                reservations__deleted__isnull=True,
+            ),
+        ),
+    )
+    TimeSlotAvailability.objects.bulk_create(
+        TimeSlotAvailability(
+            timeslot_id=timeslot.pk,
+            workplace_id=timeslot.period.workplace_id,
+            date=timeslot.start_time.astimezone(pytz.timezone(
+                timeslot.period.workplace.timezone or settings.TIME_ZONE
+            )).date(),
+            start_time=timeslot.start_time,
+            end_time=timeslot.end_time,
+            reserved=timeslot.reserved,
+        )
+        for timeslot in timeslots.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workplace', '0022_workplace_volunteers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeSlotAvailability',
+            fields=[
+                ('timeslot', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='availability', serialize=False, to='workplace.TimeSlot', verbose_name='Time slot')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('start_time', models.DateTimeField(verbose_name='Start time')),
+                ('end_time', models.DateTimeField(verbose_name='End time')),
+                ('reserved', models.PositiveIntegerField(default=0, verbose_name='Reserved seats')),
+                ('workplace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availabilities', to='workplace.Workplace', verbose_name='Workplace')),
+            ],
+            options={
+                'verbose_name': 'Time slot availability',
+                'verbose_name_plural': 'Time slot availabilities',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='timeslotavailability',
+            index_together={('workplace', 'date')},
+        ),
+        migrations.RunPython(compute_availability, migrations.RunPython.noop),
+    ]
@@ -244,3 +244,46 @@ class Reservation(SafeDeleteModel):
 
     def __str__(self):
         return str(self.user)
+
+
+class TimeSlotAvailability(models.Model):
+    """
+    Materialized number of active reservations of a time slot. Rows are
+    updated along with reservations so availability calendars can be built
+    without counting reservations.
+    """
+
+    class Meta:
+        verbose_name = _("Time slot availability")
+        verbose_name_plural = _("Time slot availabilities")
+        index_together = (('workplace', 'date'),)
+
+    timeslot = models.OneToOneField(
+        TimeSlot,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        verbose_name=_("Time slot"),
+        related_name='availability',
+    )
+    workplace = models.ForeignKey(
+        Workplace,
+        on_delete=models.CASCADE,
+        verbose_name=_("Workplace"),
+        related_name='availabilities',
+    )
+    date = models.DateField(
+        verbose_name=_("Date"),
+    )
+    start_time = models.DateTimeField(
+        verbose_name=_("Start time"),
+    )
+    end_time = models.DateTimeField(
+        verbose_name=_("End time"),
+    )
+    reserved = models.PositiveIntegerField(
+        verbose_name=_("Reserved seats"),
+        default=0,
+    )
+
+    def __str__(self):
+        return str(self.timeslot_id)
@@ -1,6 +1,6 @@
-from copy import copy
+from collections import namedtuple
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from dateutil.parser import parse
 from dateutil.rrule import rrule, DAILY
@@ -12,11 +12,7 @@ from rest_framework.reverse import reverse
 from rest_framework.validators import UniqueValidator
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
-from django.db import transaction
-from django.db.models import F
-from django.template.loader import render_to_string
+from django.db import connection, transaction
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -24,10 +20,11 @@ from blitz_api.serializers import UserSerializer
 from blitz_api.services import (remove_translation_fields,
                                 check_if_translated_field,)
 
-from .models import Workplace, Picture, Period, TimeSlot, Reservation
+from .models import (Workplace, Picture, Period, TimeSlot, Reservation,
+                     TimeSlotAvailability, )
 from .fields import TimezoneField
-
-User = get_user_model()
+from .services import (build_availability, cancel_reservations,
+                       find_overlaps, update_availability, )
 
 
 class WorkplaceSerializer(serializers.HyperlinkedModelSerializer):
@@ -305,37 +302,31 @@ class TimeSlotSerializer(serializers.HyperlinkedModelSerializer):
         max_length=1000,
     )
 
-    def get_reservations(self, obj):
-        reservation_ids = Reservation.objects.filter(
-            is_active=True,
-            timeslot=obj,
-        ).values_list('id', flat=True)
+    def get_reservation_urls(self, obj, is_active):
+        # Reservations are prefetched when listing timeslots
         return [
             reverse(
                 'reservation-detail',
-                args=[id],
+                args=[reservation.id],
                 request=self.context['request']
-            ) for id in reservation_ids
+            ) for reservation in obj.reservations.all()
+            if reservation.is_active == is_active
         ]
 
+    def get_reservations(self, obj):
+        return self.get_reservation_urls(obj, True)
+
     def get_reservations_canceled(self, obj):
-        reservation_ids = Reservation.objects.filter(
-            is_active=False,
-            timeslot=obj,
-        ).values_list('id', flat=True)
-        return [
-            reverse(
-                'reservation-detail',
-                args=[id],
-                request=self.context['request']
-            ) for id in reservation_ids
-        ]
+        return self.get_reservation_urls(obj, False)
 
     def get_places_remaining(self, obj):
         if not obj.period.workplace:
             return 0
         seats = obj.period.workplace.seats
-        reservations = obj.reservations.filter(is_active=True).count()
+        # Active reservations are annotated when listing timeslots
+        reservations = getattr(obj, 'active_reservations', None)
+        if reservations is None:
+            reservations = obj.reservations.filter(is_active=True).count()
         return seats - reservations
 
     def validate(self, attrs):
@@ -432,52 +423,22 @@ class TimeSlotSerializer(serializers.HyperlinkedModelSerializer):
         provided in the request. If provided, cancel reservations and refund
         affected users tickets.
         """
-        if instance.reservations.filter(is_active=True).exists():
-            if (validated_data.get('start_time') or
-                    validated_data.get('end_time')):
-                custom_message = validated_data.get('custom_message')
-                reservation_cancel = instance.reservations.filter(
-                    is_active=True
-                )
-                affected_users = User.objects.filter(
-                    reservations__in=reservation_cancel
-                )
-
-                reservations_cancel_copy = copy(reservation_cancel)
-
-                affected_users.update(tickets=F('tickets') + 1)
-                reservation_cancel.update(
-                    is_active=False,
-                    cancelation_reason='TM',  # TimeSlot modified
-                    cancelation_date=timezone.now(),
-                )
-
-                for reservation in reservations_cancel_copy:
-                    merge_data = {
-                        'TIMESLOT_LIST': [instance],
-                        'SUPPORT_EMAIL': settings.SUPPORT_EMAIL,
-                        'CUSTOM_MESSAGE': custom_message,
-                    }
-                    plain_msg = render_to_string(
-                        "cancelation.txt",
-                        merge_data
-                    )
-                    msg_html = render_to_string(
-                        "cancelation.html",
-                        merge_data
-                    )
-                    send_mail(
-                        "Annulation d'un bloc de rédaction",
-                        plain_msg,
-                        settings.DEFAULT_FROM_EMAIL,
-                        [reservation.user.email],
-                        html_message=msg_html,
-                    )
+        # Users are notified by the view once the update is committed
+        self.canceled = []
+        if (validated_data.get('start_time') or
+                validated_data.get('end_time')):
+            self.canceled = cancel_reservations(
+                instance.reservations.all(),
+                'TM',  # TimeSlot modified
+            )
 
-        return super(TimeSlotSerializer, self).update(
+        instance = super(TimeSlotSerializer, self).update(
             instance,
             validated_data,
         )
+        update_availability([instance.id])
+
+        return instance
 
     def create(self, validated_data):
         """
@@ -486,7 +447,10 @@ class TimeSlotSerializer(serializers.HyperlinkedModelSerializer):
         if 'price' not in validated_data:
             validated_data['price'] = validated_data['period'].price
 
-        return super().create(validated_data)
+        instance = super().create(validated_data)
+        update_availability([instance.id])
+
+        return instance
 
     def to_representation(self, instance):
         is_staff = self.context['request'].user.is_staff
@@ -522,11 +486,32 @@ class TimeSlotSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
-class BatchTimeSlotSerializer(serializers.HyperlinkedModelSerializer):
+# Start & end times of a timeslot generated by a batch
+Interval = namedtuple('Interval', ('start_time', 'end_time'))
+
+
+class TimeRangeSerializer(serializers.Serializer):
     start_time = serializers.TimeField()
     end_time = serializers.TimeField()
+
+    def validate(self, attrs):
+        if attrs['start_time'] >= attrs['end_time']:
+            raise serializers.ValidationError({
+                'end_time': [_("End time must be later than start_time.")],
+            })
+        return attrs
+
+
+class BatchTimeSlotSerializer(serializers.HyperlinkedModelSerializer):
+    start_time = serializers.TimeField(required=False)
+    end_time = serializers.TimeField(required=False)
+    time_ranges = TimeRangeSerializer(many=True, required=False)
     start_date = serializers.DateField()
     end_date = serializers.DateField()
+    excluded_dates = serializers.ListField(
+        child=serializers.DateField(),
+        required=False,
+    )
     period = serializers.HyperlinkedRelatedField(
         view_name='period-detail',
         queryset=Period.objects.all(),
@@ -548,6 +533,25 @@ class BatchTimeSlotSerializer(serializers.HyperlinkedModelSerializer):
             ))
         return weekdays
 
+    def validate_time_ranges(self, time_ranges):
+        """
+        Check that time ranges are provided and don't overlap each other.
+        """
+        if not time_ranges:
+            raise serializers.ValidationError(_(
+                "At least one time range is required."
+            ))
+        time_ranges = sorted(
+            time_ranges,
+            key=lambda time_range: time_range['start_time'],
+        )
+        for previous, time_range in zip(time_ranges, time_ranges[1:]):
+            if time_range['start_time'] < previous['end_time']:
+                raise serializers.ValidationError(_(
+                    "Time ranges can't overlap each other."
+                ))
+        return time_ranges
+
     def validate(self, attrs):
         validated_data = super(BatchTimeSlotSerializer, self).validate(attrs)
         period = validated_data['period']
@@ -555,8 +559,23 @@ class BatchTimeSlotSerializer(serializers.HyperlinkedModelSerializer):
         period_end_date = period.end_date
         start_date = attrs.get('start_date')
         end_date = attrs.get('end_date')
-        start_time = attrs.get('start_time')
-        end_time = attrs.get('end_time')
+
+        # A single time range can be provided with start_time & end_time
+        time_ranges = attrs.get('time_ranges')
+        if time_ranges is None:
+            if not (attrs.get('start_time') and attrs.get('end_time')):
+                raise serializers.ValidationError({
+                    'time_ranges': [_(
+                        "Provide either start_time and end_time or "
+                        "time_ranges."
+                    )],
+                })
+            time_ranges = [{
+                'start_time': attrs['start_time'],
+                'end_time': attrs['end_time'],
+            }]
+        start_time = time_ranges[0]['start_time']
+        end_time = max(time_range['end_time'] for time_range in time_ranges)
 
         # Use workplace's timezone if possible. Otherwise use Montreal timezone
         if period.workplace and period.workplace.timezone:
@@ -592,80 +611,159 @@ class BatchTimeSlotSerializer(serializers.HyperlinkedModelSerializer):
                 'start_date': [_("Start date must be earlier than end_date.")],
             })
 
-        time_list = TimeSlot.objects.filter(
-            period=validated_data['period']
-        ).values_list('start_time', 'end_time')
-
-        timeslot_data = {
-            'period': validated_data['period'],
-        }
-
-        timeslot_data_list = list()
-
-        # Create a list of start times for timeslots
-        # Naive datetimes are used to avoid problems with DST (not handled by
-        # rrule)
-        timeslot_start_dates = list(
+        timeslot_data_list = list(self.generate_intervals(
+            tz,
             rrule(
                 freq=DAILY,
-                dtstart=aware_start.replace(tzinfo=None),
-                until=aware_end.replace(tzinfo=None),
+                dtstart=start_date,
+                until=end_date,
                 byweekday=validated_data['weekdays'],
-            )
+            ),
+            set(attrs.get('excluded_dates', [])),
+            time_ranges,
+        ))
+
+        validated_data = {
+            'period': period,
+            'intervals': timeslot_data_list,
+        }
+        if not timeslot_data_list:
+            return validated_data
+
+        # Only existing timeslots within the batch's time window can overlap
+        existing_timeslots = list(
+            TimeSlot.objects.filter(
+                period=validated_data['period'],
+                start_time__lt=timeslot_data_list[-1].end_time,
+                end_time__gt=timeslot_data_list[0].start_time,
+            ).order_by('start_time').only('id', 'start_time', 'end_time')
         )
+        overlaps = find_overlaps(timeslot_data_list, existing_timeslots)
 
-        # Create a list of end times for timeslots
-        # Naive datetimes are used to avoid problems with DST (not handled by
-        # rrule)
-        timeslot_end_dates = list(
-            rrule(
-                freq=DAILY,
-                dtstart=aware_start.replace(
-                    hour=aware_end.hour,
-                    minute=aware_end.minute,
-                    second=aware_end.second,
-                    tzinfo=None,
+        if overlaps:
+            datetime_field = serializers.DateTimeField()
+            raise serializers.ValidationError({
+                'non_field_errors': _(
+                    "An existing timeslot overlaps with the provided "
+                    "start_time and end_time."
                 ),
-                until=aware_end.replace(tzinfo=None),
-                byweekday=validated_data['weekdays'],
-            )
-        )
-
-        # For every start/end times in the list built by rrule, we add the
-        # timezone information and create the timeslot using that timezone-
-        # aware datetime. This will be automatically converted to correct UTC
-        # time by Django.
-        for start, end in zip(timeslot_start_dates, timeslot_end_dates):
-            timeslot_data['start_time'] = tz.localize(start)
-            timeslot_data['end_time'] = tz.localize(end)
-            new_timeslot = TimeSlot(**timeslot_data)
-            timeslot_data_list.append(new_timeslot)
-
-        for duration in time_list:
-            for timeslot in timeslot_data_list:
-                start = timeslot.start_time
-                end = timeslot.end_time
-                if max(duration[0], start) < min(duration[1], end):
-                    raise serializers.ValidationError({
-                        'non_field_errors': _(
-                            "An existing timeslot overlaps with the provided "
-                            "start_time and end_time."
+                'conflicts': [
+                    {
+                        'start_time': datetime_field.to_representation(
+                            timeslot.start_time
                         ),
-                    })
+                        'end_time': datetime_field.to_representation(
+                            timeslot.end_time
+                        ),
+                        'timeslot': existing_timeslot.id,
+                    }
+                    for timeslot, existing_timeslot in overlaps
+                ],
+            })
 
-        return timeslot_data_list
+        return validated_data
 
+    @staticmethod
+    def generate_intervals(tz, dates, excluded_dates, time_ranges):
+        """
+        Yield the start & end times of a timeslot for each time range of each
+        date, sorted by start time.
+        Start and end times are localized separately from the date and time
+        they are made of, so the local time of timeslots is the same on
+        both sides of a DST change. The timezone-aware datetimes are
+        automatically converted to the correct UTC time by Django.
+        """
+        for date in dates:
+            date = date.date()
+            if date in excluded_dates:
+                continue
+            for time_range in time_ranges:
+                yield Interval(
+                    tz.localize(
+                        datetime.combine(date, time_range['start_time'])
+                    ),
+                    tz.localize(
+                        datetime.combine(date, time_range['end_time'])
+                    ),
+                )
+
+    @transaction.atomic()
     def create(self, validated_data):
-        return TimeSlot.objects.bulk_create(validated_data)
+        """
+        Insert the timeslots, with their availability, in chunks and set
+        their primary key. Returns the timeslots.
+        """
+        period = validated_data['period']
+        intervals = validated_data['intervals']
+        batch_size = settings.LOCAL_SETTINGS['TIMESLOT_BATCH_SIZE']
+        timeslots = []
+        for index in range(0, len(intervals), batch_size):
+            chunk = [
+                TimeSlot(
+                    period=period,
+                    price=period.price,
+                    start_time=interval.start_time,
+                    end_time=interval.end_time,
+                )
+                for interval in intervals[index:index + batch_size]
+            ]
+            if connection.features.can_return_ids_from_bulk_insert:
+                TimeSlot.objects.bulk_create(chunk)
+            else:
+                # Primary keys are only set by bulk_create on backends that
+                # return them (ie: PostgreSQL)
+                for timeslot in chunk:
+                    timeslot.save()
+            if period.workplace:
+                # New timeslots have no reservations
+                TimeSlotAvailability.objects.bulk_create(
+                    build_availability(timeslot) for timeslot in chunk
+                )
+            timeslots.extend(chunk)
+        return timeslots
 
     def save(self, **kwargs):
-        return self.create(self.validated_data)
+        self.instance = self.create(self.validated_data)
+        return self.instance
 
     class Meta:
         model = TimeSlot
         exclude = ('deleted', 'price', 'users', 'name', )
 
 
+class WorkplaceAvailabilitySerializer(serializers.Serializer):
+    """
+    Validates the date range of a workplace availability calendar. The range
+    defaults to the next 30 days.
+    """
+    DEFAULT_DAYS = 30
+    MAX_DAYS = 92
+
+    def get_fields(self):
+        # "from" is a keyword and can't be declared as a class attribute
+        return {
+            'from': serializers.DateField(required=False),
+            'to': serializers.DateField(required=False),
+        }
+
+    def validate(self, attrs):
+        start = attrs.get('from', timezone.localdate())
+        end = attrs.get('to', start + timedelta(days=self.DEFAULT_DAYS))
+
+        if start > end:
+            raise serializers.ValidationError({
+                'to': [_("This date must be later than 'from'.")],
+            })
+        if (end - start).days > self.MAX_DAYS:
+            raise serializers.ValidationError({
+                'to': [_(
+                    "The calendar can't span more than {0} days."
+                ).format(self.MAX_DAYS)],
+            })
+
+        return {'from': start, 'to': end}
+
+
 class ReservationSerializer(serializers.HyperlinkedModelSerializer):
     id = serializers.ReadOnlyField()
     # Custom names are needed to overcome an issue with DRF:
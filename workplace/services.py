@@ -0,0 +1,295 @@
+import hashlib
+import heapq
+import json
+from collections import defaultdict
+from itertools import groupby
+
+import pytz
+
+from rest_framework import serializers
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import (Case, Count, F, IntegerField, OuterRef, Q,
+                              Subquery, Value, When, )
+from django.db.models.functions import Coalesce
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from blitz_api.services import queue_mass_mail, update_tickets
+
+from .models import Reservation, TimeSlot, TimeSlotAvailability
+
+
+def find_overlaps(timeslots, others):
+    """
+    Return every (timeslot, other) pair of overlapping timeslots, sorted by
+    start time. Both lists must be sorted by start time.
+
+    Both lists are swept at once: "others" that started before the end of
+    the current timeslot are kept in a heap ordered by end time, from which
+    those that ended before its start are discarded. This takes
+    O((n + m) log m + k) instead of comparing every pair.
+    """
+    overlaps = []
+    active = []
+    index = 0
+    for timeslot in timeslots:
+        while (index < len(others) and
+                others[index].start_time < timeslot.end_time):
+            heapq.heappush(active, (others[index].end_time, index))
+            index += 1
+        while active and active[0][0] <= timeslot.start_time:
+            heapq.heappop(active)
+        overlaps.extend(
+            (timeslot, others[other_index])
+            for end_time, other_index in sorted(active, key=lambda x: x[1])
+            if others[other_index].start_time < timeslot.end_time
+        )
+    return overlaps
+
+
+def build_availability(timeslot, reserved=0):
+    """
+    Return the unsaved availability of a timeslot whose period belongs to a
+    workplace.
+    """
+    workplace = timeslot.period.workplace
+    tz = pytz.timezone(workplace.timezone or settings.TIME_ZONE)
+    return TimeSlotAvailability(
+        timeslot=timeslot,
+        workplace=workplace,
+        date=timeslot.start_time.astimezone(tz).date(),
+        start_time=timeslot.start_time,
+        end_time=timeslot.end_time,
+        reserved=reserved,
+    )
+
+
+def update_availability(timeslot_ids):
+    """
+    Synchronize the availability rows of the given timeslots with the
+    timeslots themselves: rows of new timeslots are created, rows of
+    timeslots that were deleted, or that no longer belong to a workplace,
+    are removed and the workplace and times of the others are updated.
+
+    The reserved seats of existing rows are not recomputed, they are kept up
+    to date by "adjust_availability" as reservations are made and canceled.
+    """
+    timeslot_ids = set(timeslot_ids)
+    if not timeslot_ids:
+        return
+
+    timeslots = TimeSlot.objects.filter(
+        pk__in=timeslot_ids,
+        period__deleted__isnull=True,
+        period__workplace__isnull=False,
+    ).select_related('period__workplace').annotate(
+        reserved=Count(
+            'reservations',
+            filter=Q(
+                reservations__is_active=True,
+                reservations__deleted__isnull=True,
+            ),
+        ),
+    )
+
+    with transaction.atomic():
+        existing = TimeSlotAvailability.objects.select_for_update().in_bulk(
+            list(timeslot_ids)
+        )
+        new_availabilities = []
+        for timeslot in timeslots:
+            availability = build_availability(timeslot, timeslot.reserved)
+            current = existing.pop(timeslot.id, None)
+            if current is None:
+                new_availabilities.append(availability)
+            elif any(
+                getattr(current, field) != getattr(availability, field)
+                for field in ('workplace_id', 'date', 'start_time', 'end_time')
+            ):
+                TimeSlotAvailability.objects.filter(pk=timeslot.id).update(
+                    workplace=availability.workplace,
+                    date=availability.date,
+                    start_time=availability.start_time,
+                    end_time=availability.end_time,
+                )
+
+        if existing:
+            TimeSlotAvailability.objects.filter(pk__in=existing).delete()
+        TimeSlotAvailability.objects.bulk_create(new_availabilities)
+
+
+def adjust_availability(amounts):
+    """
+    Update the reserved seats of timeslots.
+
+    amounts maps timeslot ids to the number of reservations made, or
+    canceled if negative. Rows are updated in place by a single statement so
+    that concurrent bookings of a timeslot add up instead of overwriting each
+    other.
+    """
+    amounts = {
+        timeslot_id: amount
+        for timeslot_id, amount in amounts.items() if amount
+    }
+    if not amounts:
+        return
+
+    TimeSlotAvailability.objects.filter(pk__in=amounts).update(
+        reserved=F('reserved') + Case(
+            *[
+                When(pk=timeslot_id, then=Value(amount))
+                for timeslot_id, amount in amounts.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+
+
+def rebuild_availability():
+    """
+    Synchronize the availability rows of all timeslots and recount their
+    reserved seats from the active reservations.
+    """
+    update_availability(
+        set(TimeSlot.objects.values_list('id', flat=True)) |
+        set(TimeSlotAvailability.objects.values_list('pk', flat=True))
+    )
+    reserved = Reservation.objects.filter(
+        timeslot_id=OuterRef('pk'),
+        is_active=True,
+    ).order_by().values('timeslot_id').annotate(
+        count=Count('pk'),
+    ).values('count')
+    TimeSlotAvailability.objects.update(
+        reserved=Coalesce(Subquery(reserved), 0),
+    )
+
+
+def get_availability(workplace, start_date, end_date, active_only=True):
+    """
+    Return the remaining seats of the timeslots of a workplace between two
+    dates (inclusive), grouped by day, along with an ETag of the calendar.
+    """
+    availabilities = TimeSlotAvailability.objects.filter(
+        workplace=workplace,
+        date__gte=start_date,
+        date__lte=end_date,
+    ).order_by('date', 'start_time')
+    if active_only:
+        availabilities = availabilities.filter(
+            timeslot__period__is_active=True,
+        )
+    datetime_field = serializers.DateTimeField()
+
+    days = [
+        {
+            'date': date,
+            'time_slots': [
+                {
+                    'id': availability.timeslot_id,
+                    'start_time': datetime_field.to_representation(
+                        availability.start_time
+                    ),
+                    'end_time': datetime_field.to_representation(
+                        availability.end_time
+                    ),
+                    'places_remaining': max(
+                        workplace.seats - availability.reserved,
+                        0,
+                    ),
+                }
+                for availability in day
+            ],
+        }
+        for date, day in groupby(
+            availabilities,
+            key=lambda availability: availability.date,
+        )
+    ]
+    data = {
+        'workplace': workplace.id,
+        'seats': workplace.seats,
+        'from': start_date,
+        'to': end_date,
+        'days': days,
+    }
+    etag = hashlib.md5(
+        json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True).encode()
+    ).hexdigest()
+    return data, etag
+
+
+def cancel_reservations(reservations, cancelation_reason):
+    """
+    Cancel the active reservations of the queryset, give back a ticket for
+    each of them to their user and free their seats. The number of queries
+    does not depend on the number of reservations. Must be called in a
+    transaction.
+
+    Returns the (timeslot id, user email) of the canceled reservations, to
+    notify users with "notify_cancelations" once the transaction is
+    committed.
+    """
+    reservations = reservations.filter(is_active=True)
+    canceled = list(reservations.values_list('timeslot_id', 'user__email'))
+
+    # Refunds must be computed before the reservations are updated: the
+    # queryset is filtered using "is_active=True" and would be empty
+    # afterwards. A user with multiple reservations gets one ticket back for
+    # each of them.
+    update_tickets(
+        dict(
+            reservations.order_by().values_list('user_id').annotate(
+                Count('id'),
+            )
+        ),
+        'C',
+    )
+    adjust_availability(
+        {
+            timeslot_id: -count
+            for timeslot_id, count in reservations.order_by().values_list(
+                'timeslot_id',
+            ).annotate(Count('id'))
+        }
+    )
+    reservations.update(
+        is_active=False,
+        cancelation_reason=cancelation_reason,
+        cancelation_date=timezone.now(),
+    )
+
+    return canceled
+
+
+def notify_cancelations(canceled, custom_message=None):
+    """
+    Email the users of canceled reservations, as returned by
+    "cancel_reservations". The email of each timeslot is rendered once and
+    sent separately for each of its canceled reservations.
+    """
+    emails = defaultdict(list)
+    for timeslot_id, email in canceled:
+        emails[timeslot_id].append(email)
+    timeslots = TimeSlot.objects.all_with_deleted().in_bulk(list(emails))
+
+    for timeslot_id, recipient_list in emails.items():
+        merge_data = {
+            'TIMESLOT_LIST': [timeslots[timeslot_id]],
+            'SUPPORT_EMAIL': settings.SUPPORT_EMAIL,
+            'CUSTOM_MESSAGE': custom_message,
+        }
+        plain_msg = render_to_string("cancelation.txt", merge_data)
+        msg_html = render_to_string("cancelation.html", merge_data)
+        queue_mass_mail(
+            "Annulation d'un bloc de rédaction",
+            plain_msg,
+            settings.DEFAULT_FROM_EMAIL,
+            recipient_list,
+            html_message=msg_html,
+            unique=False,
+        )
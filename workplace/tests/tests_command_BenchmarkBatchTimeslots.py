@@ -0,0 +1,50 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..models import Period, TimeSlot, Workplace
+
+
+class BenchmarkBatchTimeslotsTest(TestCase):
+
+    @override_settings(DEBUG=True)
+    def test_benchmark_batch_timeslots(self):
+        out = StringIO()
+
+        call_command(
+            'benchmark_batch_timeslots',
+            '--workplaces=2',
+            '--days=30',
+            '--time_ranges=3',
+            stdout=out
+        )
+
+        self.assertIn(
+            'Schedules: 2 workplaces, 30 days, 3 timeslots/day',
+            out.getvalue(),
+        )
+        self.assertIn('Timeslots: 180 (180 saved)', out.getvalue())
+        self.assertIn('Total: ', out.getvalue())
+
+        # Benchmark data is deleted
+        self.assertFalse(Workplace.objects.all_with_deleted().exists())
+        self.assertFalse(Period.objects.all_with_deleted().exists())
+        self.assertFalse(TimeSlot.objects.all_with_deleted().exists())
+
+    @override_settings(DEBUG=True)
+    def test_benchmark_batch_timeslots_max_duration(self):
+        with self.assertRaises(CommandError):
+            call_command(
+                'benchmark_batch_timeslots',
+                '--workplaces=1',
+                '--days=7',
+                '--max_duration=0',
+                stdout=StringIO(),
+            )
+
+    def test_benchmark_batch_timeslots_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_batch_timeslots', '--workplaces=1')
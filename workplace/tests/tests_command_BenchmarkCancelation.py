@@ -0,0 +1,51 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..models import Period, Reservation, TimeSlot, Workplace
+
+User = get_user_model()
+
+
+class BenchmarkCancelationTest(TestCase):
+
+    @override_settings(DEBUG=True)
+    def test_benchmark_cancelation(self):
+        out = StringIO()
+
+        call_command(
+            'benchmark_cancelation',
+            '--reservations=20',
+            '--users=10',
+            '--timeslots=2',
+            stdout=out
+        )
+
+        self.assertIn('Status: 204', out.getvalue())
+        self.assertIn('Reservations: 20 (20 canceled)', out.getvalue())
+        self.assertIn('Duration: ', out.getvalue())
+
+        # Benchmark data is deleted
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Workplace.objects.all_with_deleted().exists())
+        self.assertFalse(Period.objects.all_with_deleted().exists())
+        self.assertFalse(TimeSlot.objects.all_with_deleted().exists())
+        self.assertFalse(Reservation.objects.all_with_deleted().exists())
+
+    @override_settings(DEBUG=True)
+    def test_benchmark_cancelation_too_many_reservations(self):
+        with self.assertRaises(CommandError):
+            call_command(
+                'benchmark_cancelation',
+                '--reservations=21',
+                '--users=10',
+                '--timeslots=2',
+            )
+
+    def test_benchmark_cancelation_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_cancelation', '--reservations=1')
@@ -0,0 +1,89 @@
+from datetime import datetime
+from io import StringIO
+
+import pytz
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from blitz_api.factories import UserFactory
+
+from ..models import (Period, Reservation, TimeSlot, TimeSlotAvailability,
+                      Workplace, )
+from ..services import adjust_availability, update_availability
+
+User = get_user_model()
+
+LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
+
+class RebuildAvailabilityTest(TestCase):
+
+    def setUp(self):
+        self.workplace = Workplace.objects.create(
+            name="Blitz",
+            seats=40,
+            address_line1="random_address_1",
+            postal_code="RAN_DOM",
+            state_province="Random_State",
+            country="Random_Country",
+            timezone="America/Montreal",
+        )
+        self.period = Period.objects.create(
+            name="random_period_active",
+            workplace=self.workplace,
+            start_date=LOCAL_TIMEZONE.localize(datetime(2130, 1, 15)),
+            end_date=LOCAL_TIMEZONE.localize(datetime(2130, 1, 30)),
+            price=3,
+            is_active=True,
+        )
+        self.timeslots = [
+            TimeSlot.objects.create(
+                period=self.period,
+                price=1,
+                start_time=LOCAL_TIMEZONE.localize(datetime(2130, 1, day, 8)),
+                end_time=LOCAL_TIMEZONE.localize(datetime(2130, 1, day, 12)),
+            )
+            for day in (16, 17)
+        ]
+        for user in (UserFactory(), UserFactory()):
+            Reservation.objects.create(
+                user=user,
+                timeslot=self.timeslots[0],
+                is_active=True,
+            )
+
+    def test_rebuild_availability(self):
+        """
+        Ensure missing availability rows are created and reserved seats are
+        recounted from active reservations.
+        """
+        update_availability([self.timeslots[0].id])
+        adjust_availability({self.timeslots[0].id: 5})
+        out = StringIO()
+
+        call_command('rebuild_availability', stdout=out)
+
+        self.assertIn(
+            'Rebuilt the availability of 2 timeslots',
+            out.getvalue(),
+        )
+        self.assertEqual(
+            dict(TimeSlotAvailability.objects.values_list('pk', 'reserved')),
+            {self.timeslots[0].id: 2, self.timeslots[1].id: 0},
+        )
+
+    def test_rebuild_availability_deleted_timeslot(self):
+        """
+        Ensure rows of soft-deleted timeslots are removed.
+        """
+        update_availability([timeslot.id for timeslot in self.timeslots])
+        self.timeslots[1].delete()
+
+        call_command('rebuild_availability', stdout=StringIO())
+
+        self.assertEqual(
+            list(TimeSlotAvailability.objects.values_list('pk', flat=True)),
+            [self.timeslots[0].id],
+        )
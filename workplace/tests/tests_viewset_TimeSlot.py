@@ -8,17 +8,20 @@ from datetime import datetime, timedelta, date, time
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
+from django.db import connection
 from django.urls import reverse
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import mail
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from blitz_api.factories import UserFactory, AdminFactory
+from blitz_api.models import TicketEntry
 from blitz_api.services import remove_translation_fields
 
-from ..models import Period, TimeSlot, Workplace, Reservation
+from ..models import (Period, TimeSlot, Workplace, Reservation,
+                      TimeSlotAvailability, )
 
 User = get_user_model()
 
@@ -1008,6 +1011,47 @@ class TimeSlotTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_delete_queries(self):
+        """
+        Ensure the number of queries to delete a timeslot does not depend
+        on the number of reservations to cancel.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        def delete_time_slot(day, users):
+            time_slot = TimeSlot.objects.create(
+                period=self.period_active,
+                price=3,
+                start_time=LOCAL_TIMEZONE.localize(datetime(2130, 3, day, 8)),
+                end_time=LOCAL_TIMEZONE.localize(datetime(2130, 3, day, 12)),
+            )
+            for user in users:
+                Reservation.objects.create(
+                    user=user,
+                    timeslot=time_slot,
+                    is_active=True,
+                )
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.delete(
+                    reverse('timeslot-detail', kwargs={'pk': time_slot.id}),
+                    {'force_delete': True},
+                    format='json',
+                )
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_204_NO_CONTENT,
+                response.content,
+            )
+            return len(queries)
+
+        queries = delete_time_slot(1, [UserFactory()])
+
+        self.assertEqual(
+            delete_time_slot(2, [UserFactory() for _ in range(5)]),
+            queries,
+        )
+        self.assertEqual(len(mail.outbox), 6)
+
     def test_delete_with_reservations(self):
         """
         Ensure we can delete a timeslot that has reservations.
@@ -1045,6 +1089,10 @@ class TimeSlotTests(APITestCase):
         self.assertEqual(len(mail.outbox), 3)
         self.assertEqual(self.user.tickets, 3)
         self.assertEqual(self.admin.tickets, 2)
+        self.assertEqual(
+            TicketEntry.objects.get(user=self.user, reason='C').amount,
+            2,
+        )
 
         self.reservation.is_active = True
         self.reservation.cancelation_date = None
@@ -1173,6 +1221,49 @@ class TimeSlotTests(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_queries(self):
+        """
+        Ensure the number of queries to list timeslots does not depend on
+        the number of timeslots and reservations.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('timeslot-list'))
+
+        for day in range(1, 11):
+            time_slot = TimeSlot.objects.create(
+                period=self.period_active,
+                price=3,
+                start_time=LOCAL_TIMEZONE.localize(datetime(2130, 2, day, 8)),
+                end_time=LOCAL_TIMEZONE.localize(datetime(2130, 2, day, 12)),
+            )
+            Reservation.objects.create(
+                user=self.user,
+                timeslot=time_slot,
+                is_active=True,
+            )
+            Reservation.objects.create(
+                user=self.admin,
+                timeslot=time_slot,
+                is_active=False,
+            )
+
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('timeslot-list'))
+
+        data = json.loads(response.content)
+        result = next(
+            result for result in data['results']
+            if result['id'] == time_slot.id
+        )
+
+        self.assertEqual(data['count'], 12)
+        self.assertEqual(result['places_remaining'], 39)
+        self.assertEqual(len(result['reservations']), 1)
+        self.assertEqual(len(result['reservations_canceled']), 1)
+        self.assertEqual(len(result['users']), 2)
+
     def test_list_inactive(self):
         """
         Ensure we can list all timeslots as an admin user.
@@ -1567,6 +1658,22 @@ class TimeSlotTests(APITestCase):
             period=self.period_no_workplace
         )
         new_timeslot_count = new_timeslots.count()
+        content = json.loads(response.content)
+
+        self.assertEqual(content['count'], new_timeslot_count)
+        self.assertEqual(
+            content['time_slots'][0],
+            {
+                'id': new_timeslots.earliest('start_time').id,
+                'url': 'http://testserver/time_slots/{0}'.format(
+                    new_timeslots.earliest('start_time').id
+                ),
+            },
+        )
+        self.assertEqual(
+            {time_slot['id'] for time_slot in content['time_slots']},
+            set(new_timeslots.values_list('id', flat=True)),
+        )
 
         start_date = date(2130, 1, 1)
         end_date = date(2130, 12, 12)
@@ -1595,6 +1702,145 @@ class TimeSlotTests(APITestCase):
                 time(12, 0, 0)
             )
 
+    @override_settings(
+        LOCAL_SETTINGS=dict(settings.LOCAL_SETTINGS, TIMESLOT_BATCH_SIZE=3),
+    )
+    def test_batch_create_time_ranges(self):
+        """
+        Ensure that an admin can batch create multiple timeslots per day,
+        except on excluded dates, with the same local time across DST
+        changes.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "period": reverse(
+                'period-detail', args=[self.period_active.id]
+            ),
+            "time_ranges": [
+                {"start_time": "13:00:00", "end_time": "17:00:00"},
+                {"start_time": "08:00:00", "end_time": "12:00:00"},
+            ],
+            "start_date": "2130-03-08",
+            "end_date": "2130-03-14",
+            "excluded_dates": ["2130-03-10"],
+            "weekdays": [0, 1, 2, 3, 4, 5, 6],
+        }
+
+        response = self.client.post(
+            reverse('timeslot-batch-create'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            response.content
+        )
+
+        new_timeslots = TimeSlot.objects.filter(
+            period=self.period_active,
+            start_time__date__gte=date(2130, 3, 8),
+        ).order_by('start_time')
+        local_times = [
+            (
+                timeslot.start_time.astimezone(LOCAL_TIMEZONE),
+                timeslot.end_time.astimezone(LOCAL_TIMEZONE),
+            )
+            for timeslot in new_timeslots
+        ]
+        expected_times = [
+            (
+                LOCAL_TIMEZONE.localize(datetime(2130, 3, day, *start)),
+                LOCAL_TIMEZONE.localize(datetime(2130, 3, day, *end)),
+            )
+            for day in (8, 9, 11, 12, 13, 14)
+            for start, end in (((8,), (12,)), ((13,), (17,)))
+        ]
+
+        self.assertEqual(json.loads(response.content)['count'], 12)
+        self.assertEqual(local_times, expected_times)
+        self.assertEqual(
+            [
+                (start.hour, end.hour)
+                for start, end in local_times
+            ],
+            [(8, 12), (13, 17)] * 6,
+        )
+        # All timeslots get their price and availability
+        self.assertFalse(new_timeslots.exclude(price=3).exists())
+        self.assertEqual(
+            TimeSlotAvailability.objects.filter(
+                timeslot__in=new_timeslots,
+            ).count(),
+            12,
+        )
+
+    def test_batch_create_overlapping_time_ranges(self):
+        """
+        Ensure that an admin can't batch create timeslots with overlapping
+        time ranges.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "period": reverse(
+                'period-detail', args=[self.period_active.id]
+            ),
+            "time_ranges": [
+                {"start_time": "08:00:00", "end_time": "12:00:00"},
+                {"start_time": "11:00:00", "end_time": "17:00:00"},
+            ],
+            "start_date": "2130-03-08",
+            "end_date": "2130-03-14",
+            "weekdays": [0, 1, 2, 3, 4, 5, 6],
+        }
+
+        response = self.client.post(
+            reverse('timeslot-batch-create'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'time_ranges': ["Time ranges can't overlap each other."],
+        }
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), content)
+
+    def test_batch_create_without_times(self):
+        """
+        Ensure that an admin can't batch create timeslots without times.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        data = {
+            "period": reverse(
+                'period-detail', args=[self.period_active.id]
+            ),
+            "start_time": "08:00:00",
+            "start_date": "2130-03-08",
+            "end_date": "2130-03-14",
+            "weekdays": [0, 1, 2, 3, 4, 5, 6],
+        }
+
+        response = self.client.post(
+            reverse('timeslot-batch-create'),
+            data,
+            format='json',
+        )
+
+        content = {
+            'time_ranges': [
+                "Provide either start_time and end_time or time_ranges."
+            ],
+        }
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), content)
+
     def test_batch_create_without_permission(self):
         """
         Ensure that an admin can batch create timeslots for a specific period.
@@ -1731,7 +1977,81 @@ class TimeSlotTests(APITestCase):
             "non_field_errors": [
                 "An existing timeslot overlaps with the provided start_time "
                 "and end_time."
-            ]
+            ],
+            "conflicts": [{
+                "start_time": "2130-01-15T00:00:00-05:00",
+                "end_time": "2130-01-15T23:59:59-05:00",
+                "timeslot": str(self.time_slot_active.id),
+            }],
+        }
+
+        self.assertEqual(json.loads(response.content), content)
+
+    def test_batch_create_multiple_conflicts(self):
+        """
+        Ensure that every timeslot of the batch overlapping an existing
+        timeslot is reported, and that existing timeslots outside of the
+        batch are ignored.
+        """
+        self.client.force_authenticate(user=self.admin)
+
+        time_slots = [
+            TimeSlot.objects.create(
+                period=self.period_active,
+                price=3,
+                start_time=LOCAL_TIMEZONE.localize(datetime(*start)),
+                end_time=LOCAL_TIMEZONE.localize(datetime(*end)),
+            )
+            for start, end in (
+                ((2130, 1, 17, 19), (2130, 1, 17, 20)),
+                ((2130, 1, 17, 20), (2130, 1, 17, 23)),
+                ((2130, 1, 18, 12), (2130, 1, 18, 17)),
+                ((2130, 3, 15, 18), (2130, 3, 15, 22)),
+            )
+        ]
+
+        data = {
+            "period": reverse(
+                'period-detail', args=[self.period_active.id]
+            ),
+            "name": "test",
+            "start_date": "2130-01-14",
+            "end_date": "2130-01-20",
+            "start_time": "17:00:00",
+            "end_time": "21:00:00",
+            "weekdays": [0, 1, 2, 3, 4, 5, 6],
+        }
+
+        response = self.client.post(
+            reverse('timeslot-batch-create'),
+            data,
+            format='json',
+        )
+
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            response.content,
+        )
+
+        conflicts = [
+            ("2130-01-15", self.time_slot_active),
+            ("2130-01-17", time_slots[0]),
+            ("2130-01-17", time_slots[1]),
+        ]
+        content = {
+            "non_field_errors": [
+                "An existing timeslot overlaps with the provided start_time "
+                "and end_time."
+            ],
+            "conflicts": [
+                {
+                    "start_time": "{0}T17:00:00-05:00".format(date),
+                    "end_time": "{0}T21:00:00-05:00".format(date),
+                    "timeslot": str(time_slot.id),
+                }
+                for date, time_slot in conflicts
+            ],
         }
 
         self.assertEqual(json.loads(response.content), content)
@@ -1,18 +1,24 @@
 import json
+from datetime import datetime
 
+import pytz
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
+from django.conf import settings
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 
 from blitz_api.factories import UserFactory, AdminFactory
 from blitz_api.services import remove_translation_fields
 
-from ..models import Workplace
+from ..models import Workplace, Period, TimeSlot, Reservation
+from ..services import update_availability
 
 User = get_user_model()
 
+LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
 
 class WorkplaceTests(APITestCase):
 
@@ -390,3 +396,202 @@ class WorkplaceTests(APITestCase):
         self.assertEqual(json.loads(response.content), content)
 
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def create_timeslots(self):
+        """
+        Create timeslots on two days in an active period and a timeslot in an
+        inactive period, then compute their availability.
+        """
+        period = Period.objects.create(
+            name="random_period_active",
+            workplace=self.workplace,
+            start_date=LOCAL_TIMEZONE.localize(datetime(2130, 1, 15)),
+            end_date=LOCAL_TIMEZONE.localize(datetime(2130, 1, 30)),
+            price=3,
+            is_active=True,
+        )
+        period_inactive = Period.objects.create(
+            name="random_period",
+            workplace=self.workplace,
+            start_date=LOCAL_TIMEZONE.localize(datetime(2130, 2, 15)),
+            end_date=LOCAL_TIMEZONE.localize(datetime(2130, 2, 28)),
+            price=3,
+            is_active=False,
+        )
+        timeslots = [
+            TimeSlot.objects.create(
+                period=period,
+                price=1,
+                start_time=LOCAL_TIMEZONE.localize(datetime(*start)),
+                end_time=LOCAL_TIMEZONE.localize(datetime(*end)),
+            )
+            for start, end in (
+                ((2130, 1, 16, 13), (2130, 1, 16, 17)),
+                ((2130, 1, 16, 8), (2130, 1, 16, 12)),
+                ((2130, 1, 17, 8), (2130, 1, 17, 12)),
+            )
+        ]
+        timeslots.append(TimeSlot.objects.create(
+            period=period_inactive,
+            price=1,
+            start_time=LOCAL_TIMEZONE.localize(datetime(2130, 2, 16, 8)),
+            end_time=LOCAL_TIMEZONE.localize(datetime(2130, 2, 16, 12)),
+        ))
+        self.reservation = Reservation.objects.create(
+            user=self.user,
+            timeslot=timeslots[1],
+            is_active=True,
+        )
+        Reservation.objects.create(
+            user=self.admin,
+            timeslot=timeslots[1],
+            is_active=False,
+        )
+        update_availability([timeslot.id for timeslot in timeslots])
+        return timeslots
+
+    def test_availability(self):
+        """
+        Ensure we can get the remaining seats of the active timeslots of a
+        workplace, by day, as an unauthenticated user.
+        """
+        timeslots = self.create_timeslots()
+
+        response = self.client.get(
+            reverse(
+                'workplace-availability',
+                kwargs={'pk': self.workplace.id},
+            ),
+            {'from': '2130-01-16', 'to': '2130-02-16'},
+        )
+
+        content = {
+            'workplace': self.workplace.id,
+            'seats': 40,
+            'from': '2130-01-16',
+            'to': '2130-02-16',
+            'days': [
+                {
+                    'date': '2130-01-16',
+                    'time_slots': [
+                        {
+                            'id': timeslots[1].id,
+                            'start_time': '2130-01-16T08:00:00-05:00',
+                            'end_time': '2130-01-16T12:00:00-05:00',
+                            'places_remaining': 39,
+                        },
+                        {
+                            'id': timeslots[0].id,
+                            'start_time': '2130-01-16T13:00:00-05:00',
+                            'end_time': '2130-01-16T17:00:00-05:00',
+                            'places_remaining': 40,
+                        },
+                    ],
+                },
+                {
+                    'date': '2130-01-17',
+                    'time_slots': [
+                        {
+                            'id': timeslots[2].id,
+                            'start_time': '2130-01-17T08:00:00-05:00',
+                            'end_time': '2130-01-17T12:00:00-05:00',
+                            'places_remaining': 40,
+                        },
+                    ],
+                },
+            ],
+        }
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), content)
+        self.assertTrue(response['ETag'])
+
+    def test_availability_as_admin(self):
+        """
+        Ensure admins also see the timeslots of inactive periods.
+        """
+        timeslots = self.create_timeslots()
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get(
+            reverse(
+                'workplace-availability',
+                kwargs={'pk': self.workplace.id},
+            ),
+            {'from': '2130-02-16', 'to': '2130-02-16'},
+        )
+
+        content = json.loads(response.content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            content['days'][0]['time_slots'][0]['id'],
+            timeslots[3].id,
+        )
+
+    def test_availability_not_modified(self):
+        """
+        Ensure an unchanged calendar is not sent again and that canceling a
+        reservation changes the calendar.
+        """
+        self.create_timeslots()
+        url = reverse(
+            'workplace-availability',
+            kwargs={'pk': self.workplace.id},
+        )
+        params = {'from': '2130-01-16', 'to': '2130-01-16'}
+
+        response = self.client.get(url, params)
+        etag = response['ETag']
+
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.content)
+
+        self.client.force_authenticate(user=self.user)
+        self.client.delete(
+            reverse(
+                'reservation-detail',
+                kwargs={'pk': self.reservation.id},
+            ),
+        )
+
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+
+        content = json.loads(response.content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+            content['days'][0]['time_slots'][0]['places_remaining'],
+            40,
+        )
+
+    def test_availability_invalid_dates(self):
+        """
+        Ensure the date range of the calendar is validated.
+        """
+        response = self.client.get(
+            reverse(
+                'workplace-availability',
+                kwargs={'pk': self.workplace.id},
+            ),
+            {'from': '2130-01-16', 'to': '2130-01-15'},
+        )
+
+        content = {'to': ["This date must be later than 'from'."]}
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), content)
+
+        response = self.client.get(
+            reverse(
+                'workplace-availability',
+                kwargs={'pk': self.workplace.id},
+            ),
+            {'from': '2130-01-16', 'to': '2131-01-15'},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
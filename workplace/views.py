@@ -1,7 +1,5 @@
 import pytz
 
-from copy import copy
-
 from datetime import datetime
 
 from dateutil.parser import parse
@@ -11,29 +9,30 @@ import rest_framework
 from rest_framework import viewsets, status, exceptions
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.core.mail import send_mail as django_send_mail
 from django.db import transaction
-from django.db.models import F, Q
+from django.db.models import Count, Prefetch, Q
 from django.http import HttpResponse
-from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from blitz_api.exceptions import MailServiceError
-from blitz_api.services import send_mail, ExportPagination
+from blitz_api.services import send_mail, ExportPagination, stream_export
 
 from .models import Workplace, Picture, Period, TimeSlot, Reservation
+from .services import (adjust_availability, cancel_reservations,
+                       get_availability, notify_cancelations,
+                       update_availability, )
 from .resources import (WorkplaceResource, PeriodResource, TimeSlotResource,
                         ReservationResource)
 
 from . import serializers, permissions
 
-User = get_user_model()
-
 LOCAL_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
 
 
@@ -60,6 +59,14 @@ class WorkplaceViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                WorkplaceResource(),
+                queryset,
+                'Workplace',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -74,6 +81,34 @@ class WorkplaceViewSet(viewsets.ModelViewSet):
         ])
         return response
 
+    @action(detail=True)
+    def availability(self, request, pk=None):
+        """
+        Return the remaining seats of the workplace's timeslots for each day
+        between the "from" and "to" dates (inclusive). Calendars are served
+        from precomputed availabilities and carry an ETag: a request with a
+        matching "If-None-Match" header gets an empty 304 response.
+        """
+        workplace = self.get_object()
+        serializer = serializers.WorkplaceAvailabilitySerializer(
+            data=request.query_params,
+        )
+        serializer.is_valid(raise_exception=True)
+
+        data, etag = get_availability(
+            workplace,
+            serializer.validated_data['from'],
+            serializer.validated_data['to'],
+            active_only=not request.user.is_staff,
+        )
+        etag = quote_etag(etag)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = Response(data)
+        response['ETag'] = etag
+        return response
+
 
 class PictureViewSet(viewsets.ModelViewSet):
     """
@@ -120,6 +155,9 @@ class PeriodViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(request, PeriodResource(), queryset, 'Period')
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -143,6 +181,11 @@ class PeriodViewSet(viewsets.ModelViewSet):
             return Period.objects.all()
         return Period.objects.filter(is_active=True)
 
+    def perform_update(self, serializer):
+        period = serializer.save()
+        # The workplace of the period's timeslots may have changed
+        update_availability(period.time_slots.values_list('id', flat=True))
+
     def destroy(self, request, *args, **kwargs):
         """
         An admin can soft-delete a Period instance. From an API user
@@ -177,60 +220,18 @@ class PeriodViewSet(viewsets.ModelViewSet):
 
         custom_message = data.get('custom_message')
 
-        reservation_cancel = Reservation.objects.filter(
-            timeslot__period=instance, is_active=True
-        )
-        affected_users = User.objects.filter(
-            reservations__in=reservation_cancel
-        )
-
+        timeslot_ids = list(instance.time_slots.values_list('id', flat=True))
         with transaction.atomic():
-            reservations_cancel_copy = copy(reservation_cancel)
-
-            # The sequence is important here because the Queryset are
-            # dynamically changing when doing update(). If the
-            # `reservation_cancel` queryset objects are updated first, the
-            # queryset will become empty since it was filtered using
-            # "is_active=True". That would lead to an empty `affected_users`
-            # queryset.
-            #
-            # For-loop required to handle duplicates (if user has multiple
-            # reservations that must be canceled).
-            # user.update(tickets=F('tickets') + 1)
-            for user in affected_users:
-                User.objects.filter(
-                    email=user.email
-                ).update(tickets=F('tickets') + 1)  # Increment tickets
-            reservation_cancel.update(
-                is_active=False,
-                cancelation_reason='TD',  # Period deleted
-                cancelation_date=timezone.now(),
+            canceled = cancel_reservations(
+                Reservation.objects.filter(timeslot__period=instance),
+                'TD',  # Period deleted
             )
             instance.delete()
-
-            for reservation in reservations_cancel_copy:
-                merge_data = {
-                    'TIMESLOT_LIST': [reservation.timeslot],
-                    'SUPPORT_EMAIL': settings.SUPPORT_EMAIL,
-                    'CUSTOM_MESSAGE': custom_message,
-                }
-                plain_msg = render_to_string(
-                    "cancelation.txt",
-                    merge_data
-                )
-                msg_html = render_to_string(
-                    "cancelation.html",
-                    merge_data
-                )
-                django_send_mail(
-                    "Annulation d'un bloc de rédaction",
-                    plain_msg,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [reservation.user.email],
-                    html_message=msg_html,
-                )
-
             instance.time_slots.all().delete()
+            update_availability(timeslot_ids)
+
+        # Users are notified once the cancelation is committed
+        notify_cancelations(canceled, custom_message)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -263,12 +264,54 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
         'end_time': ['exact', 'gte', 'lte'],
     }
 
+    def get_queryset(self):
+        """
+        Timeslots are listed with their workplace, the number of active
+        reservations and the reservations themselves loaded in a constant
+        number of queries.
+        """
+        queryset = super(TimeSlotViewSet, self).get_queryset()
+        if self.action in ['list', 'retrieve']:
+            queryset = queryset.select_related(
+                'period__workplace',
+            ).annotate(
+                active_reservations=Count(
+                    'reservations',
+                    filter=Q(
+                        reservations__is_active=True,
+                        reservations__deleted__isnull=True,
+                    ),
+                    distinct=True,
+                ),
+            ).prefetch_related(
+                Prefetch(
+                    'reservations',
+                    queryset=Reservation.objects.only(
+                        'id',
+                        'is_active',
+                        'timeslot_id',
+                    ),
+                ),
+                'users',
+                'period__workplace__pictures',
+                'period__workplace__volunteers',
+            )
+        return queryset
+
     @action(detail=False, permission_classes=[IsAdminUser])
     def export(self, request):
         # Use custom paginator (by page, min/max 1000 objects/page)
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                TimeSlotResource(),
+                queryset,
+                'TimeSlot',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -290,33 +333,38 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
 
         Parameters:
             name: name to be used for all timeslots
-            start_time: datetime (isoformat).
-            end_time: datetime (isoformat).
+            start_time: time of the start of the timeslots.
+            end_time: time of the end of the timeslots.
+            time_ranges: list of {start_time, end_time} to create multiple
+                timeslots per day. Replaces start_time & end_time.
+            start_date: date of the first timeslots.
+            end_date: date of the last timeslots.
+            excluded_dates: list of dates without timeslots (ie: holidays).
             period: period in which timeslots are created. The period defines
                 the max boundary of the timeslot batch.
             weekdays: Days of the week for which the timeslots are created.
                 Takes a list of integer from 0:Monday to 6:Sunday.
 
-        NOTE:
-            The date from the datetimes (start_time & end_time) are used as
-            boundaries for the batch creation.
-            The time from the datetimes (start_time & end_time) are used as
-            start time & end time for the timeslots to be created.
-
         ie:
             {
                 'name': "test",
-                'start_time': '2019-11-25T08:00:00',
-                'end_time': '2019-12-25T12:00:00',
+                'time_ranges': [
+                    {'start_time': '08:00:00', 'end_time': '12:00:00'},
+                    {'start_time': '13:00:00', 'end_time': '17:00:00'},
+                ],
+                'start_date': '2019-11-25',
+                'end_date': '2019-12-25',
+                'excluded_dates': ['2019-12-24'],
                 'period': validated_data['period'],
                 'weekdays': [0,4]
             }
-            That will create timeslots named "test", with start_time=08:00:00
-            and end_time=12:00:00 for every Monday and Thursday between
-            2019-11-25 and 2019-12-25 if those dates are within the period
-            date range.
+            That will create timeslots named "test", from 08:00:00 to
+            12:00:00 and from 13:00:00 to 17:00:00 for every Monday and
+            Thursday between 2019-11-25 and 2019-12-25, except on
+            2019-12-24, if those dates are within the period date range.
 
-        Process will abort if a conflict arise.
+        Process will abort if a conflict arise. Returns the id and url of
+        the created timeslots.
         """
         serializer = serializers.BatchTimeSlotSerializer(
             data=request.data
@@ -324,24 +372,33 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
 
         serializer.is_valid(raise_exception=True)
 
-        serializer.save()
+        timeslots = serializer.save()
+
+        # Full timeslots are not serialized, a batch can hold thousands
+        data = {
+            'count': len(timeslots),
+            'time_slots': [
+                {
+                    'id': timeslot.id,
+                    'url': reverse(
+                        'timeslot-detail',
+                        args=[timeslot.id],
+                        request=request,
+                    ),
+                }
+                for timeslot in timeslots
+            ],
+        }
 
-        # The following commented code grabs the newly created timeslots and
-        #  returns them in the request.
-        #
-        # data = serializer.save()
-        # data = serializers.TimeSlotSerializer(
-        #     data,
-        #     many=True,
-        #     context={
-        #         'request': request,
-        #         'view': self
-        #     },
-        # ).data
-        #
-        # return Response(data, status=status.HTTP_201_CREATED)
-
-        return Response(status=status.HTTP_201_CREATED)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def perform_update(self, serializer):
+        serializer.save()
+        # Users are notified once the cancelation is committed
+        notify_cancelations(
+            serializer.canceled,
+            serializer.validated_data.get('custom_message'),
+        )
 
     def filter_queryset(self, queryset):
         """
@@ -386,59 +443,16 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
 
         custom_message = data.get('custom_message')
 
-        reservation_cancel = instance.reservations.filter(
-            is_active=True
-        )
-        affected_users = User.objects.filter(
-            reservations__in=reservation_cancel
-        )
-
         with transaction.atomic():
-            reservations_cancel_copy = copy(reservation_cancel)
-
-            # The sequence is important here because the Queryset are
-            # dynamically changing when doing update(). If the
-            # `reservation_cancel` queryset objects are updated first, the
-            # queryset will become empty since it was filtered using
-            # "is_active=True". That would lead to an empty `affected_users`
-            # queryset.
-            #
-            # For-loop required to handle duplicates (if user has multiple
-            # reservations that must be canceled).
-            # user.update(tickets=F('tickets') + 1)
-            for user in affected_users:
-                User.objects.filter(
-                    email=user.email
-                ).update(tickets=F('tickets') + 1)  # Increment tickets
-
-            reservation_cancel.update(
-                is_active=False,
-                cancelation_reason='TD',  # TimeSlot deleted
-                cancelation_date=timezone.now(),
+            canceled = cancel_reservations(
+                instance.reservations.all(),
+                'TD',  # TimeSlot deleted
             )
             instance.delete()
+            update_availability([instance.id])
 
-            for reservation in reservations_cancel_copy:
-                merge_data = {
-                    'TIMESLOT_LIST': [instance],
-                    'SUPPORT_EMAIL': settings.SUPPORT_EMAIL,
-                    'CUSTOM_MESSAGE': custom_message,
-                }
-                plain_msg = render_to_string(
-                    "cancelation.txt",
-                    merge_data
-                )
-                msg_html = render_to_string(
-                    "cancelation.html",
-                    merge_data
-                )
-                django_send_mail(
-                    "Annulation d'un bloc de rédaction",
-                    plain_msg,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [reservation.user.email],
-                    html_message=msg_html,
-                )
+        # Users are notified once the cancelation is committed
+        notify_cancelations(canceled, custom_message)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -475,6 +489,14 @@ class ReservationViewSet(viewsets.ModelViewSet):
         self.pagination_class = ExportPagination
         # Order queryset by ascending id, thus by descending age too
         queryset = self.get_queryset().order_by('pk')
+        # Stream the whole export instead of a page if requested
+        if request.query_params.get('stream'):
+            return stream_export(
+                request,
+                ReservationResource(),
+                queryset,
+                'Reservation',
+            )
         # Paginate queryset using custom paginator
         page = self.paginate_queryset(queryset)
         # Build dataset using paginated queryset
@@ -523,6 +545,11 @@ class ReservationViewSet(viewsets.ModelViewSet):
             ]
         return [permission() for permission in permission_classes]
 
+    def perform_create(self, serializer):
+        reservation = serializer.save()
+        if reservation.is_active:
+            adjust_availability({reservation.timeslot_id: 1})
+
     def update(self, request, *args, **kwargs):
         if self.action == "update":
             return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -541,4 +568,5 @@ class ReservationViewSet(viewsets.ModelViewSet):
             instance.cancelation_reason = 'U'
             instance.cancelation_date = timezone.now()
             instance.save()
+            adjust_availability({instance.timeslot_id: -1})
         return Response(status=status.HTTP_204_NO_CONTENT)